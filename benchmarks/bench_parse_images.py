@@ -0,0 +1,88 @@
+"""
+Benchmark of image set parsing: sequential os.walk() path versus parallel os.scandir() scanner
+
+Usage:
+    python benchmarks/bench_parse_images.py                      # synthetic tree in a temporary folder
+    python benchmarks/bench_parse_images.py --sets a:dir1:_a b:dir2:_b --ext .jpg --recursive
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+from imcomp.fill_table_data import parse_images_sequential
+from imcomp.image_scanner import scan_images
+
+
+def create_tree(root, nb_sets, nb_dirs, nb_files):
+    """ Create nb_sets image sets with nb_dirs subdirectories of nb_files empty images each """
+    image_sets = []
+    for s in range(nb_sets):
+        set_dir = os.path.join(root, f'set{s}')
+        for d in range(nb_dirs):
+            sub_dir = os.path.join(set_dir, f'scene{d // 10}', f'take{d}')
+            os.makedirs(sub_dir, exist_ok=True)
+            for f in range(nb_files):
+                open(os.path.join(sub_dir, f'image{f}_out.jpg'), 'w').close()
+                # files that need to be filtered out
+                open(os.path.join(sub_dir, f'image{f}_out.txt'), 'w').close()
+        image_sets.append({'directory': set_dir, 'suffix': '_out'})
+    return image_sets
+
+
+def timed(func, *args, **kwargs):
+    # parse_images_from_dir() prints each found file, do not measure the terminal output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        res = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+    return res, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sets', nargs='+', default=[], help="image sets as name:dir:suffix")
+    parser.add_argument('-f', '--filters', default='', help="comma separated filename filters")
+    parser.add_argument('--ext', nargs='+', default=['.jpg', '.png'], help="list of image extensions")
+    parser.add_argument('-rec', '--recursive', action='store_true', help="recursively parse directories")
+    parser.add_argument('--nb_sets',  type=int, default=6,   help="synthetic tree: number of image sets")
+    parser.add_argument('--nb_dirs',  type=int, default=200, help="synthetic tree: directories per set")
+    parser.add_argument('--nb_files', type=int, default=50,  help="synthetic tree: images per directory")
+    parser.add_argument('--workers', type=int, default=None, help="number of scanner threads")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs, the best time is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.sets:
+            image_sets = []
+            for set_desc in args.sets:
+                _, set_dir, set_suffix = set_desc.split(':')
+                image_sets.append({'directory': set_dir, 'suffix': set_suffix})
+            recursive = args.recursive
+        else:
+            image_sets = create_tree(tmp_dir, args.nb_sets, args.nb_dirs, args.nb_files)
+            recursive = True
+
+        sequential_times, parallel_times = [], []
+        for _ in range(args.repeat):
+            res_seq, t = timed(parse_images_sequential, image_sets, args.filters, args.ext, recursive)
+            sequential_times.append(t)
+            res_par, t = timed(scan_images, image_sets, args.filters, args.ext, recursive,
+                               max_workers=args.workers)
+            parallel_times.append(t)
+
+        if res_seq != res_par or list(res_seq or []) != list(res_par or []):
+            print("ERROR: the two parsers return different results")
+            sys.exit(1)
+        nb_images = len(res_seq) if res_seq else 0
+        t_seq, t_par = min(sequential_times), min(parallel_times)
+        print(f"{len(image_sets)} image sets, {nb_images} common images")
+        print(f"  sequential os.walk : {t_seq*1000:8.1f} ms")
+        print(f"  parallel scandir   : {t_par*1000:8.1f} ms  (x{t_seq/max(t_par, 1e-9):.2f})")
+
+
+if __name__ == '__main__':
+    main()
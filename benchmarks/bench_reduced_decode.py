@@ -0,0 +1,71 @@
+"""
+Benchmark of the image difference decoding: full decode + resize versus reduced JPEG decode + resize
+
+Usage:
+    python benchmarks/bench_reduced_decode.py                     # synthetic 6000x4000 JPEG images
+    python benchmarks/bench_reduced_decode.py --images a.jpg b.jpg --width 1000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from imcomp.qimtools.difference_engine import jpeg_header, read_resized, reduced_scale
+
+
+def create_images(folder, nb_images, width, height):
+    """ Write nb_images smooth color JPEG images with some noise """
+    rng = np.random.default_rng(0)
+    filenames = []
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    for n in range(nb_images):
+        image = np.empty((height, width, 3), dtype=np.float32)
+        for c in range(3):
+            image[..., c] = 127 + 100*np.sin((c+1)*6*x + (n+1)*4*y)
+        image += rng.normal(0, 8, image.shape).astype(np.float32)
+        filename = os.path.join(folder, f'image{n}.jpg')
+        cv2.imwrite(filename, np.clip(image, 0, 255).astype(np.uint8))
+        filenames.append(filename)
+    return filenames
+
+
+def timed(func, filenames, *args):
+    start = time.perf_counter()
+    res = [func(filename, *args) for filename in filenames]
+    return res, (time.perf_counter() - start)/len(filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', nargs='+', default=[], help="JPEG images to decode")
+    parser.add_argument('--width', type=int, default=1000, help="target width of the comparison")
+    parser.add_argument('--nb_images', type=int, default=4, help="synthetic images: number of images")
+    parser.add_argument('--size', type=int, nargs=2, default=[6000, 4000], help="synthetic images: width height")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs, the best time is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filenames = args.images or create_images(tmp_dir, args.nb_images, *args.size)
+        full_times, reduced_times = [], []
+        for _ in range(args.repeat):
+            full, t = timed(read_resized, filenames, args.width, False)
+            full_times.append(t)
+            reduced, t = timed(read_resized, filenames, args.width, True)
+            reduced_times.append(t)
+
+        scales = [reduced_scale(jpeg_header(f)[0], args.width) if jpeg_header(f) else 1 for f in filenames]
+        error = np.mean([cv2.mean(cv2.absdiff(a, b))[0] for a, b in zip(full, reduced)])
+        t_full, t_reduced = min(full_times), min(reduced_times)
+        print(f"{len(filenames)} images, target width {args.width}, decode scales {sorted(set(scales))}")
+        print(f"  full decode + resize    : {t_full*1000:8.1f} ms/image")
+        print(f"  reduced decode + resize : {t_reduced*1000:8.1f} ms/image  (x{t_full/max(t_reduced, 1e-9):.2f})")
+        print(f"  mean abs difference of the resized images: {error:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
 from .version import __version__
 
-from .imcomp_window import ImCompWindow
-from .imcomp_table  import ImCompTable
-
 __all__ = ['__version__', 'ImCompWindow']
+
+
+def __getattr__(name):
+    # the Qt classes are imported on first use, so that the headless imcomp-batch does not load Qt
+    if name == 'ImCompWindow':
+        from .imcomp_window import ImCompWindow
+        return ImCompWindow
+    if name == 'ImCompTable':
+        from .imcomp_table import ImCompTable
+        return ImCompTable
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,131 @@
+"""
+Cached basename -> paths index of the files and folders below a root directory
+
+Used by fill_table_data.find_file() to locate the images of a report that moved, and by
+fill_table_data.adapt_path() to locate its image set folders, without walking the root directory for each
+lookup: the index is built on the first lookup and shared by the next ones. When a name is not found,
+refresh() walks the tree again but only lists the directories whose modification time changed, at most
+once every min_refresh_interval seconds.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class BasenameIndex:
+    """
+        basename -> list of paths, for the files and the folders below root
+    """
+    # minimal time in seconds between two refreshes triggered by names not found
+    min_refresh_interval = 2.
+
+    def __init__(self, root: str, max_depth: Optional[int] = None):
+        '''
+        :param root: indexed directory
+        :param max_depth: depth of the indexed folders below root, None for the whole tree
+        '''
+        self.root = root
+        self.max_depth = max_depth
+        # rel_dir -> [mtime_ns, subdir names, file names]
+        self._dirs: Dict[str, list] = dict()
+        self._files: Optional[Dict[str, List[str]]] = None
+        self._folders: Dict[str, List[str]] = dict()
+        self._refresh_time = 0.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _list_dir(path: str) -> Tuple[List[str], List[str]]:
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        # same as os.walk(): do not follow symbolic links to directories
+                        if entry.is_dir() and not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return subdirs, files
+
+    def refresh(self) -> int:
+        """
+        Walk the tree, listing again only the directories whose modification time changed
+        :return: number of listed directories
+        """
+        nb_listed = 0
+        new_dirs, depths = dict(), dict()
+        stack = [('', 0)]
+        while stack:
+            rel_dir, depth = stack.pop()
+            path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self._dirs.get(rel_dir)
+            if entry is None or entry[0] != mtime_ns:
+                entry = [mtime_ns, *self._list_dir(path)]
+                nb_listed += 1
+            new_dirs[rel_dir] = entry
+            depths[rel_dir] = depth
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+            # reversed to keep the os.walk() top-down order in the index
+            for name in reversed(entry[1]):
+                stack.append((os.path.join(rel_dir, name) if rel_dir else name, depth+1))
+
+        files, folders = dict(), dict()
+        for rel_dir, (_, subdirs, filenames) in new_dirs.items():
+            path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+            for name in filenames:
+                files.setdefault(name, []).append(os.path.join(path, name))
+            if self.max_depth is None or depths[rel_dir] < self.max_depth:
+                for name in subdirs:
+                    folders.setdefault(name, []).append(os.path.join(path, name))
+        self._dirs, self._files, self._folders = new_dirs, files, folders
+        self._refresh_time = time.monotonic()
+        return nb_listed
+
+    def _lookup(self, basename: str, folders: bool, check) -> List[str]:
+        with self._lock:
+            if self._files is None:
+                start = time.monotonic()
+                nb_listed = self.refresh()
+                print(f"Indexed {nb_listed} directories of {self.root} in {time.monotonic()-start:0.3f} sec.")
+            index = self._folders if folders else self._files
+            paths = [path for path in index.get(basename, []) if check(path)]
+            if not paths and time.monotonic()-self._refresh_time >= self.min_refresh_interval:
+                # the name may have been created after the last refresh
+                self.refresh()
+                index = self._folders if folders else self._files
+                paths = [path for path in index.get(basename, []) if check(path)]
+            return paths
+
+    def find_file(self, basename: str) -> Optional[str]:
+        """ First file named basename below root, in os.walk() order """
+        paths = self._lookup(basename, False, os.path.isfile)
+        return paths[0] if paths else None
+
+    def find_directories(self, basename: str) -> List[str]:
+        """ Folders named basename below root, in os.walk() order """
+        return self._lookup(basename, True, os.path.isdir)
+
+
+_indexes: Dict[Tuple[str, Optional[int]], BasenameIndex] = dict()
+_indexes_lock = threading.Lock()
+
+
+def get_basename_index(root: str, max_depth: Optional[int] = None) -> BasenameIndex:
+    """ Shared BasenameIndex instance of the root directory """
+    key = (os.path.abspath(root), max_depth)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = BasenameIndex(root, max_depth)
+        return index
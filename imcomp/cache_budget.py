@@ -0,0 +1,149 @@
+"""
+Adaptive budgets of the file and image caches
+
+The cache sizes selected in the cache menu are upper bounds. The CacheBudgetController samples the
+available memory and the process RSS, and sets the budgets so that the caches can grow as long as a
+reserve of memory stays available to the other processes. Under memory pressure the file cache is
+reduced first, since its files are read again at a small cost, then the image cache. Before a cache is
+reduced, the images displayed in the viewers are moved to the end of its eviction order.
+"""
+
+import os
+from contextlib import nullcontext
+from typing import Iterable, List, Optional
+
+import psutil
+
+
+class CacheBudget:
+    """ Budget of a cache, in Mb """
+    def __init__(self, name: str, cache):
+        self.name = name
+        self.cache = cache
+        # bounds of the budget, the upper bound is the size selected in the cache menu
+        self.min_size = 0
+        self.max_size = 0
+        self.enabled = True
+
+    @property
+    def size(self) -> int:
+        return self.cache.max_cache_size
+
+    @property
+    def used(self) -> int:
+        return int(self.cache.cache_size/self.cache.cache_unit+0.5)
+
+
+class CacheBudgetController:
+    """
+        Shrink or grow the cache budgets within their bounds, from the memory available
+    """
+    def __init__(self, reserve_ratio: float = 0.1, min_ratio: float = 0.25, step: int = 64):
+        '''
+        :param reserve_ratio: part of the total memory to keep available
+        :param min_ratio: lower bound of each budget, as a part of its upper bound
+        :param step: smallest change of a budget in Mb, smaller changes are ignored unless memory is missing
+        '''
+        self.reserve_ratio = reserve_ratio
+        self.min_ratio = min_ratio
+        self.step = step
+        self.enabled = True
+        # in priority order: the last budgets are reduced first and increased last
+        self.budgets: List[CacheBudget] = []
+        self.available = 0
+        self.rss = 0
+        self.total = 0
+
+    def add_cache(self, name: str, cache, max_size: int) -> CacheBudget:
+        budget = CacheBudget(name, cache)
+        self.budgets.append(budget)
+        self.set_bounds(budget, max_size)
+        return budget
+
+    def set_bounds(self, budget: CacheBudget, max_size: int) -> None:
+        ''' Set the upper bound of a budget, the budget follows it when the controller is disabled '''
+        budget.max_size = max_size
+        budget.min_size = max(1, int(self.min_ratio*max_size))
+        if not self.enabled:
+            budget.cache.set_max_cache_size(max_size)
+        elif budget.size > max_size or budget.size < budget.min_size:
+            budget.cache.set_max_cache_size(min(max(budget.size, budget.min_size), max_size))
+
+    def set_enabled(self, enabled: bool) -> None:
+        ''' When disabled, the budgets are set to their upper bounds '''
+        self.enabled = enabled
+        if not enabled:
+            for budget in self.budgets:
+                budget.cache.set_max_cache_size(budget.max_size)
+
+    def sample(self) -> None:
+        ''' Memory available and process RSS, in Mb '''
+        memory = psutil.virtual_memory()
+        unit = 1024*1024
+        self.total = memory.total//unit
+        self.available = memory.available//unit
+        self.rss = psutil.Process().memory_info().rss//unit
+
+    def targets(self) -> List[int]:
+        '''
+        Budgets such that the memory available stays above the reserve, each budget within its bounds:
+        the memory missing is taken from the last caches first, the memory left is given to the first caches
+        '''
+        budgets = [b for b in self.budgets if b.enabled]
+        headroom = self.available - int(self.reserve_ratio*self.total)
+        total = sum(b.used for b in budgets) + headroom
+        targets = []
+        for n, budget in enumerate(budgets):
+            left = total - sum(b.min_size for b in budgets[n+1:])
+            targets.append(min(max(left, budget.min_size), budget.max_size))
+            total -= targets[-1]
+        return targets
+
+    def update(self, protected: Iterable[str] = ()) -> bool:
+        '''
+        Sample the memory and apply the budgets, from the GUI thread
+        :param protected: filenames of the images displayed, evicted last
+        :return: True if a budget has changed
+        '''
+        self.sample()
+        if not self.enabled:
+            return False
+        protected = list(protected)
+        changed = False
+        budgets = [b for b in self.budgets if b.enabled]
+        for budget, target in zip(budgets, self.targets()):
+            if target == budget.size:
+                continue
+            if target >= budget.used and abs(target-budget.size) < self.step \
+                    and target not in (budget.min_size, budget.max_size):
+                continue
+            if target < budget.used:
+                self._move_to_end(budget.cache, protected)
+            budget.cache.set_max_cache_size(target)
+            changed = True
+        return changed
+
+    @staticmethod
+    def _move_to_end(cache, filenames: Iterable[str]) -> None:
+        ''' Move the entries of the files to the end of the cache, which evicts its first entries '''
+        # the caches of the window are changed under their lock, see cache_stats.LockedCache
+        with getattr(cache, 'lock', None) or nullcontext():
+            for filename in filenames:
+                if not filename:
+                    continue
+                entry = cache.search(os.path.abspath(filename))
+                if entry is not None and cache.remove(entry[0]):
+                    cache.append(*entry, check_size=False)
+
+    def tooltip(self, budget: Optional[CacheBudget]) -> str:
+        if budget is None or not budget.enabled:
+            return "Disabled"
+        text = f"{budget.name}: {budget.used}/{budget.size} Mb"
+        if self.enabled:
+            text += f"\nadaptive budget within {budget.min_size}-{budget.max_size} Mb"
+        else:
+            text += "\nfixed budget"
+        if self.total:
+            text += f"\nmemory available {self.available}/{self.total} Mb, " \
+                    f"reserve {int(self.reserve_ratio*self.total)} Mb\nimcomp RSS {self.rss} Mb"
+        return text
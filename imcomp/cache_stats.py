@@ -0,0 +1,375 @@
+"""
+Instrumentation of the image caches and of the row display
+
+SessionStats counts the hits, misses and evictions of the FileCache and of the ImageCache, and keeps
+latency histograms of the file reads, of the image decoding and of the time from a row selection to its
+display. The reads of the RowPrefetcher are counted apart, so that the image cache hits reflect the
+navigation. The caches of the main window are the instrumented subclasses below, the ImageCache can also
+share its images with other processes (see shared_cache.py). The statistics are shown in the status bar
+and in a dialog of the cache menu, and can be exported to JSON to analyse a session.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict
+
+from qimview.utils.qt_imports import QtWidgets, QtGui
+from qimview.utils.utils import get_time
+from qimview.utils.viewer_image import ViewerImage, ImageFormat
+from qimview.cache import ImageCache, FileCache
+
+
+class LatencyHistogram:
+    """
+        Latencies counted in buckets of increasing width
+    """
+    # upper bounds of the buckets in ms, the last bucket has no upper bound
+    edges = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.buckets = [0]*(len(self.edges)+1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds: float) -> None:
+        ms = seconds*1000
+        self.buckets[bisect_left(self.edges, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p: float) -> float:
+        ''' Upper bound in ms of the bucket of the p percentile, the maximum for the last bucket '''
+        if self.count == 0:
+            return 0.
+        rank = p*self.count/100
+        seen = 0
+        for edge, n in zip(self.edges, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        labels = [f'<{e}ms' for e in self.edges] + [f'>={self.edges[-1]}ms']
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total/self.count, 3) if self.count else 0,
+            'p50_ms': round(self.percentile(50), 3),
+            'p95_ms': round(self.percentile(95), 3),
+            'max_ms': round(self.max, 3),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+    def summary(self) -> str:
+        if self.count == 0:
+            return "-"
+        return f"{self.count:6d}  mean {self.total/self.count:7.1f} ms  p50 {self.percentile(50):6.0f} ms  " \
+               f"p95 {self.percentile(95):6.0f} ms  max {self.max:7.0f} ms"
+
+
+class CacheCounters:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits+self.misses
+        return self.hits/total if total else 0.
+
+    def to_dict(self) -> Dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': round(self.hit_ratio(), 4)}
+
+    def summary(self) -> str:
+        return f"{self.hits:6d} hits  {self.misses:6d} misses  {self.evictions:6d} evictions  " \
+               f"hit ratio {self.hit_ratio()*100:5.1f}%"
+
+
+class SessionStats:
+    """
+        Cache counters and latency histograms of a session, updated from any thread
+    """
+    # 'prefetch' counts the image cache reads of the RowPrefetcher, 'image cache' the other reads
+    cache_names = ('file cache', 'image cache', 'prefetch', 'shared cache')
+    latency_names = ('file read', 'decode', 'row display')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # file read time of the current image decoding, per thread
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.start = time.time()
+            self.caches = {name: CacheCounters() for name in self.cache_names}
+            self.latencies = {name: LatencyHistogram() for name in self.latency_names}
+
+    def count(self, cache_name: str, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.caches[cache_name].hits += 1
+            else:
+                self.caches[cache_name].misses += 1
+
+    def evicted(self, cache_name: str, nb: int) -> None:
+        if nb > 0:
+            with self._lock:
+                self.caches[cache_name].evictions += nb
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies[name].add(seconds)
+
+    def add_read_time(self, seconds: float) -> None:
+        self._local.read_time = getattr(self._local, 'read_time', 0.)+seconds
+
+    def set_prefetching(self, prefetching: bool) -> None:
+        ''' Count the image cache reads of the current thread as prefetch reads '''
+        self._local.prefetching = prefetching
+
+    def image_cache_name(self) -> str:
+        ''' Counters of the image cache reads of the current thread '''
+        return 'prefetch' if getattr(self._local, 'prefetching', False) else 'image cache'
+
+    def take_read_time(self) -> float:
+        ''' File read time of the current thread since the last call '''
+        read_time = getattr(self._local, 'read_time', 0.)
+        self._local.read_time = 0.
+        return read_time
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+                'duration_s': round(time.time()-self.start, 1),
+                'caches': {name: counters.to_dict() for name, counters in self.caches.items()},
+                'latencies': {name: histogram.to_dict() for name, histogram in self.latencies.items()},
+            }
+
+    def write_json(self, filename: str) -> None:
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = [f"Session started {time.strftime('%H:%M:%S', time.localtime(self.start))}", ""]
+            lines += [f"{name:12s} {counters.summary()}" for name, counters in self.caches.items()]
+            lines.append("")
+            lines += [f"{name:12s} {histogram.summary()}" for name, histogram in self.latencies.items()]
+        return "\n".join(lines)
+
+    def status(self) -> str:
+        ''' Short text for the status bar '''
+        with self._lock:
+            image_cache = self.caches['image cache']
+            display = self.latencies['row display']
+            text = f"hits {image_cache.hit_ratio()*100:.0f}%"
+            if display.count:
+                text += f" | display p50 {display.percentile(50):.0f} ms"
+        return text
+
+
+class LockedCache:
+    """
+        Entries of a cache changed under one lock: the prefetch, file loading and thumbnail threads add entries
+        while the GUI thread applies the budgets.
+        The files being read are tracked, a file requested while another thread reads it is taken from the
+        cache once read, instead of being read twice.
+    """
+    def init_lock(self) -> None:
+        self.lock = threading.RLock()
+        # absolute path -> event set when the file has been read
+        self._reading: Dict[str, threading.Event] = dict()
+
+    def search(self, id):
+        with self.lock:
+            return super().search(id)
+
+    def append(self, id, value, extra, check_size=True):
+        with self.lock:
+            super().append(id, value, extra, check_size)
+
+    def remove(self, id):
+        with self.lock:
+            return super().remove(id)
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+
+    def check_size_limit(self, update_progress=False):
+        with self.lock:
+            super().check_size_limit(update_progress)
+
+    def drop_outdated(self, filename: str) -> None:
+        ''' Remove the entry of a file modified since it was cached, the base classes do it without the lock '''
+        with self.lock:
+            entry = self.search(filename)
+            if entry is None:
+                return
+            try:
+                outdated = entry[2] < os.path.getmtime(filename)
+            except OSError:
+                return
+            if outdated:
+                self.remove(filename)
+
+    def read_once(self, filename: str, read: Callable):
+        '''
+        Call read() once no other thread reads the file, it then finds the file in the cache
+        :param filename: absolute path of the file
+        '''
+        while True:
+            with self.lock:
+                reading = self._reading.get(filename)
+                if reading is None:
+                    reading = self._reading[filename] = threading.Event()
+                    break
+            reading.wait()
+        try:
+            self.drop_outdated(filename)
+            return read()
+        finally:
+            with self.lock:
+                del self._reading[filename]
+            reading.set()
+
+
+class InstrumentedFileCache(LockedCache, FileCache):
+    """
+        FileCache that records its hits, misses, evictions and file reads in a SessionStats
+    """
+    def __init__(self, stats: SessionStats):
+        FileCache.__init__(self)
+        self.init_lock()
+        self.stats = stats
+
+    def get_file(self, filename, check_size=True):
+        return self.read_once(os.path.abspath(filename), lambda: self._get_file(filename, check_size))
+
+    def _get_file(self, filename, check_size):
+        start = get_time()
+        data, from_cache = FileCache.get_file(self, filename, check_size)
+        self.stats.count('file cache', from_cache)
+        if data is not None and not from_cache:
+            read_time = get_time()-start
+            self.stats.record('file read', read_time)
+            self.stats.add_read_time(read_time)
+        return data, from_cache
+
+    def check_size_limit(self, update_progress=False):
+        with self.lock:
+            nb = len(self.cache_list)
+            super().check_size_limit(update_progress)
+            self.stats.evicted('file cache', nb-len(self.cache_list))
+
+
+class InstrumentedImageCache(LockedCache, ImageCache):
+    """
+        ImageCache that records its hits, misses, evictions and image decoding in a SessionStats,
+        the decoding time excludes the reads from the FileCache.
+        When a SharedImageStore is set, the images missing in the cache are first taken from the store,
+        and the decoded images are added to it.
+    """
+    def __init__(self, stats: SessionStats):
+        ImageCache.__init__(self)
+        self.init_lock()
+        self.stats = stats
+        # SharedImageStore set by the main window
+        self.shared = None
+
+    def get_image(self, filename, read_size='full', verbose=False, use_RGB=True, image_transform=None,
+                  check_size=True):
+        return self.read_once(os.path.abspath(filename),
+                              lambda: self._get_image(filename, read_size, verbose, use_RGB, image_transform,
+                                                      check_size))
+
+    def _get_image(self, filename, read_size, verbose, use_RGB, image_transform, check_size):
+        self.stats.take_read_time()
+        start = get_time()
+        shared = self.shared if image_transform is None else None
+        key = None
+        if shared is not None and not self.has_image(filename):
+            key = shared.key(filename, f'{read_size}|{use_RGB}')
+            image = self.shared_image(key)
+            self.stats.count('shared cache', image is not None)
+            if image is not None:
+                self.stats.count(self.stats.image_cache_name(), False)
+                self.append(os.path.abspath(filename), image, extra=os.path.getmtime(filename),
+                            check_size=check_size)
+                return image, True
+        image, from_cache = ImageCache.get_image(self, filename, read_size, verbose, use_RGB, image_transform,
+                                                 check_size)
+        self.stats.count(self.stats.image_cache_name(), from_cache)
+        if image is not None and not from_cache:
+            self.stats.record('decode', get_time()-start-self.stats.take_read_time())
+            if key is not None:
+                self.share_image(key, image)
+        return image, from_cache
+
+    def shared_image(self, key):
+        ''' ViewerImage copied from the shared store, None if not found '''
+        if key is None:
+            return None
+        res = self.shared.get(key)
+        if res is None:
+            return None
+        array, image_format = res
+        return ViewerImage(array, precision=image_format['precision'], downscale=image_format['downscale'],
+                           channels=ImageFormat(image_format['channels']))
+
+    def share_image(self, key, image) -> None:
+        # the images with separate chroma planes are not shared
+        if image.u is None and image.uv is None:
+            self.shared.put(key, image.data, image.precision, image.downscale, int(image.channels))
+
+    def check_size_limit(self, update_progress=False):
+        with self.lock:
+            nb = len(self.cache_list)
+            super().check_size_limit(update_progress)
+            self.stats.evicted('image cache', nb-len(self.cache_list))
+
+
+class CacheStatsDialog(QtWidgets.QDialog):
+    """
+        Statistics of the session, refreshed by the main window
+    """
+    def __init__(self, stats: SessionStats, parent=None):
+        QtWidgets.QDialog.__init__(self, parent)
+        self.stats = stats
+        self.setWindowTitle("Cache statistics")
+        self.text = QtWidgets.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.text.setMinimumWidth(700)
+        buttons = QtWidgets.QHBoxLayout()
+        for label, callback in (('Reset', self.reset), ('Export JSON', self.export_json), ('Close', self.close)):
+            button = QtWidgets.QPushButton(label)
+            button.clicked.connect(callback)
+            buttons.addWidget(button)
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.text)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.text.setPlainText(self.stats.summary())
+
+    def reset(self) -> None:
+        self.stats.reset()
+        self.refresh()
+
+    def export_json(self) -> None:
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export cache statistics',
+                                                            'imcomp_stats.json', "JSON (*.json)")
+        if filename:
+            self.stats.write_json(filename)
+            print(f"Cache statistics written to {filename}")
@@ -0,0 +1,110 @@
+"""
+Colormap lookup tables for the table cell backgrounds
+
+Each colormap is a (size, 3) uint8 RGB table built by linear interpolation of a few control colors,
+so that matplotlib is not needed. A whole column of values is converted to table indices in one NumPy
+pass, the table views then only map the indices to precomputed brushes.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# control points (position, (r, g, b)) with components in [0, 1]
+_JET = {
+    'r': ([0, 0.35, 0.66, 0.89, 1], [0, 0, 1, 1, 0.5]),
+    'g': ([0, 0.125, 0.375, 0.64, 0.91, 1], [0, 0, 1, 1, 0, 0]),
+    'b': ([0, 0.11, 0.34, 0.65, 1], [0.5, 1, 1, 0, 0]),
+}
+
+_VIRIDIS = ['#440154', '#482475', '#414487', '#355f8d', '#2a788e', '#21918c',
+            '#22a884', '#44bf70', '#7ad151', '#bddf26', '#fde725']
+
+# blue - light gray - red, close to the 'coolwarm' diverging map
+_DIVERGING = ['#3b4cc0', '#8db0fe', '#dddddd', '#f49a7b', '#b40426']
+
+
+def _hex_stops(colors: List[str]) -> Dict[str, Tuple[List[float], List[float]]]:
+    positions = list(np.linspace(0, 1, len(colors)))
+    rgb = [[int(c[pos:pos+2], 16)/255 for pos in (1, 3, 5)] for c in colors]
+    return {channel: (positions, [c[n] for c in rgb]) for n, channel in enumerate('rgb')}
+
+
+class Colormap:
+    """
+        Lookup table of size RGB colors
+    """
+    def __init__(self, name: str, stops: Dict[str, Tuple[List[float], List[float]]], size: int = 256,
+                 center: Optional[float] = None):
+        '''
+        :param name: colormap name
+        :param stops: for each channel 'r', 'g', 'b', the control positions and values in [0, 1]
+        :param size: number of colors of the table
+        :param center: for diverging colormaps, value mapped to the middle color when the range contains it
+        '''
+        self.name = name
+        self.size = size
+        self.center = center
+        x = np.linspace(0, 1, size)
+        self.lut = np.stack([np.interp(x, *stops[channel]) for channel in 'rgb'], axis=1)
+        self.lut = np.round(self.lut*255).astype(np.uint8)
+
+    def value_range(self, values: np.ndarray, vmin: Optional[float] = None,
+                    vmax: Optional[float] = None) -> Optional[Tuple[float, float]]:
+        ''' Normalization range, None if there are no valid values or if all values are equal '''
+        if vmin is None or vmax is None:
+            valid = values[~np.isnan(values)]
+            if valid.size == 0:
+                return None
+            vmin = valid.min() if vmin is None else vmin
+            vmax = valid.max() if vmax is None else vmax
+        if self.center is not None and vmin < self.center < vmax:
+            half = max(self.center-vmin, vmax-self.center)
+            vmin, vmax = self.center-half, self.center+half
+        if vmin == vmax:
+            return None
+        return float(vmin), float(vmax)
+
+    def indices(self, values: np.ndarray, vmin: Optional[float] = None,
+                vmax: Optional[float] = None) -> Optional[np.ndarray]:
+        '''
+        Table index of each value
+        :param values: float array, NaN for missing values
+        :param vmin: value of the first color, minimum of values by default
+        :param vmax: value of the last color, maximum of values by default
+        :return: int16 array with -1 for missing values, or None if there is nothing to color
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        value_range = self.value_range(values, vmin, vmax)
+        if value_range is None:
+            return None
+        vmin, vmax = value_range
+        valid = ~np.isnan(values)
+        res = np.full(values.shape, -1, dtype=np.int16)
+        res[valid] = np.clip((values[valid]-vmin)/(vmax-vmin)*self.size, 0, self.size-1).astype(np.int16)
+        return res
+
+    def colors(self, values: np.ndarray, vmin: Optional[float] = None,
+               vmax: Optional[float] = None) -> Optional[np.ndarray]:
+        ''' (N, 3) uint8 colors of the values, NaN values get the first color '''
+        indices = self.indices(values, vmin, vmax)
+        if indices is None:
+            return None
+        return self.lut[np.maximum(indices, 0)]
+
+
+COLORMAPS = {
+    'jet':       Colormap('jet', _JET),
+    'viridis':   Colormap('viridis', _hex_stops(_VIRIDIS)),
+    'diverging': Colormap('diverging', _hex_stops(_DIVERGING), center=0.0),
+}
+
+
+def colormap_names() -> List[str]:
+    return list(COLORMAPS.keys())
+
+
+def get_colormap(name: str) -> Colormap:
+    ''' Colormap from its name, jet for unknown names '''
+    return COLORMAPS.get(name, COLORMAPS['jet'])
@@ -0,0 +1,386 @@
+"""
+Columnar storage of the table contents
+
+Rows are stored as records in insertion order and identified by their row id (unique name).
+Numeric columns are NumPy int64 or float64 arrays with a mask of the cells that have a value, text
+columns are NumPy object arrays with None for empty cells. The display order of the rows is handled by the views.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class NumericColumn:
+    """
+        int64 or float64 values with a mask of the cells that have a value
+        Count, NaN count, sum, min and max are updated on each write, overwriting or clearing a value
+        only marks them for a full update on the next stats() call. Percentiles are computed on demand
+        and cached until the next modification.
+    """
+    kind = 'numeric'
+
+    def __init__(self, capacity: int, dtype=np.float64, float_format: str = '%.5f'):
+        self.dtype = np.dtype(dtype)
+        self.values = np.zeros(capacity, dtype=self.dtype)
+        self.mask = np.zeros(capacity, dtype=bool)
+        self.float_format = float_format
+        # incremented on each modification
+        self.version = 0
+        self._reset_stats()
+        self._stats_valid = True
+        # q -> (version, value)
+        self._percentiles: Dict[float, Tuple[int, float]] = dict()
+
+    def _reset_stats(self) -> None:
+        self._count = 0
+        self._nan_count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def resize(self, capacity: int) -> None:
+        values = np.zeros(capacity, dtype=self.dtype)
+        mask = np.zeros(capacity, dtype=bool)
+        size = min(capacity, len(self.values))
+        values[:size] = self.values[:size]
+        mask[:size] = self.mask[:size]
+        self.values, self.mask = values, mask
+
+    def to_float(self) -> None:
+        """ Convert an int64 column to float64 """
+        if self.dtype != np.float64:
+            self.dtype = np.dtype(np.float64)
+            self.values = self.values.astype(np.float64)
+            if self.float_format == '%d':
+                self.float_format = '%.5f'
+
+    def set(self, record: int, value) -> None:
+        if self.mask[record]:
+            # the previous value may have been the min or the max
+            self._stats_valid = False
+        self.values[record] = value
+        self.mask[record] = True
+        self.version += 1
+        if self._stats_valid:
+            if value != value:
+                self._nan_count += 1
+            else:
+                self._count += 1
+                self._sum += value
+                self._min = value if self._min is None else min(self._min, value)
+                self._max = value if self._max is None else max(self._max, value)
+
+    def is_empty(self, record: int) -> bool:
+        return not self.mask[record]
+
+    def value(self, record: int):
+        if not self.mask[record]:
+            return None
+        return self.values[record].item()
+
+    def text(self, record: int) -> str:
+        if not self.mask[record]:
+            return ''
+        return self.float_format % self.values[record]
+
+    def clear(self, record: int) -> None:
+        if self.mask[record]:
+            self.mask[record] = False
+            self.values[record] = 0
+            self._stats_valid = False
+            self.version += 1
+
+    def as_float(self, size: int) -> np.ndarray:
+        """ float64 values of the first size records, NaN for the cells without value """
+        values = self.values[:size].astype(np.float64)
+        values[~self.mask[:size]] = np.nan
+        return values
+
+    def stats(self) -> Dict[str, Any]:
+        """ Dictionary with count, nan_count, min, max and mean of the column values """
+        if not self._stats_valid:
+            self._reset_stats()
+            values = self.values[self.mask]
+            if self.dtype == np.float64:
+                nan = np.isnan(values)
+                self._nan_count = int(nan.sum())
+                values = values[~nan]
+            if values.size:
+                self._count = int(values.size)
+                self._sum = float(values.sum())
+                self._min = values.min().item()
+                self._max = values.max().item()
+            self._stats_valid = True
+        return {'count': self._count, 'nan_count': self._nan_count,
+                'min': self._min, 'max': self._max,
+                'mean': self._sum/self._count if self._count else None}
+
+    def percentile(self, q: float) -> Optional[float]:
+        """ q-th percentile of the values (NaN excluded), cached until the column is modified """
+        cached = self._percentiles.get(q)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        values = self.values[self.mask].astype(np.float64)
+        values = values[~np.isnan(values)]
+        res = float(np.percentile(values, q)) if values.size else None
+        self._percentiles[q] = (self.version, res)
+        return res
+
+
+class TextColumn:
+    """ Python strings in an object array, None for empty cells """
+    kind = 'text'
+
+    def __init__(self, capacity: int):
+        self.values = np.full(capacity, None, dtype=object)
+        # incremented on each modification
+        self.version = 0
+
+    def resize(self, capacity: int) -> None:
+        values = np.full(capacity, None, dtype=object)
+        size = min(capacity, len(self.values))
+        values[:size] = self.values[:size]
+        self.values = values
+
+    def set(self, record: int, value: str) -> None:
+        self.values[record] = value
+        self.version += 1
+
+    def is_empty(self, record: int) -> bool:
+        return not self.values[record]
+
+    def value(self, record: int) -> Optional[str]:
+        return self.values[record]
+
+    def text(self, record: int) -> str:
+        v = self.values[record]
+        return '' if v is None else v
+
+    def clear(self, record: int) -> None:
+        self.values[record] = None
+        self.version += 1
+
+
+Column = Union[NumericColumn, TextColumn]
+
+
+class ColumnStore:
+    """
+        Table contents stored by column, rows are records identified by their row id
+    """
+    def __init__(self, capacity: int = 1024, row_id_name: str = 'Unique Name'):
+        '''
+        :param capacity: initial number of records
+        :param row_id_name: name of the read-only column that contains the row ids
+        '''
+        self.row_id_name = row_id_name
+        self._capacity = max(1, capacity)
+        self.size = 0
+        self.row_ids = np.full(self._capacity, None, dtype=object)
+        # row_id -> record
+        self.index: Dict[str, int] = dict()
+        self.columns: Dict[str, Column] = dict()
+        # sort keys -> (column versions, sorted records)
+        self._sort_cache: Dict[tuple, Tuple[tuple, np.ndarray]] = dict()
+
+    def _reserve(self, size: int) -> None:
+        if size <= self._capacity:
+            return
+        while self._capacity < size:
+            self._capacity *= 2
+        row_ids = np.full(self._capacity, None, dtype=object)
+        row_ids[:self.size] = self.row_ids[:self.size]
+        self.row_ids = row_ids
+        for column in self.columns.values():
+            column.resize(self._capacity)
+
+    def add_rows(self, row_ids: List[str]) -> range:
+        """ Add empty records, returns the range of new records """
+        start = self.size
+        self._reserve(start + len(row_ids))
+        for pos, row_id in enumerate(row_ids):
+            self.row_ids[start+pos] = row_id
+            self.index[row_id] = start+pos
+        self.size += len(row_ids)
+        return range(start, self.size)
+
+    def record(self, row_id: str) -> Optional[int]:
+        return self.index.get(row_id)
+
+    def column(self, name: str) -> Optional[Column]:
+        return self.columns.get(name)
+
+    def _text_column(self, name: str) -> TextColumn:
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = TextColumn(self._capacity)
+        elif column.kind != 'text':
+            # mixed contents: keep the formatted numbers as text
+            text_column = TextColumn(self._capacity)
+            for record in range(self.size):
+                if not column.is_empty(record):
+                    text_column.set(record, column.text(record))
+            column = self.columns[name] = text_column
+        return column
+
+    def set_number(self, record: int, name: str, value, float_format: str = '%.5f') -> None:
+        '''
+        Write a number, the column is created as int64 for integer values, and converted to float64
+        when a float value is written to it
+        '''
+        is_int = isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+        column = self.columns.get(name)
+        if column is None:
+            dtype = np.int64 if is_int else np.float64
+            column = self.columns[name] = NumericColumn(self._capacity, dtype, float_format)
+        elif column.kind != 'numeric':
+            column.set(record, float_format % value)
+            return
+        if not is_int:
+            column.to_float()
+            column.float_format = float_format
+        elif column.dtype == np.int64:
+            column.float_format = float_format
+        # integers written to a float column keep the column format
+        column.set(record, value)
+
+    def set_text(self, record: int, name: str, text: str) -> None:
+        if text == '':
+            self.clear(record, name)
+            return
+        column = self.columns.get(name)
+        if column is not None and column.kind == 'numeric':
+            try:
+                value = int(text) if column.dtype == np.int64 else float(text)
+            except ValueError:
+                try:
+                    value = float(text)
+                except ValueError:
+                    value = None
+            if value is not None:
+                float_format = column.float_format
+                if isinstance(value, float) and float_format == '%d':
+                    float_format = '%.5f'
+                self.set_number(record, name, value, float_format)
+                return
+        self._text_column(name).set(record, text)
+
+    def fill_numbers(self, records: np.ndarray, name: str, values: np.ndarray, float_format: str) -> np.ndarray:
+        '''
+        Write numbers in the empty cells of a column, in one vectorized pass
+        :param records: int64 array of records
+        :param values: int64 or float64 array, same size as records
+        :return: boolean array, True where the value was written
+        '''
+        column = self.columns.get(name)
+        if column is not None and column.kind != 'numeric':
+            written = np.array([column.is_empty(r) for r in records], dtype=bool)
+            for record, value in zip(records[written], values[written]):
+                column.set(record, float_format % value)
+            return written
+        if column is None:
+            dtype = np.int64 if values.dtype.kind in 'iu' else np.float64
+            column = self.columns[name] = NumericColumn(self._capacity, dtype, float_format)
+        elif values.dtype.kind == 'f':
+            column.to_float()
+            column.float_format = float_format
+        elif column.dtype == np.int64:
+            column.float_format = float_format
+        written = ~column.mask[records]
+        if written.any():
+            target = records[written]
+            column.values[target] = values[written]
+            column.mask[target] = True
+            column._stats_valid = False
+            column.version += 1
+        return written
+
+    def fill_texts(self, records: np.ndarray, name: str, texts: List[str]) -> np.ndarray:
+        '''
+        Write strings in the empty cells of a column
+        :return: boolean array, True where the text was written
+        '''
+        written = np.zeros(len(records), dtype=bool)
+        for pos, (record, text) in enumerate(zip(records, texts)):
+            if self.is_empty(record, name):
+                self.set_text(record, name, text)
+                written[pos] = True
+        return written
+
+    def clear(self, record: int, name: str) -> None:
+        column = self.columns.get(name)
+        if column is not None:
+            column.clear(record)
+
+    def is_empty(self, record: int, name: str) -> bool:
+        column = self.columns.get(name)
+        return column is None or column.is_empty(record)
+
+    def text(self, record: int, name: str) -> str:
+        if name == self.row_id_name:
+            return self.row_ids[record]
+        column = self.columns.get(name)
+        return '' if column is None else column.text(record)
+
+    def numeric_values(self, name: str) -> Optional[np.ndarray]:
+        """ float64 values of a numeric column for all the records (NaN for empty cells), None for text columns """
+        column = self.columns.get(name)
+        if column is None or column.kind != 'numeric':
+            return None
+        return column.as_float(self.size)
+
+    def stats(self, name: str) -> Optional[Dict[str, Any]]:
+        """ Statistics of a numeric column, None for text columns """
+        column = self.columns.get(name)
+        if column is None or column.kind != 'numeric':
+            return None
+        return column.stats()
+
+    def _sort_key(self, name: str, descending: bool) -> List[np.ndarray]:
+        """ lexsort keys of one column, least significant first: value, then missing flag """
+        column = self.columns.get(name)
+        if name == self.row_id_name:
+            texts = self.row_ids[:self.size]
+            _, values = np.unique(texts.astype(str), return_inverse=True)
+            return [-values if descending else values]
+        if column is None:
+            return []
+        if column.kind == 'numeric':
+            values = column.as_float(self.size)
+            missing = np.isnan(values)
+            values = np.where(missing, 0, -values if descending else values)
+        else:
+            texts = column.values[:self.size]
+            missing = np.array([not t for t in texts], dtype=bool)
+            # rank of each string, the comparisons are done once by np.unique
+            _, values = np.unique(np.where(missing, '', texts).astype(str), return_inverse=True)
+            if descending:
+                values = -values
+        return [values, missing]
+
+    def sort_records(self, keys: List[Tuple[str, bool]]) -> np.ndarray:
+        """
+        Records sorted by several columns, the first key being the primary one
+        The sort is stable (ties keep the record order) and empty cells come last in both orders.
+        The result is cached until one of the key columns is modified or rows are added.
+        :param keys: list of (column name, descending)
+        :return: int64 array of records
+        """
+        cache_key = tuple(keys)
+        versions = (self.size,) + tuple((id(self.columns.get(name)), getattr(self.columns.get(name), 'version', -1))
+                                        for name, _ in keys)
+        cached = self._sort_cache.get(cache_key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+        lex_keys = []
+        for name, descending in reversed(keys):
+            lex_keys.extend(self._sort_key(name, descending))
+        if lex_keys:
+            records = np.lexsort(lex_keys).astype(np.int64)
+        else:
+            records = np.arange(self.size, dtype=np.int64)
+        if len(self._sort_cache) >= 16:
+            self._sort_cache.clear()
+        self._sort_cache[cache_key] = (versions, records)
+        return records
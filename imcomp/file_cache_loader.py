@@ -0,0 +1,126 @@
+"""
+Loading of the image files into the FileCache
+
+The files are given in priority order (selected rows, visible rows, then the table order) and read on a
+bounded thread pool. Files already in the cache are skipped, and loading stops before the files would
+exceed the FileCache budget: the cache evicts its oldest entries first, so reading beyond the budget
+would only replace the first files loaded, which are the most useful ones.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional
+
+
+class FileCacheLoader:
+    """
+        Read files into a FileCache from a background thread, the progress is polled from the GUI thread
+    """
+    def __init__(self, file_cache, max_workers: int = 4):
+        '''
+        :param file_cache: FileCache to fill
+        :param max_workers: number of reading threads, at most 2 reads per thread are pending
+        '''
+        self.file_cache = file_cache
+        self.max_workers = max_workers
+        self._thread: Optional[threading.Thread] = None
+        self._cancel = threading.Event()
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_loaded = 0
+        self.budget_reached = False
+        self.skipped = 0
+        self.failed = 0
+
+    def start(self, filenames: List[str]) -> None:
+        '''
+        Start loading, a previous loading is cancelled
+        :param filenames: files in priority order, empty names and duplicates are ignored
+        '''
+        self.cancel()
+        resident = set(self.file_cache.cache_list)
+        filenames = [f for f in dict.fromkeys(filenames) if f]
+        to_load = [f for f in filenames if os.path.abspath(f) not in resident]
+        self.skipped = len(filenames)-len(to_load)
+        self.files_total = len(to_load)
+        self.files_done = 0
+        self.bytes_loaded = 0
+        self.budget_reached = False
+        self.failed = 0
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(to_load,), daemon=True)
+        self._thread.start()
+
+    def cancel(self) -> None:
+        ''' Stop loading, the files being read are finished '''
+        if self._thread is not None:
+            self._cancel.set()
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def progress(self) -> int:
+        return int(self.files_done*100/self.files_total) if self.files_total else 100
+
+    def summary(self) -> str:
+        message = f"{self.files_done}/{self.files_total} files, {self.bytes_loaded/(1024*1024):.0f} Mb loaded"
+        if self.skipped:
+            message += f", {self.skipped} already in cache"
+        if self.failed:
+            message += f", {self.failed} failed"
+        if self.budget_reached:
+            message += ", cache budget reached"
+        if self.cancelled:
+            message += ", cancelled"
+        return message
+
+    def _read(self, filename: str) -> Optional[int]:
+        ''' :return: number of bytes read, None if the file cannot be read '''
+        try:
+            data, _ = self.file_cache.get_file(filename, check_size=False)
+        except OSError as e:
+            # removed or renamed since the loading started
+            print(f"FileCacheLoader failed to read {filename}: {e}")
+            return None
+        return len(data) if data is not None else None
+
+    def _run(self, filenames: List[str]) -> None:
+        # the cache size is updated by check_size_limit(), called from the GUI thread before and after loading
+        budget = self.file_cache.max_cache_size*self.file_cache.cache_unit - self.file_cache.cache_size
+        next_file = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='file_cache') as executor:
+            while True:
+                while not self.cancelled and next_file < len(filenames) and len(pending) < 2*self.max_workers:
+                    try:
+                        size = os.path.getsize(filenames[next_file])
+                    except OSError:
+                        size = 0
+                    if size > budget:
+                        self.budget_reached = True
+                        next_file = len(filenames)
+                        break
+                    budget -= size
+                    pending.add(executor.submit(self._read, filenames[next_file]))
+                    next_file += 1
+                if self.cancelled:
+                    for future in pending:
+                        future.cancel()
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if not future.cancelled():
+                        size = future.result()
+                        if size is None:
+                            self.failed += 1
+                        else:
+                            self.bytes_loaded += size
+                        self.files_done += 1
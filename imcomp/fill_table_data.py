@@ -5,8 +5,11 @@ import os
 import gzip
 import json
 
-from qimview.utils.qt_imports import QtWidgets, QtCore
-import os
+from .image_scanner import scan_images, merge_image_lists
+from .basename_index import get_basename_index
+
+# depth of the folders below root_dir where adapt_path() looks for a moved folder
+ADAPT_PATH_MAX_DEPTH = 4
 
 
 def writeJson(data, filename, compress = False, compressLevel = 9, indent=None):
@@ -37,7 +40,13 @@ def readJson(filename):
 	return data
 
 
-def adapt_path(path):
+def adapt_path(path, root_dir=None):
+	'''
+	Adapt a directory path to the current platform
+	:param path: directory path
+	:param root_dir: if set and the path does not exist, look for the folder below root_dir, its path below
+	root_dir must match the end of the path
+	'''
 	import sys
 	is_windows = sys.platform.startswith('win')
 	if os.path.isdir(path):
@@ -47,6 +56,21 @@ def adapt_path(path):
 		new_path = path.replace('/Public','P:')
 	else:
 		new_path = path.replace('P:','/Public')
+	if root_dir is not None and not os.path.isdir(new_path):
+		# the folder may have moved within root_dir
+		parts = os.path.normpath(new_path.replace('\\',os.sep)).split(os.sep)
+		index = get_basename_index(root_dir, max_depth=ADAPT_PATH_MAX_DEPTH)
+		found_paths = []
+		for found_path in index.find_directories(parts[-1]):
+			rel_parts = os.path.relpath(found_path, root_dir).split(os.sep)
+			if parts[-len(rel_parts):] == rel_parts:
+				found_paths.append((len(rel_parts), found_path))
+		if found_paths:
+			# the folder that matches the longest end of the path
+			found_paths.sort(key=lambda p: -p[0])
+			if len(found_paths) > 1:
+				print(f"Warning: several folders match {path}: {[p for _, p in found_paths]}")
+			return found_paths[0][1]
 	return new_path
 
 
@@ -58,28 +82,32 @@ def find_file(path, filename):
 	if os.path.isfile(filename_path):
 		return filename_path
 	else:
-		# look for basename within path
+		# look for basename within path, the index of path is built once and shared by all the lookups
 		# base_name = os.path.basename(filename)
 		base_name = os.path.basename(filename.replace('\\',os.sep))
-		for root, directories, filenames in os.walk(path):
-			for file in filenames:
-				if os.path.basename(file) == base_name:
-					return os.path.join(root, file)
+		found_path = get_basename_index(path).find_file(base_name)
+		if found_path is not None:
+			return found_path
 		print("Filename {0} not found within {1}".format(filename, path))
 		return filename_path
 
 
-def initTable(imcomp_win, config):
+def image_set_names(config, params):
+	'''
+	Names of the images of a row, without Qt so that the headless batch names its columns as the table
+	:param params: command line parameters, with 'image_sets'
+	:return: tuple (image_list, title_string, default_report_file), image_list starts with the input image
+	'''
 	title_string = ''
 	default_report_file = '_report'
-	image_sets = imcomp_win.get_params()['image_sets']
+	image_sets = params['image_sets']
 	image_list = [config['input']]
 	# TODO: deal with different blendings!
 	previous_basedir = ''
 
 	# check if all image set have the same input directory
-	if imcomp_win.get_params()['directory_list'] is not None:
-		unique_directory = len(imcomp_win.get_params()['directory_list']) <= 1
+	if params['directory_list'] is not None:
+		unique_directory = len(params['directory_list']) <= 1
 	basedir0 = ''
 
 	for per_set_output in config['outputs']:
@@ -111,13 +139,28 @@ def initTable(imcomp_win, config):
 					set_suffix = '_set{}'.format(idx)
 				image_list.append('{0}{1}'.format(per_set_output, set_suffix))
 				previous_basedir = basename_dir
+	return image_list, title_string, default_report_file
+
 
+def config_diff_pairs(config, image_list):
+	'''
+	Difference pairs of the configuration whose images are in image_list
+	:return: list of (diff_name, image1, image2)
+	'''
+	pairs = []
 	if 'diff' in config and len(config['diff'])>0:
 		for pos, diff_pair in enumerate(config['diff']):
 			if diff_pair[0] in image_list and diff_pair[1] in image_list:
 				diff_name = '{}-{}'.format(diff_pair[0],diff_pair[1])
-				image_list.append(diff_name)
-				imcomp_win.setImageComparePair(diff_name, diff_pair[0], diff_pair[1])
+				pairs.append((diff_name, diff_pair[0], diff_pair[1]))
+	return pairs
+
+
+def initTable(imcomp_win, config):
+	image_list, title_string, default_report_file = image_set_names(config, imcomp_win.get_params())
+	for diff_name, image1, image2 in config_diff_pairs(config, image_list):
+		image_list.append(diff_name)
+		imcomp_win.setImageComparePair(diff_name, image1, image2)
 
 	imcomp_win.setWindowTitle('Image Set Comparison '+title_string)
 	imcomp_win.set_default_report_file(default_report_file+'.json')
@@ -130,9 +173,11 @@ def initTable(imcomp_win, config):
 	return image_list
 
 
-def CreateTableFromImages(imcomp_win, jpg_files, config):
-	print("CreateTableFromImages")
-	# find all the flare measure files
+def InitTableData(imcomp_win, config, nb_rows=0):
+	'''
+	Create the table with its columns, and the empty useful_data dictionary shared with the window
+	:return: useful_data dictionary
+	'''
 	useful_data = dict()
 	all_data = dict()
 
@@ -141,27 +186,29 @@ def CreateTableFromImages(imcomp_win, jpg_files, config):
 	# print column_list
 
 	# Create Qt table
-	imcomp_win.create_table_widget(len(jpg_files), len(column_list))
-	image_list = initTable(imcomp_win, config)
+	imcomp_win.create_table_widget(nb_rows, len(column_list))
+	initTable(imcomp_win, config)
 	imcomp_win.table_widget.setColumnList(column_list)
 	imcomp_win.setAllData(all_data)
-	image_sets = imcomp_win.get_params()['image_sets']
 	imcomp_win.table_widget.setWordWrap (True)
+	imcomp_win.setUsefulData(useful_data)
+	imcomp_win.set_table_info()
+	return useful_data
 
-	# Iterate over the data and write it out row by row.
-	# TODO: code here is for 2 image sets generalize to any number of image sets
-	row = 0
-	for elt in jpg_files:
-		col = column_list['Unique Name']['default_pos']
-		unique_name = elt
-		item = QtWidgets.QTableWidgetItem(unique_name)
-		# Center alignment
-		item.setTextAlignment(QtCore.Qt.AlignLeft)
-		# don't allow edit
-		item.setFlags(QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled)
-		# Add item
-		imcomp_win.table_widget.setItem(row, col, item)
 
+def AddTableRows(imcomp_win, rows, config, useful_data):
+	'''
+	Append rows to the table
+	:param rows: list of (unique_name, [filename per image set])
+	:param useful_data: dictionary unique_name -> { image name: filename }, updated with the new rows
+	'''
+	image_list = imcomp_win.image_list
+	image_sets = imcomp_win.get_params()['image_sets']
+	table = imcomp_win.table_widget
+	table.append_rows([unique_name for unique_name, _ in rows])
+
+	# TODO: code here is for 2 image sets generalize to any number of image sets
+	for unique_name, files in rows:
 		# create a row_id using folder_name
 		row_id = unique_name
 		useful_data[row_id] = dict()
@@ -169,8 +216,8 @@ def CreateTableFromImages(imcomp_win, jpg_files, config):
 		# output file names
 		# in the case of flare data, try to guess the original image
 		if config['config_name'] == 'flare':
-			for set_index in range(len(jpg_files[elt])):
-				jpg_file = jpg_files[elt][set_index]
+			for set_index in range(len(files)):
+				jpg_file = files[set_index]
 				original_stitched_filename = os.path.join(os.path.dirname(jpg_file),
 														  os.path.basename(jpg_file))
 				if not os.path.isfile(original_stitched_filename):
@@ -186,12 +233,14 @@ def CreateTableFromImages(imcomp_win, jpg_files, config):
 			useful_data[row_id][image_list[0]] = ""
 
 		for n in range(len(image_sets)):
-			useful_data[row_id][image_list[n+1]] = jpg_files[elt][n]
+			useful_data[row_id][image_list[n+1]] = files[n]
 
-		row += 1
 
-	imcomp_win.setUsefulData(useful_data)
-	imcomp_win.set_table_info()
+def CreateTableFromImages(imcomp_win, jpg_files, config):
+	print("CreateTableFromImages")
+	useful_data = InitTableData(imcomp_win, config)
+	AddTableRows(imcomp_win, list(jpg_files.items()), config, useful_data)
+
 	imcomp_win.show()
 	imcomp_win.raise_()
 	imcomp_win.update_colors()
@@ -199,6 +248,43 @@ def CreateTableFromImages(imcomp_win, jpg_files, config):
 	return imcomp_win
 
 
+def CreateTableFromScanner(imcomp_win, scanner, config, batch_size=1000):
+	'''
+	Create the table and add its rows while the image sets are being scanned, so that the first rows
+	can be reviewed before the end of the scan
+	:param scanner: ImageScanner instance
+	:param batch_size: number of rows added to the table at once
+	'''
+	print("CreateTableFromScanner")
+	useful_data = InitTableData(imcomp_win, config)
+	imcomp_win.show()
+	imcomp_win.raise_()
+
+	from qimview.utils.qt_imports import QtCore
+	app = QtCore.QCoreApplication.instance()
+	status_bar = imcomp_win.statusBar()
+	table = imcomp_win.table_widget
+	for rows in scanner.iter_rows(batch_size):
+		if rows:
+			AddTableRows(imcomp_win, rows, config, useful_data)
+		imcomp_win.setProgress(int(scanner.progress()))
+		status_bar.showMessage(" Scanning image sets: {0} rows, {1}/{2} directories".format(
+			table.rowCount(), scanner.directories_done, scanner.directories_found))
+		app.processEvents()
+	imcomp_win.setProgress(0)
+	# same files and row order as a scan followed by CreateTableFromImages()
+	image_list = imcomp_win.image_list
+	for unique_name, files in scanner.updated_rows.items():
+		for n, filename in enumerate(files):
+			useful_data[unique_name][image_list[n+1]] = filename
+	table.set_row_order(scanner.row_order)
+	status_bar.showMessage(" Scan done: {0} rows".format(table.rowCount()))
+
+	imcomp_win.update_colors()
+	table.resizeRowsToContents()
+	return imcomp_win
+
+
 def parse_images_from_dir(dir, name_filters, suffix, extensions=['.png', '.dxr', '.jpg'], recursive=True):
 	'''
 	List all jpgs containing filters (if any) in their filename and the specified suffix and name_filter
@@ -249,30 +335,31 @@ def parse_images_from_dir(dir, name_filters, suffix, extensions=['.png', '.dxr',
 	return list_stills
 
 
-def parse_images(image_sets, name_filter, extensions, recursive=True):
+def parse_images_sequential(image_sets, name_filter, extensions, recursive=True):
+	'''
+	Previous implementation of parse_images(), parsing each set one after the other with os.walk()
+	'''
 	lists = []
 	for image_set in image_sets:
 		print("Parsing for {}".format(image_set['suffix']))
 		list_stills = parse_images_from_dir(image_set['directory'], name_filter, image_set['suffix'],
 											extensions=extensions, recursive=recursive)
 		lists.append(list_stills)
+	return merge_image_lists(lists)
 
-	if len(lists) == 0:
-		return None
-
-	# merge lists
-	list_files = dict()
-	# initialize with the first list
-	for s in lists[0]:
-		still_ok = True
-		for l in range(1, len(lists)):
-			if s not in lists[l]:
-				still_ok = False
-				break
-		if still_ok:
-			list_files[s] = []
-			for l in range(len(lists)):
-				list_files[s].append(lists[l][s])
-
-	return list_files
 
+def parse_images(image_sets, name_filter, extensions, recursive=True, max_workers=None,
+				 use_index=False, rescan=False):
+	'''
+	List the images of all the image sets and keep the ones present in every set
+	:param image_sets: list of dict with 'directory' and 'suffix' keys
+	:param name_filter: comma separated list of substrings that the filenames must contain
+	:param extensions: list of accepted image extensions
+	:param recursive: parse subdirectories
+	:param max_workers: number of scanning threads, None for the default
+	:param use_index: use the persistent scan index to skip unchanged directories
+	:param rescan: ignore the existing scan index and list all the directories
+	:return: dictionary unique_name -> list of filenames (one per image set), or None if there is no image set
+	'''
+	return scan_images(image_sets, name_filter, extensions, recursive=recursive, max_workers=max_workers,
+					   use_index=use_index, rescan=rescan)
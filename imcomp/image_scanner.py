@@ -0,0 +1,299 @@
+"""
+Parallel scanner for image set directories, based on os.scandir
+
+Produces the same unique_name -> filename dictionaries as fill_table_data.parse_images_from_dir(),
+but walks all the image sets and their subdirectories concurrently on a thread pool, which mostly
+helps on network file systems where each directory listing has a high latency.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Tuple
+
+from .scan_index import ScanIndex
+
+
+def directory_prefix(rel_dir: str) -> str:
+    """ Prefix added to image names found in the directory rel_dir (relative to the set directory),
+        same convention as parse_images_from_dir(), where the set directory itself is '.' """
+    return rel_dir.replace("/", "_").replace('\\', '_') + '_'
+
+
+class ImageNameMatcher:
+    """
+        Precompiled filename checks of an image set: extensions, name filters and suffix
+    """
+    def __init__(self, name_filters: str, suffix: str, extensions: List[str]):
+        self.suffix = suffix
+        # extensions are compared to the lower case filename, as in parse_images_from_dir()
+        self._extensions = tuple(extensions)
+        # empty filters always match
+        self._filters = tuple(f for f in name_filters.split(',') if f != '')
+        self._suffix_length = len(suffix)
+        # identifies the matching rules in the scan index
+        self.key = '|'.join([suffix, ','.join(self._extensions), ','.join(self._filters)])
+
+    def image_name(self, filename: str) -> Optional[str]:
+        """ Returns the image name (without extension and suffix) or None if filename does not match """
+        if not filename.lower().endswith(self._extensions):
+            return None
+        for f in self._filters:
+            if f not in filename:
+                return None
+        image_name = os.path.splitext(filename)[0]
+        if self._suffix_length:
+            if not image_name.endswith(self.suffix):
+                return None
+            image_name = image_name[:-self._suffix_length]
+        return image_name
+
+    def unique_name(self, prefix: str, filename: str) -> Optional[str]:
+        image_name = self.image_name(filename)
+        if image_name is None:
+            return None
+        return prefix + image_name
+
+
+def scan_directory(path: str, prefix: str, matchers: List[ImageNameMatcher]) \
+        -> Tuple[List[str], List[List[Tuple[str, str]]]]:
+    """
+    List one directory and apply all the matchers to its files
+    :param path: directory to list
+    :param prefix: unique name prefix of the directory
+    :param matchers: list of ImageNameMatcher
+    :return: pair (subdirectory names, list of [(unique_name, filename)] for each matcher)
+    """
+    subdirs = []
+    found = [[] for _ in matchers]
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        # same behavior as os.walk(): unreadable directories are skipped
+        return subdirs, found
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # os.walk() does not follow symbolic links to directories by default
+            try:
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+            except OSError:
+                pass
+            continue
+        for pos, matcher in enumerate(matchers):
+            unique_name = matcher.unique_name(prefix, entry.name)
+            if unique_name is not None:
+                found[pos].append((unique_name, os.path.join(path, entry.name)))
+    return subdirs, found
+
+
+class ImageScanner:
+    """
+        Scan several image sets in parallel
+
+        Image sets sharing the same directory are listed only once, each directory listing is a task
+        of the thread pool, and subdirectories are submitted as soon as they are discovered.
+        With use_index, a ScanIndex per set directory avoids listing the directories that did not
+        change since the previous scan, rescan ignores the previous index content.
+    """
+    def __init__(self, image_sets: List[Dict[str, str]], name_filters: str, extensions: List[str],
+                 recursive: bool = True, max_workers: Optional[int] = None,
+                 use_index: bool = False, rescan: bool = False, index_dir: Optional[str] = None):
+        self.image_sets = image_sets
+        self.recursive = recursive
+        self.max_workers = max_workers
+        self.use_index = use_index
+        self.rescan = rescan
+        self.index_dir = index_dir
+        self._indexes: Dict[str, ScanIndex] = dict()
+        # number of directories listed and discovered, gives the scan progress
+        self.directories_done = 0
+        self.directories_found = 0
+        # unique_name -> [filename or None per image set], for the names missing in some sets after iter_rows()
+        self.incomplete_rows: Dict[str, List[Optional[str]]] = dict()
+        # after iter_rows(): rows whose files changed after they were yielded, and order of the rows in scan()
+        self.updated_rows: Dict[str, List[str]] = dict()
+        self.row_order: List[str] = []
+        # group image sets by directory: { directory: [ (set_index, matcher) ] }
+        self._roots: Dict[str, List[Tuple[int, ImageNameMatcher]]] = dict()
+        for set_index, image_set in enumerate(image_sets):
+            matcher = ImageNameMatcher(name_filters, image_set['suffix'], extensions)
+            self._roots.setdefault(image_set['directory'], []).append((set_index, matcher))
+
+    def _scan_directory(self, root: str, rel_dir: str, path: str):
+        """ scan_directory() going through the scan index of root if any """
+        matchers = [m for _, m in self._roots[root]]
+        prefix = directory_prefix(rel_dir)
+        index = self._indexes.get(root)
+        if index is None:
+            return scan_directory(path, prefix, matchers)
+        try:
+            # get mtime before listing: changes during the listing will invalidate the entry
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return [], [[] for _ in matchers]
+        keys = [m.key for m in matchers]
+        cached = index.lookup(rel_dir, mtime_ns, keys)
+        if cached is not None:
+            subdirs, files = cached
+            found = [[(unique_name, os.path.join(path, basename)) for unique_name, basename in f.items()]
+                     for f in files]
+            return subdirs, found
+        subdirs, found = scan_directory(path, prefix, matchers)
+        index.update(rel_dir, mtime_ns, subdirs,
+                     {key: {unique_name: os.path.basename(filename) for unique_name, filename in f}
+                      for key, f in zip(keys, found)})
+        return subdirs, found
+
+    def iter_directories(self, timeout: Optional[float] = None):
+        """
+        Generator over scanned directories, in completion order
+        :param timeout: if set, yields (None, None, []) when no directory was completed within timeout seconds,
+            to let the caller process its events
+        :return: yields tuples (set_index, order_key, [(unique_name, filename)]), where sorting the
+            order_key values gives the os.walk() top-down order of the directories within the set
+        """
+        self.directories_done = 0
+        self.directories_found = 0
+        if self.use_index:
+            for root in self._roots:
+                index = ScanIndex(root, self.index_dir)
+                if not self.rescan:
+                    index.load()
+                self._indexes[root] = index
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = dict()
+
+            def submit(root, rel_dir, path, order_key):
+                future = executor.submit(self._scan_directory, root, rel_dir, path)
+                pending[future] = (root, rel_dir, path, order_key)
+                self.directories_found += 1
+
+            for root in self._roots:
+                submit(root, '.', root, ())
+
+            while pending:
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    yield None, None, []
+                for future in done:
+                    root, rel_dir, path, order_key = pending.pop(future)
+                    self.directories_done += 1
+                    subdirs, found = future.result()
+                    if self.recursive:
+                        for pos, name in enumerate(subdirs):
+                            sub_rel = name if rel_dir == '.' else os.path.join(rel_dir, name)
+                            submit(root, sub_rel, os.path.join(path, name), order_key + (pos,))
+                    for (set_index, _), set_found in zip(self._roots[root], found):
+                        yield set_index, order_key, set_found
+
+        for root, index in self._indexes.items():
+            print(f"Scan index {root}: {index.hits} unchanged, {index.misses} listed directories")
+            index.save(keep_previous=not self.recursive)
+        self._indexes = dict()
+
+    def progress(self) -> float:
+        """ Approximate scan progress in percent, the total number of directories is not known in advance """
+        return 100 * self.directories_done / max(1, self.directories_found)
+
+    def iter_rows(self, batch_size: int = 1000, interval: float = 0.25):
+        """
+        Streaming version of scan() followed by merge_image_lists()
+        A row is ready as soon as its unique name has been found in all the image sets. If a unique name
+        appears several times in a set, the last file in os.walk() order is kept, as in scan(): at the end of
+        the scan, updated_rows gives the rows yielded before their last duplicate was found, with their final
+        files, and row_order gives the order of the rows in merge_image_lists(), the first occurrence of
+        the unique names in the first image set.
+        :param batch_size: number of rows that triggers a new batch
+        :param interval: maximal time in seconds between two batches, batches can be empty
+        :return: yields lists of (unique_name, [filename per image set])
+        """
+        nb_sets = len(self.image_sets)
+        # unique_name -> [filenames, their os.walk() positions, number of sets where it was found, yielded,
+        #                 first os.walk() position in the first set]
+        partial: Dict[str, list] = dict()
+        self.updated_rows = dict()
+        batch = []
+        last_batch_time = time.perf_counter()
+        for set_index, order_key, found in self.iter_directories(timeout=interval):
+            for pos, (unique_name, filename) in enumerate(found):
+                # the files of a directory come before its subdirectories, as in scan()
+                walk_key = (order_key, pos)
+                row = partial.get(unique_name)
+                if row is None:
+                    row = partial[unique_name] = [[None] * nb_sets, [None] * nb_sets, 0, False, None]
+                files, keys = row[0], row[1]
+                if set_index == 0 and (row[4] is None or walk_key < row[4]):
+                    row[4] = walk_key
+                if files[set_index] is None:
+                    files[set_index] = filename
+                    keys[set_index] = walk_key
+                    row[2] += 1
+                    if row[2] == nb_sets:
+                        row[3] = True
+                        batch.append((unique_name, list(files)))
+                elif walk_key > keys[set_index]:
+                    files[set_index] = filename
+                    keys[set_index] = walk_key
+                    if row[3]:
+                        self.updated_rows[unique_name] = files
+            if len(batch) >= batch_size or time.perf_counter() - last_batch_time >= interval:
+                yield batch
+                batch = []
+                last_batch_time = time.perf_counter()
+        if batch:
+            yield batch
+        complete = [unique_name for unique_name, row in partial.items() if row[2] == nb_sets]
+        self.row_order = sorted(complete, key=lambda unique_name: partial[unique_name][4])
+        self.incomplete_rows = {unique_name: row[0] for unique_name, row in partial.items() if row[2] < nb_sets}
+
+    def scan(self) -> List[Dict[str, str]]:
+        """
+        Scan all the image sets
+        :return: list with one dictionary unique_name -> filename per image set
+        """
+        per_set = [[] for _ in self.image_sets]
+        for set_index, order_key, found in self.iter_directories():
+            if found:
+                per_set[set_index].append((order_key, found))
+        lists = []
+        for set_dirs in per_set:
+            # keep os.walk() order, so that duplicated unique names resolve the same way
+            set_dirs.sort(key=lambda d: d[0])
+            list_stills = dict()
+            for _, found in set_dirs:
+                list_stills.update(found)
+            lists.append(list_stills)
+        return lists
+
+
+def merge_image_lists(lists: List[Dict[str, str]]) -> Optional[Dict[str, List[str]]]:
+    """
+    Keep the unique names present in all the image sets
+    :param lists: one dictionary unique_name -> filename per image set
+    :return: dictionary unique_name -> list of filenames, one per image set
+    """
+    if len(lists) == 0:
+        return None
+    list_files = dict()
+    for s in lists[0]:
+        if all(s in l for l in lists[1:]):
+            list_files[s] = [l[s] for l in lists]
+    return list_files
+
+
+def scan_images(image_sets, name_filter, extensions, recursive=True, max_workers=None,
+                use_index=False, rescan=False):
+    """ Parallel equivalent of fill_table_data.parse_images() """
+    scanner = ImageScanner(image_sets, name_filter, extensions, recursive=recursive, max_workers=max_workers,
+                           use_index=use_index, rescan=rescan)
+    lists = scanner.scan()
+    for image_set, list_stills in zip(image_sets, lists):
+        print(f"Found {len(list_stills)} images for {image_set['suffix']} in {image_set['directory']}")
+    return merge_image_lists(lists)
@@ -4,26 +4,14 @@ import json
 from imcomp import version, fill_table_data
 import glob
 
-from qimview.utils.qt_imports   import QtWidgets, QtCore, QtGui
-from qimview.image_viewers      import ViewerType
-from imcomp                     import ImCompWindow
+# Qt is imported in main(): the argument parsing is shared with the headless imcomp-batch command
 
 
-# *****************************************************************************
-# Main
-# *****************************************************************************
-def main():
-	# Init log
-	logging.info('Begin')
- 
-	try:
-		reader_add_plugins()
-	except Exception as e:
-		print(f"No reader plugin, {e}")
-		pass
-
-	# Parse parse_args
-	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+def create_parser(description=__doc__):
+	'''
+	Command line arguments, shared by imcomp and imcomp-batch
+	'''
+	parser = argparse.ArgumentParser(description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 	parser.add_argument( 'directory_list', 
 					 type=str, nargs='*', 
 					 default='.', 
@@ -52,8 +40,21 @@ def main():
 	                    help="List of of image sets, each image set is defined as name:dir:suffix, this parameter"
 	                         "replacess directory_list and suffix_list options")
 	parser.add_argument('--timing', action='store_true', help='display timings')
+	parser.add_argument('--rescan', action='store_true',
+						help='ignore the scan index of the image set directories and parse them entirely')
+	parser.add_argument('--watch', action='store_true',
+						help='watch the image set directories and add new or modified images to the table')
+	parser.add_argument('--table', type=str, choices={'widget','model'}, default='widget',
+						help="Table implementation, widget: QTableWidget with one item per cell, model: "
+							 "virtualized view on column arrays, for large image sets")
+	return parser
 
-	args = parser.parse_args()
+
+def init_params(args):
+	'''
+	Parameters from the command line arguments, completed by the parameters of the report if any,
+	with the list of image sets in 'image_sets'
+	'''
 	_params = vars(args)
 
 	need_image_sets = True
@@ -62,8 +63,8 @@ def main():
 		try:
 			data = fill_table_data.readJson(args.report)
 			for key in data['params']:
-				# don't change report value
-				if key == 'report':
+				# don't change report value, and keep session options (rescan, watch, table) from the command line
+				if key in ['report', 'rescan', 'watch', 'table']:
 					continue
 				# keep command line argument if using long name: --XXX
 				if key not in _params or _params[key] is None or _params[key] == '' \
@@ -147,15 +148,27 @@ def main():
 				print("Found path {0}".format(d1))
 				_params['image_sets'][pos]['directory'] = d1
 			else:
-				print("Path {0} or {1} not found".format(d, d1))
+				# path of another platform, or folder moved below the folder of the report
+				d2 = fill_table_data.adapt_path(d, root_dir=search_path if args.report else None)
+				if os.path.isdir(d2):
+					print("Found path {0}".format(d2))
+					_params['image_sets'][pos]['directory'] = d2
+				else:
+					print("Path {0} or {1} not found".format(d, d1))
 		else:
 			print("Path {0} checked".format(d))
+	return _params
 
-	# Read config file
-	if os.path.isfile(_params['config']):
-		config_filename = _params['config']
+
+def read_config(config_name):
+	'''
+	Read the configuration file
+	:param config_name: json file, or name of a file of the config folder
+	'''
+	if os.path.isfile(config_name):
+		config_filename = config_name
 	else:
-		filename = os.path.join(os.path.dirname(__file__), 'config', _params['config']+'.json')
+		filename = os.path.join(os.path.dirname(__file__), 'config', config_name+'.json')
 		if os.path.isfile(filename):
 			config_filename = filename
 		else:
@@ -166,6 +179,31 @@ def main():
 			config = json.load(cf)
 	except Exception as e:
 		print(("Failed to open config file {} error: {}".format(config_filename, e)))
+	return config
+
+
+# *****************************************************************************
+# Main
+# *****************************************************************************
+def main():
+	from qimview.utils.qt_imports   import QtWidgets, QtCore, QtGui
+	from qimview.image_viewers      import ViewerType
+	from imcomp                     import ImCompWindow
+
+	# Init log
+	logging.info('Begin')
+ 
+	try:
+		reader_add_plugins()
+	except Exception as e:
+		print(f"No reader plugin, {e}")
+		pass
+
+	# Parse parse_args
+	args = create_parser().parse_args()
+	_params = init_params(args)
+	# Read config file
+	config = read_config(_params['config'])
 
 	_params['version'] = version.__version__
 
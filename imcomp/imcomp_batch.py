@@ -0,0 +1,90 @@
+"""
+Headless image set comparison
+
+imcomp-batch takes the imcomp arguments to define the image sets (--sets, --suffix_list, --filters, --ext,
+--recursive, ...), computes the image differences on a process pool and writes a report that imcomp reads
+with --report. The metric cache is shared with imcomp when both are run from the same folder. Qt is not imported.
+"""
+
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from . import version
+from .imcomp import create_parser, init_params, read_config
+from .fill_table_data import image_set_names, config_diff_pairs, writeJson
+from .image_scanner import scan_images
+from .qimtools.difference_engine import DifferenceEngine, difference_pairs, difference_tasks
+from .qimtools.metrics import METRICS
+
+
+def create_batch_parser():
+    parser = create_parser(__doc__)
+    group = parser.add_argument_group('batch options', 'default values are taken from diff_options of the config')
+    group.add_argument('-o', '--output', type=str, default='',
+                       help="Report file, compressed if it ends with .json.gz, default: the report name of imcomp")
+    group.add_argument('--metrics', nargs='+', choices=list(METRICS), help="Metrics of each image pair")
+    group.add_argument('--mode', type=str, choices={'config', 'reference'},
+                       help="config: pairs of the config diff entry, reference: reference set against the others")
+    group.add_argument('--reference', type=str, help="Name of the reference image set, the first set by default")
+    group.add_argument('--workers', type=int, help="Number of processes, 0 for the number of CPUs")
+    return parser
+
+
+def diff_options(config, params):
+    ''' diff_options of the configuration, updated by the command line arguments '''
+    options = dict(config.get('diff_options') or dict())
+    for key, option in (('metrics', 'metrics'), ('mode', 'mode'), ('reference', 'reference'),
+                        ('workers', 'max_workers')):
+        if params.get(key) is not None:
+            options[option] = params[key]
+    return options
+
+
+def main():
+    params = init_params(create_batch_parser().parse_args())
+    config = read_config(params['config'])
+    params['version'] = version.__version__
+    params['config_name'] = config['config_name']
+
+    image_list, _, default_report_file = image_set_names(config, params)
+    config_pairs = config_diff_pairs(config, image_list)
+    options = diff_options(config, params)
+    pairs = difference_pairs(image_list[1:], config_pairs, options.get('mode', 'config'), options.get('reference'))
+    if not pairs:
+        print("No image pair to compare")
+        sys.exit(1)
+
+    rows = scan_images(params['image_sets'], params['filters'], params['ext'], params['recursive'],
+                       use_index=True, rescan=params.get('rescan', False)) or dict()
+    print(f"{len(rows)} rows, pairs {[diff_name for diff_name, _, _ in pairs]}")
+    useful_data = {unique_name: {image_list[n+1]: filename for n, filename in enumerate(files)}
+                   for unique_name, files in rows.items()}
+
+    engine = DifferenceEngine.from_options(pairs, options, default_report_file)
+    column_names = engine.column_names()
+    tasks = difference_tasks(sorted(useful_data), useful_data, engine.images())
+    # same contents as the reports written by the table, without the 'Unique Name' column
+    contents = OrderedDict()
+    contents['params'] = params
+    for unique_name, _ in tasks:
+        contents[unique_name] = dict()
+    start = time.perf_counter()
+    nb_done = 0
+    for results in engine.run(tasks):
+        for unique_name, values in results:
+            contents[unique_name].update((column_name, '%.4f' % value)
+                                         for column_name, value in zip(column_names, values) if value == value)
+        nb_done += len(results)
+        rate = nb_done / max(time.perf_counter()-start, 1e-6)
+        print(f"Image differences: {nb_done}/{len(tasks)} rows, {rate:.1f} rows/s")
+    print("Image diff done in {0:0.2f} sec".format(time.perf_counter()-start))
+
+    output = params['output'] or os.path.join(os.getcwd(), default_report_file+'.json')
+    writeJson(contents, output)
+    print(f"Report written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,3 +14,13 @@ class ImCompConfig:
         if os.path.isfile(config_file): 
             config.read([config_file])
         return config
+
+    @staticmethod
+    def cache_dir(subdir=''):
+        """
+            Folder where imcomp keeps its persistent data (scan indexes, ...),
+            set with Directory in the [CACHE] section of ~/.imcomp.cfg, defaults to ~/.cache/imcomp
+        """
+        config = ImCompConfig.user_config()
+        cache_dir = config.get('CACHE', 'Directory', fallback='~/.cache/imcomp')
+        return os.path.join(os.path.expanduser(cache_dir), subdir)
@@ -0,0 +1,437 @@
+"""
+Model/view version of ImCompTable
+
+The table contents are kept in a ColumnStore (NumPy columns) and displayed through a QAbstractTableModel
+in a QTableView, so that only the visible cells are created by Qt. ImCompTableView provides the same
+interface as ImCompTable for the main window and fill_table_data.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from qimview.utils.qt_imports import QtWidgets, QtCore, QtGui
+from qimview.utils.utils import get_time
+from .column_store import ColumnStore
+from .report_reader import is_metric_column
+from .imcomp_table import ImCompTableMixin, colormap_brushes, stats_tooltip, update_sort_keys
+from .colormap import get_colormap
+from .qimtools.process_image_differences import register_heatmaps
+
+# Deal with compatibility issues of different Qt versions
+if hasattr(QtCore.Qt, 'Vertical'):
+    QT_ORIENTATION = QtCore.Qt
+else:
+    QT_ORIENTATION = QtCore.Qt.Orientation
+
+
+class ImCompTableModel(QtCore.QAbstractTableModel):
+    """
+        Table model reading its cells from a ColumnStore, rows are displayed in the order given by
+        the record permutation self.order
+    """
+    def __init__(self, store: ColumnStore, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.column_names: List[str] = []
+        # columns written with can_edit=False
+        self.read_only_columns = {'Unique Name'}
+        # display row -> record
+        self.order = np.zeros(0, dtype=np.int64)
+        self._rows: Optional[np.ndarray] = None
+        # column name -> colormap index per record, -1 for no color
+        self.color_index: Dict[str, np.ndarray] = dict()
+        # QBrush per colormap index
+        self.brushes = colormap_brushes('jet', 90)
+        self.bold_record = -1
+        self.sort_columns = set()
+
+    def set_columns(self, column_names: List[str]) -> None:
+        self.beginResetModel()
+        self.column_names = column_names
+        self.endResetModel()
+
+    def add_column(self, column_name: str) -> int:
+        ''' Append a column, returns its position '''
+        col = len(self.column_names)
+        self.beginInsertColumns(QtCore.QModelIndex(), col, col)
+        self.column_names.append(column_name)
+        self.endInsertColumns()
+        return col
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.column_names)
+
+    def record(self, row: int) -> int:
+        return int(self.order[row])
+
+    def row(self, record: int) -> int:
+        """ Display row of a record, the inverse permutation is computed once after each reordering """
+        if self._rows is None:
+            self._rows = np.empty(len(self.order), dtype=np.int64)
+            self._rows[self.order] = np.arange(len(self.order))
+        return int(self._rows[record])
+
+    def row_id(self, row: int) -> str:
+        return self.store.row_ids[self.order[row]]
+
+    def add_rows(self, row_ids: List[str]) -> None:
+        if not row_ids:
+            return
+        first = len(self.order)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first+len(row_ids)-1)
+        records = self.store.add_rows(row_ids)
+        self.order = np.concatenate([self.order, np.arange(records.start, records.stop, dtype=np.int64)])
+        self._rows = None
+        for name, colors in self.color_index.items():
+            self.color_index[name] = np.concatenate([colors, np.full(len(row_ids), -1, dtype=np.int16)])
+        self.endInsertRows()
+
+    def text(self, row: int, col: int) -> str:
+        return self.store.text(self.order[row], self.column_names[col])
+
+    def is_numeric(self, col: int) -> bool:
+        column = self.store.column(self.column_names[col])
+        return column is not None and column.kind == 'numeric'
+
+    def cell_changed(self, row: int, col: int) -> None:
+        index = self.index(row, col)
+        self.dataChanged.emit(index, index)
+
+    def column_changed(self, col: int) -> None:
+        if len(self.order):
+            self.dataChanged.emit(self.index(0, col), self.index(len(self.order)-1, col))
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.order[index.row()]
+        name = self.column_names[index.column()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return self.store.text(record, name)
+        if role == QtCore.Qt.TextAlignmentRole:
+            if self.is_numeric(index.column()):
+                return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+            return int(QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter)
+        if role == QtCore.Qt.BackgroundRole:
+            colors = self.color_index.get(name)
+            if colors is not None and colors[record] >= 0:
+                return self.brushes[colors[record]]
+            return None
+        if role == QtCore.Qt.FontRole and index.column() == 0 and record == self.bold_record:
+            font = QtGui.QFont()
+            font.setBold(True)
+            return font
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QT_ORIENTATION.Horizontal:
+            if section >= len(self.column_names):
+                return None
+            if role == QtCore.Qt.DisplayRole:
+                return self.column_names[section]
+            if role == QtCore.Qt.FontRole:
+                font = QtGui.QFont()
+                font.setBold(True)
+                if section in self.sort_columns:
+                    font.setUnderline(True)
+                    font.setItalic(True)
+                return font
+            if role == QtCore.Qt.ToolTipRole:
+                return stats_tooltip(self.store, self.column_names[section]) or None
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return section+1
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        flags = QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
+        if self.column_names[index.column()] not in self.read_only_columns:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if not index.isValid() or role != QtCore.Qt.EditRole:
+            return False
+        self.store.set_text(self.order[index.row()], self.column_names[index.column()], str(value))
+        self.dataChanged.emit(index, index)
+        return True
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        if column < 0 or column >= len(self.column_names):
+            return
+        self.sort_by([(self.column_names[column], order == QtCore.Qt.DescendingOrder)])
+
+    def sort_by(self, keys):
+        """
+        Sort the rows by several columns, empty cells last, see ColumnStore.sort_records()
+        :param keys: list of (column name, descending), the first one being the primary key
+        """
+        self.set_order(self.store.sort_records(keys))
+        self.sort_columns = {self.column_names.index(name) for name, _ in keys if name in self.column_names}
+
+    def set_order(self, order: np.ndarray) -> None:
+        ''' Set the record of each display row, keeping the persistent indexes on their records '''
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        persistent_records = [self.order[index.row()] for index in persistent]
+
+        self.order = order
+        self._rows = None
+
+        self.changePersistentIndexList(persistent,
+                                       [self.index(self.row(record), index.column())
+                                        for record, index in zip(persistent_records, persistent)])
+        self.layoutChanged.emit()
+
+
+class ImCompTableView(ImCompTableMixin, QtWidgets.QTableView):
+    """
+        QTableView on an ImCompTableModel, with the interface of ImCompTable
+    """
+    cellClicked = QtCore.Signal(int, int)
+
+    def __init__(self, parent, _rows=0, _columns=0):
+        super().__init__(parent)
+        self.store = ColumnStore(max(_rows, 1024))
+        self.table_model = ImCompTableModel(self.store, self)
+        self.setModel(self.table_model)
+        self.init_table_state()
+
+    def create(self):
+        hheader = self.horizontalHeader()
+        try:
+            hheader.setSectionResizeMode(QtWidgets.QHeaderView.Interactive)
+            hheader.setSectionsMovable(True)
+        except Exception as e:
+            print("Qt hheader setting failed, old qt version ? {}".format(e))
+        # fixed row height, rows are never measured one by one
+        vheader = self.verticalHeader()
+        vheader.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        vheader.setDefaultSectionSize(self.fontMetrics().height()+8)
+        self.clicked.connect(lambda index: self.cellClicked.emit(index.row(), index.column()))
+        self.selectionModel().currentChanged.connect(self.current_changed)
+        self.selectionModel().selectionChanged.connect(self.item_selection_changed)
+
+    # QTableWidget compatible accessors used by the main window
+    def rowCount(self):
+        return self.table_model.rowCount()
+
+    def columnCount(self):
+        return self.table_model.columnCount()
+
+    def item(self, _row, _col):
+        ''' Read-only item with the cell text, None for empty cells as QTableWidget.item() '''
+        if _row < 0 or _row >= self.rowCount():
+            return None
+        text = self.table_model.text(_row, _col)
+        return QtWidgets.QTableWidgetItem(text) if text != '' else None
+
+    def horizontalHeaderItem(self, _col):
+        return QtWidgets.QTableWidgetItem(self.table_model.column_names[_col])
+
+    def selectedRanges(self):
+        return [QtWidgets.QTableWidgetSelectionRange(r.top(), r.left(), r.bottom(), r.right())
+                for r in self.selectionModel().selection()]
+
+    def resizeRowsToContents(self):
+        # rows have a fixed height: measuring all of them would defeat the virtualization of the view
+        pass
+
+    def current_changed(self, current, previous) -> None:
+        if not current.isValid():
+            return
+        _row = current.row()
+        model = self.table_model
+        old_record = model.bold_record
+        model.bold_record = model.record(_row)
+        if old_record >= 0 and old_record != model.bold_record:
+            model.cell_changed(model.row(old_record), 0)
+        model.cell_changed(_row, 0)
+        self.previous_row = _row
+        self._row_id = model.row_id(_row)
+
+    def selected_rows(self) -> List[int]:
+        return sorted({index.row() for index in self.selectionModel().selectedIndexes()})
+
+    def item_selection_changed(self, selected=None, deselected=None) -> None:
+        try:
+            start = get_time()
+            self.show_rows([self.table_model.row_id(_row) for _row in self.selected_rows()], start)
+        except Exception as e:
+            print(f"{e}")
+
+    def append_rows(self, row_ids):
+        ''' Append rows with only their Unique Name set '''
+        self.table_model.add_rows(row_ids)
+
+    def set_row_order(self, row_ids):
+        ''' Move the rows to the order of row_ids, the other rows are kept after them '''
+        model = self.table_model
+        records = np.array([self.store.index[row_id] for row_id in row_ids if row_id in self.store.index],
+                           dtype=np.int64)
+        rest = model.order[~np.isin(model.order, records)]
+        model.set_order(np.concatenate([records, rest]))
+
+    def row_records(self):
+        ''' Column store record of each table row in the current row order '''
+        return self.table_model.order
+
+    def row_index(self):
+        """ Returns the dictionary row_id -> current row position """
+        model = self.table_model
+        row_ids = self.store.row_ids
+        return {row_ids[record]: _row for _row, record in enumerate(model.order)}
+
+    def invalidate_row_metrics(self, row_ids):
+        """
+        Clear the cells of the columns computed from the images for the given rows
+        :param row_ids: list of row ids (unique names)
+        """
+        if not self.metric_columns:
+            return
+        model = self.table_model
+        for _row_id in row_ids:
+            record = self.store.record(_row_id)
+            if record is None:
+                continue
+            for _col in self.metric_columns:
+                self.store.clear(record, model.column_names[_col])
+                model.cell_changed(model.row(record), _col)
+
+    def apply_report(self, report_data, statusBar, setProgress):
+        '''
+        Fill the empty cells of the store from a parsed report, the view is refreshed once at the end
+        :param report_data: ReportData returned by report_reader.parse_report()
+        '''
+        start = get_time()
+        model = self.table_model
+        report_records = np.array([self.store.index.get(_row_id, -1) for _row_id in report_data.row_ids],
+                                  dtype=np.int64)
+        for column in report_data.columns.values():
+            if is_metric_column(column.name) and column.name not in self.column_list:
+                self.metric_columns.add(self.column_index(column.name))
+                model.read_only_columns.add(column.name)
+            elif column.name not in self.column_list or column.name == 'Unique Name':
+                continue
+            records = report_records[column.rows]
+            present = records >= 0
+            if column.kind == 'text':
+                self.store.fill_texts(records[present], column.name,
+                                      [text for text, p in zip(column.values, present) if p])
+            else:
+                float_format = '%d' if column.kind == 'int' else '%.5f'
+                self.store.fill_numbers(records[present], column.name, column.values[present], float_format)
+        model.layoutChanged.emit()
+        self.update_colors(statusBar, setProgress)
+        statusBar.showMessage(" Report applied in {0:0.3f} sec".format(get_time()-start))
+
+    def row_contents(self, _row):
+        ''' Row id and dictionary column name -> text of the non empty cells of a row '''
+        model = self.table_model
+        record = model.record(_row)
+        contents = dict()
+        for column_name in model.column_names:
+            if column_name != 'Unique Name' and not self.store.is_empty(record, column_name):
+                contents[column_name] = self.store.text(record, column_name)
+        return self.store.row_ids[record], contents
+
+    def write_number(self, _row, _col, _val, can_edit=False, float_format='%.5f'):
+        '''
+        Write the number in the specified cell
+        :param _row:
+        :param _col:
+        :param _val:
+        :param can_edit:
+        :param float_format:
+        :return:
+        '''
+        model = self.table_model
+        column_name = model.column_names[_col]
+        self.store.set_number(model.record(_row), column_name, _val, float_format)
+        if not can_edit:
+            model.read_only_columns.add(column_name)
+        model.cell_changed(_row, _col)
+
+    def write_number_int(self, _row, _col, _val, can_edit=False):
+        self.write_number(_row, _col, _val, can_edit, '%d')
+
+    def column_index(self, column_name):
+        ''' Position of a column from its name, the column is appended if it does not exist '''
+        model = self.table_model
+        if column_name in model.column_names:
+            return model.column_names.index(column_name)
+        return model.add_column(column_name)
+
+    def apply_differences(self, results):
+        '''
+        Write a batch of results of the difference thread, the view is refreshed once per column
+        :param results: list of (unique_name, values in the order of self.difference_columns)
+        '''
+        model = self.table_model
+        column_names = [model.column_names[_col] for _col in self.difference_columns]
+        model.read_only_columns.update(column_names)
+        for unique_name, values in results:
+            record = self.store.record(unique_name)
+            if record is None:
+                continue
+            for column_name, value in zip(column_names, values):
+                self.store.set_number(record, column_name, value, '%.4f')
+        for _col in self.difference_columns:
+            model.column_changed(_col)
+        register_heatmaps(self.useful_data, self.differences_worker.engine, results)
+
+    def update_difference_colors(self, statusBar, setProgress):
+        ''' Colors of all the columns, at the end of the difference computation '''
+        self.update_colors(statusBar, setProgress)
+
+    def update_colors(self, statusBar, setProgress):
+        """
+        set column colors from the range of values of each numeric column
+        """
+        statusBar.showMessage(" Updating colors")
+        start = get_time()
+        model = self.table_model
+        model.brushes = colormap_brushes(self.colormap, self.background_opacity)
+        colormap = get_colormap(self.colormap)
+        model.color_index = dict()
+        for column_name in model.column_names:
+            values = self.store.numeric_values(column_name)
+            if values is None:
+                continue
+            # one vectorized pass per column, the brushes are served through BackgroundRole
+            indices = colormap.indices(values)
+            if indices is not None:
+                model.color_index[column_name] = indices
+        for _col in range(model.columnCount()):
+            model.column_changed(_col)
+        setProgress(0)
+        statusBar.showMessage(" Colors updated in {0:0.3f} sec".format(get_time()-start))
+
+    def column_name(self, _col):
+        return self.table_model.column_names[_col]
+
+    def sort_header(self, column):
+        self.table_model.sort_by(update_sort_keys(self, column))
+        self.header_sort['current_column'] = column
+        self.previous_row = self.currentIndex().row() if self.currentIndex().isValid() else 0
+
+    def setColumnList(self, column_list):
+        self.column_list = column_list
+        column_names = [''] * len(column_list)
+        for column_name in column_list:
+            column_names[self.column_list[column_name]['default_pos']] = column_name
+        self.table_model.set_columns(column_names)
+        for column_name in column_list:
+            pos = self.column_list[column_name]['default_pos']
+            self.setColumnWidth(pos, self.column_list[column_name]['size_hint']*20)
+            if not self.column_list[column_name]['show']:
+                self.hideColumn(pos)
+        # click on header item
+        self.horizontalHeader().setSectionsClickable(True)
+        self.horizontalHeader().sectionClicked.connect(self.sort_header)
@@ -2,10 +2,13 @@
 from qimview.utils.qt_imports import QtWidgets, QtCore, QtGui
 from qimview.utils.utils import get_time
 from imcomp import fill_table_data
-from .fill_table_data import readJson
+from .report_reader import parse_report, is_metric_column
+from .colormap import get_colormap
+from .column_store import ColumnStore
 import numpy as np
 from collections import OrderedDict
-from imcomp.qimtools.process_image_differences import ProcessImageDifferences
+from imcomp.qimtools.process_image_differences import ProcessImageDifferences, register_heatmaps
+from imcomp.qimtools.difference_engine import DifferenceEngine, difference_tasks
 import os
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -35,24 +38,139 @@ def is_int_number(s):
     except ValueError:
         return False
 
-# Numeric item to allow better sorting of cells
-class NumericItem(QtWidgets.QTableWidgetItem):
-    def __lt__(self, other):
-        return self.data(QtCore.Qt.UserRole) < other.data(QtCore.Qt.UserRole)
-
-
-class ImCompTable(QtWidgets.QTableWidget):
-    def __init__(self, parent, _rows=0, _columns=0):
-        super().__init__( _rows, _columns, parent)
 
+_brushes = dict()
+
+
+def colormap_brushes(colormap_name, opacity):
+    """ List of QBrush for the colormap table, created once per colormap and opacity """
+    key = (colormap_name, opacity)
+    if key not in _brushes:
+        _brushes[key] = [QtGui.QBrush(QtGui.QColor(int(r), int(g), int(b), opacity))
+                         for r, g, b in get_colormap(colormap_name).lut]
+    return _brushes[key]
+
+
+def stats_tooltip(store, column_name):
+    """ Column statistics from the column store, as a tooltip text """
+    stats = store.stats(column_name)
+    if stats is None or stats['count'] == 0:
+        return ''
+    median = store.column(column_name).percentile(50)
+    text = "min {0:.5g}  max {1:.5g}\nmean {2:.5g}  median {3:.5g}\n{4} values".format(
+        stats['min'], stats['max'], stats['mean'], median, stats['count'])
+    if stats['nan_count']:
+        text += ", {0} NaN".format(stats['nan_count'])
+    return text
+
+
+def update_sort_keys(table, column):
+    """
+    Update the sort keys of the table after a click on a column header: a click sorts by the column,
+    toggling its order, and a Shift+click adds the column as a secondary key
+    :param table: ImCompTable or ImCompTableView
+    :param column: clicked column
+    :return: list of (column name, descending)
+    """
+    header_sort = table.header_sort
+    if column in header_sort and header_sort[column] == QtCore.Qt.DescendingOrder:
+            header_sort[column] = QtCore.Qt.AscendingOrder
+    else:
+        header_sort[column] = QtCore.Qt.DescendingOrder
+    keys = header_sort.get('keys', [])
+    if QtWidgets.QApplication.keyboardModifiers() & QtCore.Qt.ShiftModifier:
+        if column not in keys:
+            keys = keys + [column]
+    else:
+        keys = [column]
+    header_sort['keys'] = keys
+    return [(table.column_name(c), header_sort[c] == QtCore.Qt.DescendingOrder) for c in keys]
+
+
+def prioritized_row_ids(table):
+    """
+    Row ids in the order of the difference computation: selected rows first, then the visible rows,
+    then the other rows in the table order
+    :param table: ImCompTable or ImCompTableView
+    """
+    index = table.row_index()
+    row_ids = [None] * table.rowCount()
+    for _row_id, _row in index.items():
+        row_ids[_row] = _row_id
+    first = max(0, table.rowAt(0))
+    last = table.rowAt(table.viewport().height()-1)
+    if last < 0:
+        last = table.rowCount()-1
+    rows = [_row for r in table.selectedRanges() for _row in range(r.topRow(), r.bottomRow()+1)]
+    rows.extend(range(first, last+1))
+    rows.extend(range(table.rowCount()))
+    return [row_ids[_row] for _row in dict.fromkeys(rows) if row_ids[_row] is not None]
+
+
+def save_report(parent, contents, default_report_file, params, image_list, save_folder=None):
+    """
+    Write the report contents, asking for the filename if save_folder is not set
+    :param parent: parent widget of the file dialog
+    :param contents: dictionary row_id -> { column name: text }, with the 'params' entry
+    :param default_report_file: default report filename
+    :param params: image sets parameters, the directories are replaced when save_folder is set
+    :param image_list: list of image names, starting with the input image
+    :param save_folder: folder where the report is written
+    """
+    print("save_folder = ", save_folder)
+    print(default_report_file)
+    if save_folder is None:
+        fname = QtWidgets.QFileDialog.getSaveFileName(parent, 'Save contents in file',
+                                                      os.path.join(os.getcwd(), default_report_file), 'Json (*.json)')
+    else:
+        fname = [os.path.join(
+            save_folder, os.path.basename(default_report_file))]
+        # Replace directories in the params
+        contents['params']['directory_list'] = ""
+        for idx, image_set in enumerate(params['image_sets']):
+            print(idx, " ", image_set)
+            contents['params']['image_sets'][idx]['directory'] = os.path.join(
+                save_folder, image_list[idx + 1])
+            if idx > 0:
+                contents['params']['directory_list'] += ','
+            contents['params']['directory_list'] += os.path.join(
+                save_folder, image_list[idx + 1])
+
+    print("fname = ", fname)
+    # strange new issue?
+    if fname[0].startswith("//?/"):
+        print("filename may be too long for Windows !!!")
+        fname_new = fname[0][4:]
+    else:
+        fname_new = fname[0]
+    print("fname_new = ", fname_new)
+    if os.path.isfile(fname_new):
+        if os.path.isfile(fname_new+'.bak'):
+            os.remove(fname_new+'.bak')
+        os.rename(fname_new, fname_new+'.bak')
+    fill_table_data.writeJson(OrderedDict(contents), fname_new)
+
+
+class ImCompTableMixin:
+    """
+        Logic shared by ImCompTable and ImCompTableView, on top of the accessors of each table:
+        row_index(), row_records(), row_contents(), column_index(), column_name(), update_difference_colors()
+    """
+    def init_table_state(self):
         # store information about column sorting: order and number of current sorted column
         self.header_sort = dict()
 
         self.previous_row = 0
 
-        # Compute value range (min,max) for each column
-        self.column_range = dict()
+        # Columns computed from the images, to invalidate when images change
+        self.metric_columns = set()
         self.background_opacity = 90
+        self.colormap = 'jet'
+        self.differences_worker = None
+        # ThumbnailPreview set by the main window, None to display the images directly
+        self.thumbnail_preview = None
+        # SessionStats set by the main window
+        self.stats = None
 
         # export report
         self.default_report_file = 'report.json'
@@ -65,23 +183,6 @@ class ImCompTable(QtWidgets.QTableWidget):
         self.verbosity_TRACE = 1 << 4
         self.verbosity_DEBUG = 1 << 5
 
-
-    def create(self):
-
-        vheader = QtWidgets.QHeaderView(QT_ORIENTATION.Vertical)
-        # vheader.setResizeMode(QtWidgets.QHeaderView.ResizeToContents)
-        self.setVerticalHeader(vheader)
-        hheader = QtWidgets.QHeaderView(QT_ORIENTATION.Horizontal)
-        try:
-            hheader.setSectionResizeMode(QtWidgets.QHeaderView.Interactive)
-            hheader.setSectionsMovable(True)
-        except Exception as e:
-            print("Qt hheader setting failed, old qt version ? {}".format(e))
-        self.setHorizontalHeader(hheader)
-        # self.cellClicked.connect(self.cell_was_clicked)
-        self.currentCellChanged.connect(self.current_cell_changed)
-        self.itemSelectionChanged.connect(self.item_selection_changed)
-
     def set_info(self, image_list, useful_data, multiview):
         self.image_list   = image_list
         self.useful_data  = useful_data
@@ -114,6 +215,166 @@ class ImCompTable(QtWidgets.QTableWidget):
     def show_trace(self):
         return self.check_verbosity(self.verbosity_TRACE)
 
+    def show_rows(self, row_ids, start=None):
+        '''
+        Display the images of the selected rows, first as thumbnails if the images are not in cache
+        :param row_ids: row ids (unique names) of the selected rows
+        :param start: time of the selection, to record the display latency
+        :return: dictionary image name -> filename of the displayed images
+        '''
+        image_dict = {}
+        total_selected = len(row_ids)
+        for idx, _row_id in enumerate(row_ids):
+            for im in self.image_list:
+                # TODO: improve this part, for the moment, if only 1 row is selected,
+                # maintain previous names
+                # heatmaps are only available for the rows where they were computed
+                if im != 'none' and im in self.useful_data[_row_id]:
+                    key_str = f"{im}_{idx}" if total_selected > 1 else f"{im}"
+                    image_dict[key_str] = self.useful_data[_row_id][im]
+        display = lambda: self.display_images(image_dict, total_selected, start)
+        if self.thumbnail_preview is None or not self.thumbnail_preview.show(self.multiview, image_dict, display):
+            display()
+        return image_dict
+
+    def display_images(self, image_dict, total_selected, start=None) -> None:
+        ''' :param start: time of the selection, to record the display latency '''
+        try:
+            self.multiview.set_images(image_dict)
+            nb_inputs = len(image_dict)
+            max_viewers = 100
+            row_size = len([ l for l in self.image_list if l != 'none'])
+            if nb_inputs>=1 and nb_inputs<=max_viewers:
+                if total_selected>1 or self.multiview.nb_viewers_used > nb_inputs:
+                    self.multiview.set_number_of_viewers(nb_inputs, max_columns=row_size)
+                self.multiview.set_viewer_images()
+                self.multiview.viewer_grid_layout.update()
+            self.multiview.update_image()
+            if self.stats is not None and start is not None:
+                self.stats.record('row display', get_time()-start)
+        except Exception as e:
+            print(f"{e}")
+
+    def read_report(self, report, statusBar, setProgress):
+        self.apply_report(parse_report(report, list(self.column_list)), statusBar, setProgress)
+
+    def write_file(self, params=None, selected_rows=None, save_folder=None):
+        contents = dict()
+        if params is not None:
+            contents['params'] = params
+        if selected_rows is None:
+            selected_rows = np.arange(self.rowCount())
+        for _row in selected_rows:
+            try:
+                _row_id, row_contents = self.row_contents(_row)
+                contents[_row_id] = row_contents
+            except Exception as e:
+                print("Error in extracting row contents ", e)
+
+        save_report(self, contents, self.default_report_file, params, self.image_list, save_folder)
+
+    def export_to_excel(self):
+        default_output = os.path.join(
+            os.getcwd(), os.path.splitext(self.default_report_file)[0]+'.xls')
+        filename = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Save as excel file', default_output, ".xls(*.xls)")
+        import importlib.util
+        xlwt_spec = importlib.util.find_spec("xlwt")
+        if xlwt_spec is None:
+            print("Failed to load module xlwt, cannot export to excel file")
+            return
+        import xlwt
+        wbk = xlwt.Workbook()
+        self.sheet = wbk.add_sheet("sheet", cell_overwrite_ok=True)
+
+        records = self.row_records()
+        start_row = 1
+        for col in range(self.columnCount()):
+            column_name = self.column_name(col)
+            if not column_name:
+                continue
+            self.sheet.write(0, col, column_name)
+            if column_name == 'Unique Name':
+                for row, record in enumerate(records):
+                    if record >= 0:
+                        self.sheet.write(start_row + row, col, self.store.row_ids[record])
+                continue
+            # numbers and text are read from the column store
+            column = self.store.column(column_name)
+            if column is None:
+                continue
+            for row, record in enumerate(records):
+                if record >= 0 and not column.is_empty(record):
+                    self.sheet.write(start_row + row, col, column.value(record))
+        wbk.save(filename[0])
+
+    def compute_image_differences_thread(self, setProgress, statusBar, pairs, options=None):
+        '''
+        :param pairs: list of (diff_name, image1, image2)
+        :param options: diff_options of the configuration, each metric of each pair goes to the column diff_name:metric
+        '''
+        if not pairs:
+            statusBar.showMessage(" No image pair to compare")
+            return
+        statusBar.showMessage(" Processing image differences")
+        # by default, the metric cache and the heatmaps are next to the default report
+        report_name = os.path.splitext(os.path.basename(self.default_report_file))[0]
+        engine = DifferenceEngine.from_options(pairs, options, report_name)
+        self.difference_columns = [self.column_index(column_name) for column_name in engine.column_names()]
+        self.differences_status = (statusBar, setProgress)
+        tasks = difference_tasks(prioritized_row_ids(self), self.useful_data, engine.images())
+        # Compute image differences: more heavy processing
+        self.differences_worker = ProcessImageDifferences(engine, tasks)
+        self.differences_worker.updateProgress.connect(setProgress)
+        self.differences_worker.updateStatus.connect(statusBar.showMessage)
+        self.differences_worker.resultsReady.connect(self.apply_differences, QtCore.Qt.QueuedConnection)
+        self.differences_worker.finished.connect(self.compute_image_differences_end)
+        self.differences_worker.start()
+
+    def compute_image_differences_end(self):
+        self.metric_columns.update(self.difference_columns)
+        statusBar, setProgress = self.differences_status
+        self.update_difference_colors(statusBar, setProgress)
+        message = " Image diff {0} after {1:.2f} sec".format(
+            "cancelled" if self.differences_worker.cancelled else "done", get_time()-self.differences_worker.time_start)
+        if self.differences_worker.engine.cache is not None:
+            message += ", " + self.differences_worker.engine.cache.summary()
+        statusBar.showMessage(message)
+
+
+# Numeric item to allow better sorting of cells
+class NumericItem(QtWidgets.QTableWidgetItem):
+    def __lt__(self, other):
+        return self.data(QtCore.Qt.UserRole) < other.data(QtCore.Qt.UserRole)
+
+
+class ImCompTable(ImCompTableMixin, QtWidgets.QTableWidget):
+    def __init__(self, parent, _rows=0, _columns=0):
+        super().__init__( _rows, _columns, parent)
+        self.init_table_state()
+
+        # Typed values of the table cells, the items are only used for display
+        self.store = ColumnStore()
+        # row_id -> row position, reset when rows are added or moved
+        self._row_index = None
+
+
+    def create(self):
+
+        vheader = QtWidgets.QHeaderView(QT_ORIENTATION.Vertical)
+        # vheader.setResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+        self.setVerticalHeader(vheader)
+        hheader = QtWidgets.QHeaderView(QT_ORIENTATION.Horizontal)
+        try:
+            hheader.setSectionResizeMode(QtWidgets.QHeaderView.Interactive)
+            hheader.setSectionsMovable(True)
+        except Exception as e:
+            print("Qt hheader setting failed, old qt version ? {}".format(e))
+        self.setHorizontalHeader(hheader)
+        # self.cellClicked.connect(self.cell_was_clicked)
+        self.currentCellChanged.connect(self.current_cell_changed)
+        self.itemSelectionChanged.connect(self.item_selection_changed)
+
     def current_cell_changed(self, _row: int, _column: int, _prev_row, _prev_column) -> None:
         # we need 
         #   - image_list
@@ -150,178 +411,165 @@ class ImCompTable(QtWidgets.QTableWidget):
 
     def item_selection_changed(self) -> None:
         try:
+            start = get_time()
             print('item_selection_changed')
             selected_ranges = self.selectedRanges()
             print(f'selected_ranges {selected_ranges}')
-            image_dict = {}
-            # number of selected rows
-            total_selected = 0
-            for _range in selected_ranges:
-                total_selected +=  _range.bottomRow()-_range.topRow()+1
-            print(f"total_selected {total_selected}")
-            idx = 0
+            row_ids = []
             for _range in selected_ranges:
                 print(f" range rows {_range.topRow()} {_range.bottomRow()}")
                 for _row in range(_range.topRow(), _range.bottomRow()+1):
-                    _row_id = self.item(_row, 0).text()
-                    for im in self.image_list:
-                        # TODO: improve this part, for the moment, if only 1 row is selected,
-                        # maintain previous names
-                        if im != 'none':
-                            key_str = f"{im}_{idx}" if total_selected > 1 else f"{im}"
-                            image_dict[key_str] = self.useful_data[_row_id][im]
-                    idx += 1
+                    row_ids.append(self.item(_row, 0).text())
+            print(f"total_selected {len(row_ids)}")
+            image_dict = self.show_rows(row_ids, start)
             print(f"image_dict {image_dict}")
-            self.multiview.set_images(image_dict)
-            nb_inputs = len(image_dict)
-            max_viewers = 100
-            print(f"self.image_list {self.image_list}")
-            row_size = len([ l for l in self.image_list if l != 'none'])
-            if nb_inputs>=1 and nb_inputs<=max_viewers:
-                if total_selected>1 or self.multiview.nb_viewers_used > nb_inputs:
-                    self.multiview.set_number_of_viewers(nb_inputs, max_columns=row_size)
-                self.multiview.set_viewer_images()
-                self.multiview.viewer_grid_layout.update()
-                # self.multiview.update_image()
-                # self.multiview.setFocus()
-            self.multiview.update_image()
         except Exception as e:
             print(f"{e}")
 
-    def read_report(self, report, statusBar, setProgress):
-        data = readJson(report)
-        # fill table with data
-        nb_rows = self.rowCount()
+    def append_rows(self, row_ids):
+        '''
+        Append rows with only their Unique Name column set
+        :param row_ids: list of row ids (unique names)
+        '''
+        self.store.add_rows(row_ids)
+        self._row_index = None
+        row = self.rowCount()
+        self.setRowCount(row+len(row_ids))
+        col = self.column_list['Unique Name']['default_pos']
+        for _row_id in row_ids:
+            item = QtWidgets.QTableWidgetItem(_row_id)
+            # Center alignment
+            item.setTextAlignment(QtCore.Qt.AlignLeft)
+            # don't allow edit
+            item.setFlags(QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled)
+            self.setItem(row, col, item)
+            row += 1
+
+    def column_name(self, _col):
+        item = self.horizontalHeaderItem(_col)
+        return item.text() if item is not None else ''
+
+    def row_record(self, _row):
+        ''' Column store record of a table row '''
+        return self.store.record(self.item(_row, 0).text())
+
+    def row_records(self):
+        ''' Column store record of each table row in the current row order, -1 for unknown rows '''
+        records = np.full(self.rowCount(), -1, dtype=np.int64)
+        for _row in range(self.rowCount()):
+            item = self.item(_row, 0)
+            if item:
+                records[_row] = self.store.index.get(item.text(), -1)
+        return records
+
+    def commitData(self, editor):
+        # keep the column store in sync with the cells edited by the user
+        super().commitData(editor)
+        index = self.currentIndex()
+        if index.isValid() and index.column() != 0:
+            item = self.item(index.row(), index.column())
+            record = self.row_record(index.row())
+            if record is not None:
+                self.store.set_text(record, self.column_name(index.column()), item.text() if item else '')
+
+    def set_row_order(self, row_ids):
+        ''' Move the rows to the order of row_ids, the other rows are kept after them '''
+        row_index = self.row_index()
+        rows = [row_index[row_id] for row_id in row_ids if row_id in row_index]
+        listed = set(rows)
+        rows += [_row for _row in range(self.rowCount()) if _row not in listed]
+        self.reorder_rows(np.array(rows, dtype=np.int64))
+
+    def row_index(self):
+        """ Returns the dictionary row_id -> current row position """
+        if self._row_index is None:
+            self._row_index = dict()
+            for _row in range(self.rowCount()):
+                item = self.item(_row, 0)
+                if item:
+                    self._row_index[item.text()] = _row
+        return self._row_index
+
+    def invalidate_row_metrics(self, row_ids):
+        """
+        Clear the cells of the columns computed from the images for the given rows
+        :param row_ids: list of row ids (unique names)
+        """
+        if not self.metric_columns:
+            return
+        index = self.row_index()
+        for _row_id in row_ids:
+            if _row_id in index:
+                for _col in self.metric_columns:
+                    self.takeItem(index[_row_id], _col)
+                    self.store.clear(self.store.record(_row_id), self.column_name(_col))
+
+    def apply_report(self, report_data, statusBar, setProgress):
+        '''
+        Fill the empty cells of the table from a parsed report, column by column
+        :param report_data: ReportData returned by report_reader.parse_report()
+        '''
+        start = get_time()
+        statusBar.showMessage(" Applying report")
+        index = self.row_index()
+        report_rows = np.array([index.get(_row_id, -1) for _row_id in report_data.row_ids], dtype=np.int64)
+        report_records = np.array([self.store.index.get(_row_id, -1) for _row_id in report_data.row_ids],
+                                  dtype=np.int64)
+        nb_columns = len(report_data.columns)
         self.setUpdatesEnabled(False)
-        for _row in range(nb_rows):
-            self.hideRow(_row)
-            setProgress(_row*100/nb_rows)
+        for pos, column in enumerate(report_data.columns.values()):
+            setProgress(int(pos*100/nb_columns))
             QtCore.QCoreApplication.instance().processEvents()
-            try:
-                _row_id = self.item(_row, 0).text()
-                if _row_id in data:
-                    data_row = data[_row_id]
-                    for column_name in self.column_list:
-                        if column_name in data[_row_id]:
-                            # TODO: get column position in the table
-                            _col = self.column_list[column_name]['default_pos']
-                            item = self.item(_row, _col)
-                            if item:
-                                # only fill empty cells?
-                                if item.text() == '':
-                                    item.setText(data_row[column_name])
-                            else:
-                                if is_int_number(data_row[column_name]):
-                                    self.write_number_int(_row, _col, int(
-                                        data_row[column_name]), True)
-                                else:
-                                    if is_float_number(data[_row_id][column_name]):
-                                        self.write_number(_row, _col, float(
-                                            data_row[column_name]), True)
-                                    else:
-                                        _item = QtWidgets.QTableWidgetItem(
-                                            data_row[column_name])
-                                        self.setItem(
-                                            _row, _col, _item)
-            except Exception as e:
-                print("Error in setting row contents ", e)
-            self.showRow(_row)
+            if is_metric_column(column.name) and column.name not in self.column_list:
+                _col = self.column_index(column.name)
+                self.metric_columns.add(_col)
+            elif column.name not in self.column_list or column.name == 'Unique Name':
+                continue
+            else:
+                _col = self.column_list[column.name]['default_pos']
+            rows = report_rows[column.rows]
+            present = rows >= 0
+            rows = rows[present]
+            records = report_records[column.rows][present]
+            if column.kind == 'text':
+                texts = [text for text, p in zip(column.values, present) if p]
+                written = self.store.fill_texts(records, column.name, texts)
+            else:
+                float_format = '%d' if column.kind == 'int' else '%.5f'
+                written = self.store.fill_numbers(records, column.name, column.values[present], float_format)
+            store_column = self.store.column(column.name)
+            if store_column is None:
+                continue
+            numeric = store_column.kind == 'numeric'
+            for _row, record in zip(rows[written], records[written]):
+                text = store_column.text(record)
+                item = self.item(_row, _col)
+                if item is None:
+                    item = NumericItem(text) if numeric else QtWidgets.QTableWidgetItem(text)
+                    self.setItem(_row, _col, item)
+                else:
+                    item.setText(text)
+                if numeric:
+                    item.setData(QtCore.Qt.UserRole, store_column.value(record))
+                    item.setTextAlignment(QtCore.Qt.AlignRight)
+        self.setUpdatesEnabled(True)
         setProgress(0)
         self.update_colors(statusBar, setProgress)
-        self.setUpdatesEnabled(True)
+        statusBar.showMessage(" Report applied in {0:0.3f} sec".format(get_time()-start))
 
-    def write_file(self, params=None, selected_rows=None, save_folder=None):
+    def row_contents(self, _row):
+        ''' Row id and dictionary column name -> text of the non empty cells of a row '''
+        _row_id = self.item(_row, 0).text()
         contents = dict()
-        if params is not None:
-            contents['params'] = params
-        if selected_rows is None:
-            selected_rows = np.arange(self.rowCount())
-        for _row in selected_rows:
-            try:
-                _row_id = self.item(_row, 0).text()
-                print(_row_id)
-                contents[_row_id] = dict()
-                horizontal_header = self.horizontalHeader()
-                for _col in range(horizontal_header.count()):
-                    column_name = self.horizontalHeaderItem(
-                        _col).text()
-                    if column_name != 'Unique Name':
-                        if self.item(_row, _col):
-                            contents[_row_id][column_name] = self.item(
-                                _row, _col).text()
-            except Exception as e:
-                print("Error in extracting row contents ", e)
-
-        print("save_folder = ", save_folder)
-        print(self.default_report_file)
-        if save_folder is None:
-            fname = QtWidgets.QFileDialog.getSaveFileName(self, 'Save contents in file',
-                                                          os.path.join(os.getcwd(), self.default_report_file), 'Json (*.json)')
-        else:
-            fname = [os.path.join(
-                save_folder, os.path.basename(self.default_report_file))]
-            # Replace directories in the params
-            contents['params']['directory_list'] = ""
-            for idx, image_set in enumerate(self.params['image_sets']):
-                print(idx, " ", image_set)
-                contents['params']['image_sets'][idx]['directory'] = os.path.join(
-                    save_folder, self.image_list[idx + 1])
-                if idx > 0:
-                    contents['params']['directory_list'] += ','
-                contents['params']['directory_list'] += os.path.join(
-                    save_folder, self.image_list[idx + 1])
-
-        print("fname = ", fname)
-        # strange new issue?
-        if fname[0].startswith("//?/"):
-            print("filename may be too long for Windows !!!")
-            fname_new = fname[0][4:]
-        else:
-            fname_new = fname[0]
-        print("fname_new = ", fname_new)
-        if os.path.isfile(fname_new):
-            if os.path.isfile(fname_new+'.bak'):
-                os.remove(fname_new+'.bak')
-            os.rename(fname_new, fname_new+'.bak')
-        fill_table_data.writeJson(OrderedDict(contents), fname_new)
-
-    def export_to_excel(self):
-        default_output = os.path.join(
-            os.getcwd(), os.path.splitext(self.default_report_file)[0]+'.xls')
-        filename = QtWidgets.QFileDialog.getSaveFileName(
-            self, 'Save as excel file', default_output, ".xls(*.xls)")
-        import importlib.util
-        xlwt_spec = importlib.util.find_spec("xlwt")
-        if xlwt_spec is None:
-            print("Failed to load module xlwt, cannot export to excel file")
-            return
-        import xlwt
-        wbk = xlwt.Workbook()
-        self.sheet = wbk.add_sheet("sheet", cell_overwrite_ok=True)
-
-        for column in range(self.columnCount()):
-            header = self.horizontalHeaderItem(column)
-            if header is not None:
-                self.sheet.write(0, column, header.text())
-
-            start_row = 1
-            for col in range(self.columnCount()):
-                for row in range(self.rowCount()):
-                    try:
-                        text = str(self.item(row, col).text())
-                        try:
-                            number = float(text)
-                            self.sheet.write(start_row + row, col, number)
-                        except Exception as e:
-                            self.sheet.write(start_row + row, col, text)
-                    except AttributeError as e:
-                        pass
-                        # print(" Failed to read data at ({},{}): {}".format(row, col, e))
-            wbk.save(filename[0])
+        for _col in range(self.horizontalHeader().count()):
+            column_name = self.column_name(_col)
+            if column_name != 'Unique Name' and self.item(_row, _col):
+                contents[column_name] = self.item(_row, _col).text()
+        return _row_id, contents
 
     def write_number(self, _row, _col, _val, can_edit=False, float_format='%.5f'):
         '''
-        Write the number in the specified cell and update column range of values
+        Write the number in the specified cell and in the column store
         :param _row:
         :param _col:
         :param _val:
@@ -339,18 +587,11 @@ class ImCompTable(QtWidgets.QTableWidget):
                             QtCore.Qt.ItemIsEnabled)
 
         self.setItem(_row, _col, _item)
-        if 'min' not in self.column_range[_col]:
-            self.column_range[_col]['min'] = _val
-            self.column_range[_col]['max'] = _val
-        else:
-            self.column_range[_col]['min'] = min(
-                self.column_range[_col]['min'], _val)
-            self.column_range[_col]['max'] = max(
-                self.column_range[_col]['max'], _val)
+        self.store.set_number(self.row_record(_row), self.column_name(_col), _val, float_format)
 
     def write_number_int(self, _row, _col, _val, can_edit=False):
         '''
-        Write the number in the specified cell and update column range of values
+        Write the number in the specified cell and in the column store
         :param _row:
         :param _col:
         :param _val:
@@ -367,18 +608,11 @@ class ImCompTable(QtWidgets.QTableWidget):
                             QtCore.Qt.ItemIsEnabled)
 
         self.setItem(_row, _col, _item)
-        if 'min' not in self.column_range[_col]:
-            self.column_range[_col]['min'] = _val
-            self.column_range[_col]['max'] = _val
-        else:
-            self.column_range[_col]['min'] = min(
-                self.column_range[_col]['min'], _val)
-            self.column_range[_col]['max'] = max(
-                self.column_range[_col]['max'], _val)
+        self.store.set_number(self.row_record(_row), self.column_name(_col), int(_val), '%d')
 
     def write_number_item(self, item, _col, _val, can_edit=False):
         '''
-        Write the number in the specified cell and update column range of values
+        Write the number in the specified cell and in the column store
         :param item:
         :param _col:
         :param _val:
@@ -393,106 +627,141 @@ class ImCompTable(QtWidgets.QTableWidget):
             item.setFlags(QtCore.Qt.ItemIsSelectable |
                             QtCore.Qt.ItemIsEnabled)
 
-        if 'min' not in self.column_range[_col]:
-            self.column_range[_col]['min'] = _val
-            self.column_range[_col]['max'] = _val
-        else:
-            self.column_range[_col]['min'] = min(
-                self.column_range[_col]['min'], _val)
-            self.column_range[_col]['max'] = max(
-                self.column_range[_col]['max'], _val)
+        self.store.set_number(self.row_record(item.row()), self.column_name(_col), _val, '%.4f')
 
-    def compute_image_differences_thread(self, setProgress, statusBar):
-        statusBar.showMessage(" Processing image differences")
-        # Compute image differences: more heavy processing
-        self.differences_worker = ProcessImageDifferences(self)
-        self.differences_worker.updateProgress.connect(setProgress)
-        self.differences_worker.start()
-        self.differences_worker.finished.connect(self.compute_image_differences_end)
+    def column_index(self, column_name):
+        '''
+        Position of a column from its header text, the column is appended if it does not exist
+        '''
+        for c in range(self.columnCount()):
+            item = self.horizontalHeaderItem(c)
+            if item is not None and item.text() == column_name:
+                return c
+        col = self.columnCount()
+        self.insertColumn(col)
+        item = QtWidgets.QTableWidgetItem(column_name)
+        font = QtGui.QFont()
+        font.setBold(True)
+        item.setFont(font)
+        self.setHorizontalHeaderItem(col, item)
+        return col
+
+    def apply_differences(self, results):
+        '''
+        Write a batch of results of the difference thread
+        :param results: list of (unique_name, values in the order of self.difference_columns)
+        '''
+        index = self.row_index()
+        self.setUpdatesEnabled(False)
+        for unique_name, values in results:
+            _row = index.get(unique_name)
+            if _row is None:
+                continue
+            for _col, value in zip(self.difference_columns, values):
+                self.write_number(_row, _col, value, float_format='%.4f')
+        self.setUpdatesEnabled(True)
+        register_heatmaps(self.useful_data, self.differences_worker.engine, results)
 
-    def compute_image_differences_end(self):
-        c = self.differences_worker.column
-        # update column colors
-        try:
-            if 'min' in self.column_range[c]:
-                min_val = self.column_range[c]['min']
-                max_val = self.column_range[c]['max']
-                # print "min = ", min_val
-                # print "max = ", max_val
-                if min_val != max_val:
-                    for r in range(self.rowCount()):
-                        # set color for cell
-                        # get value
-                        val = float(self.item(r, c).text())
-                        val = int((val-min_val)/(max_val-min_val)*256)
-                        # print val
-                        color = cm.jet(val)
-                        # print color
-                        self.item(r, c).setBackground(QtGui.QBrush(
-                            QtGui.QColor(color[0]*255, color[1]*255, color[2]*255, self.background_opacity)))
-        except Exception as e:
-            print("Error in column range colors ", e)
-        self.differences_worker.setProgress(0)
-        self.differences_worker.statusBar.showMessage(" Image diff took: {0} sec".format(
-            get_time()-self.differences_worker.time_start))
+    def update_difference_colors(self, statusBar, setProgress):
+        ''' Colors of the difference columns, at the end of the computation '''
+        for c in self.difference_columns:
+            # update column colors
+            try:
+                self.update_column_colors(c)
+            except Exception as e:
+                print("Error in column range colors ", e)
+        setProgress(0)
+
+    def column_values(self, _col):
+        '''
+        Numeric values of a column in the current row order, read from the column store
+        :return: float array with NaN for empty cells, None for non numeric columns
+        '''
+        values = self.store.numeric_values(self.column_name(_col))
+        if values is None:
+            return None
+        records = self.row_records()
+        return np.where(records >= 0, values[records], np.nan)
+
+    def update_column_colors(self, _col):
+        '''
+        Set the background of the numeric cells of a column from the current colormap
+        :param _col: column position
+        '''
+        values = self.column_values(_col)
+        if values is None:
+            return
+        self.horizontalHeaderItem(_col).setToolTip(stats_tooltip(self.store, self.column_name(_col)))
+        indices = get_colormap(self.colormap).indices(values)
+        if indices is None:
+            return
+        brushes = colormap_brushes(self.colormap, self.background_opacity)
+        for r in np.flatnonzero(indices >= 0):
+            self.item(r, _col).setBackground(brushes[indices[r]])
 
     def update_colors(self, statusBar, setProgress):
         """
         set column color for QTable
         """
         statusBar.showMessage(" Updating colors")
-        nb_rows = self.rowCount()
         nb_columns = len(self.column_list)
         for c in range(nb_columns):
             setProgress(c*100/nb_columns)
             QtCore.QCoreApplication.instance().processEvents()
+            if self.store.stats(self.column_name(c)) is None:
+                continue
             self.setUpdatesEnabled(False)
             try:
-                if 'min' in self.column_range[c]:
-                    min_val = self.column_range[c]['min']
-                    max_val = self.column_range[c]['max']
-                    if min_val != max_val:
-                        self.hideColumn(c)
-                        for r in range(nb_rows):
-                            # set color for cell
-                            # get value
-                            item = self.item(r, c)
-                            if item:
-                                if is_float_number(item.text()):
-                                    val = float(item.text())
-                                    val = int((val-min_val) / \
-                                                (max_val-min_val)*256)
-                                    # print val
-                                    color = cm.jet(val)
-                                    # print color
-                                    item.setBackground(QtGui.QBrush(QtGui.QColor(color[0]*255, color[1]*255, color[2]*255,
-                                                                                    self.background_opacity)))
-                        self.showColumn(c)
+                self.update_column_colors(c)
             except Exception as e:
-                print("Error in column range colors column {0} min {1} max {2}: ".format(
-                    c, min_val, max_val), e)
-                self.showColumn(c)
+                print("Error in column range colors column {0}: ".format(c), e)
             self.setUpdatesEnabled(True)
         setProgress(0)
 
+    def reorder_rows(self, row_order):
+        '''
+        Move all the rows at once
+        :param row_order: new position -> previous row position
+        '''
+        current_row = self.currentRow()
+        current_column = max(0, self.currentColumn())
+        nb_columns = self.columnCount()
+        self.setUpdatesEnabled(False)
+        self.blockSignals(True)
+        rows = [[self.takeItem(_row, _col) for _col in range(nb_columns)] for _row in range(self.rowCount())]
+        self._row_index = None
+        for new_row, _row in enumerate(row_order):
+            for _col, item in enumerate(rows[_row]):
+                if item is not None:
+                    self.setItem(new_row, _col, item)
+        self.blockSignals(False)
+        self.setUpdatesEnabled(True)
+        if current_row >= 0:
+            new_row = int(np.flatnonzero(row_order == current_row)[0])
+            self.previous_row = new_row
+            self.setCurrentCell(new_row, current_column)
+
     def sort_header(self, column):
-        if column in self.header_sort and self.header_sort[column] == QtCore.Qt.DescendingOrder:
-                self.header_sort[column] = QtCore.Qt.AscendingOrder
-        else:
-            self.header_sort[column] = QtCore.Qt.DescendingOrder
-        self.sortItems(column, self.header_sort[column])
+        sort_keys = update_sort_keys(self, column)
+        # sorted records are cached by the column store until the key columns change
+        records = self.store.sort_records(sort_keys)
+        row_records = self.row_records()
+        row_of_record = np.full(self.store.size, -1, dtype=np.int64)
+        valid = row_records >= 0
+        row_of_record[row_records[valid]] = np.flatnonzero(valid)
+        row_order = row_of_record[records]
+        row_order = np.concatenate([row_order[row_order >= 0], np.flatnonzero(~valid)])
+        self.reorder_rows(row_order)
+
         _font = QtGui.QFont()
-        _font.setUnderline(False)
-        _font.setItalic(False)
         _font.setBold(True)
-        if 'current_column' in self.header_sort:
-            self.horizontalHeaderItem(self.header_sort['current_column']).setFont(_font)
-
+        for c in range(self.columnCount()):
+            header_item = self.horizontalHeaderItem(c)
+            if header_item is not None:
+                _font.setUnderline(c in self.header_sort['keys'])
+                _font.setItalic(c in self.header_sort['keys'])
+                header_item.setFont(_font)
         self.header_sort['current_column'] = column
-        _font.setUnderline(True)
-        _font.setItalic(True)
-        _font.setBold(True)
-        self.horizontalHeaderItem(self.header_sort['current_column']).setFont(_font)
 
     def setColumnList(self, column_list):
         self.column_list = column_list
@@ -516,7 +785,3 @@ class ImCompTable(QtWidgets.QTableWidget):
         # self.connect(self.horizontalHeader(), QtCore.SIGNAL('sectionClicked (int)'),
                                     # self.sort_header)
 
-        #
-        for c in range(len(column_list)):
-            self.column_range[c] = dict()
-
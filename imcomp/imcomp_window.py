@@ -8,12 +8,26 @@ import psutil
 from qimview.utils.qt_imports       import QtWidgets, QtCore, QtGui
 from qimview.utils.viewer_image     import *
 from qimview.utils.menu_selection   import MenuSelection
+from qimview.utils.thread_pool      import ThreadPool
 from qimview.image_viewers          import MultiView, ViewerType
-from .imcomp_table                  import ImCompTable
-from qimview.cache                  import ImageCache, FileCache
+from .imcomp_table                  import ImCompTable, prioritized_row_ids
+from .imcomp_model                  import ImCompTableView
 from qimview.image_readers          import gb_image_reader
 from typing                         import Optional, Any, Dict
 from .imcomp_config                 import ImCompConfig
+from .image_scanner                 import ImageScanner
+from .set_watcher                   import SetWatcher
+from .row_prefetcher                import RowPrefetcher
+from .file_cache_loader             import FileCacheLoader
+from .cache_budget                  import CacheBudgetController
+from .cache_stats                   import SessionStats, InstrumentedImageCache, InstrumentedFileCache, \
+                                           CacheStatsDialog
+from .shared_cache                  import SharedImageStore
+from .thumbnail_store               import ThumbnailStore, ThumbnailBuilder
+from .thumbnail_preview             import ThumbnailPreview
+from .colormap                      import colormap_names
+from .report_reader                 import parse_report
+from .qimtools.difference_engine    import difference_pairs
 # Only enable vlc player for windows by default
 
 userconf = ImCompConfig.user_config()
@@ -126,6 +140,12 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.menu_compute = self.menuBar().addMenu(self.tr('Compute'))
         start_bc = self.menu_compute.addAction(self.tr('Resulting image differences'))
         start_bc.triggered.connect(self.compute_image_differences)
+        start_bc = self.menu_compute.addAction(self.tr('Pause image differences'))
+        start_bc.triggered.connect(self.pause_image_differences)
+        start_bc = self.menu_compute.addAction(self.tr('Resume image differences'))
+        start_bc.triggered.connect(self.resume_image_differences)
+        start_bc = self.menu_compute.addAction(self.tr('Cancel image differences'))
+        start_bc.triggered.connect(self.cancel_image_differences)
         start_bc = self.menu_compute.addAction(self.tr('Update Colors'))
         start_bc.triggered.connect(self.update_colors)
 
@@ -135,8 +155,11 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.progressBar = QtWidgets.QProgressBar()
         self.progressBar.setMaximumWidth(210)
 
+        # Hits, misses, evictions and latencies of the caches and of the row display
+        self.cache_stats = SessionStats()
+        self._cache_stats_dialog : Optional[CacheStatsDialog] = None
         # ImageCache instance shared between MultiView instances
-        self.image_cache = ImageCache()
+        self.image_cache = InstrumentedImageCache(self.cache_stats)
 
         self.cache_progress_widget = QtWidgets.QWidget()
         self.cache_progress_widget.setMaximumWidth(200)
@@ -156,15 +179,42 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.cache_progress_layout.addWidget(self.file_cache_progress)
         self.cache_progress_layout.addWidget(self.image_cache_progress)
 
+        # Cache hit ratio and display latency, the details are in the cache statistics dialog
+        self.cache_stats_label = QtWidgets.QLabel()
         self.statusBar().addPermanentWidget(self.progressBar)
+        self.statusBar().addPermanentWidget(self.cache_stats_label)
         self.statusBar().addPermanentWidget(self.cache_progress_widget)
         self.cache_progress_widget.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.cache_progress_widget.customContextMenuRequested.connect(self.show_cache_progress_menu)
 
         # Create FileCache instance
-        self.file_cache = FileCache()
+        self.file_cache = InstrumentedFileCache(self.cache_stats)
         self.file_cache.set_memory_bar(self.file_cache_progress)
         # gb_image_reader.set_file_cache(self.file_cache)
+        # Read the rows next to the current row while it is reviewed
+        self.prefetcher = RowPrefetcher(self.image_cache, stats=self.cache_stats)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.prefetcher.shutdown)
+        # Load files in cache, its progress is polled by a timer
+        self.cache_loader = FileCacheLoader(self.file_cache)
+        self._cache_loader_timer = QtCore.QTimer(self)
+        self._cache_loader_timer.setInterval(200)
+        self._cache_loader_timer.timeout.connect(self.update_cache_loading)
+        # Persistent thumbnails, shown while the images of a new row are decoded,
+        # disk budget in Mb and width set with ThumbnailsSize and ThumbnailsWidth in the [CACHE] section of ~/.imcomp.cfg
+        self.thumbnail_store : Optional[ThumbnailStore] = None
+        self.thumbnail_preview : Optional[ThumbnailPreview] = None
+        self.thumbnail_builder : Optional[ThumbnailBuilder] = None
+        if userconf.getboolean('CACHE', 'Thumbnails', fallback=True):
+            try:
+                self.thumbnail_store = ThumbnailStore(ImCompConfig.cache_dir('thumbnails'),
+                                                      userconf.getint('CACHE', 'ThumbnailsSize', fallback=1024)*1024*1024,
+                                                      userconf.getint('CACHE', 'ThumbnailsWidth', fallback=256))
+            except Exception as e:
+                print(f"Failed to open the thumbnail store: {e}")
+        if self.thumbnail_store is not None:
+            self.thumbnail_preview = ThumbnailPreview(self.thumbnail_store, self.image_cache)
+            self.thumbnail_builder = ThumbnailBuilder(self.thumbnail_store)
+            QtWidgets.QApplication.instance().aboutToQuit.connect(self.close_thumbnails)
 
         # Add popup menu to cache progress bar
         self._cache_progress_menu = QtWidgets.QMenu(self.image_cache_progress)
@@ -173,6 +223,14 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.action_file_cache_enabled.setChecked(True)
         self._cache_progress_menu.addAction(self.action_file_cache_enabled)
         self._cache_progress_menu.triggered.connect(self.toggle_file_cache)
+        self.action_prefetch_rows = QtGui.QAction("Prefetch next rows", self._cache_progress_menu, checkable=True)
+        self.action_prefetch_rows.setChecked(True)
+        self.action_prefetch_rows.toggled.connect(self.toggle_prefetch_rows)
+        self._cache_progress_menu.addAction(self.action_prefetch_rows)
+        self.action_thumbnail_preview = QtGui.QAction("Thumbnail preview", self._cache_progress_menu, checkable=True)
+        self.action_thumbnail_preview.setChecked(True)
+        self.action_thumbnail_preview.toggled.connect(self.toggle_thumbnail_preview)
+        self._cache_progress_menu.addAction(self.action_thumbnail_preview)
 
         # set cache in percentage of memory
         cache_unit = 1024*1024 # 1 Mb
@@ -194,6 +252,9 @@ class ImCompWindow(QtWidgets.QMainWindow):
                                         self.update_file_max_cache_size)
         self._cache_progress_menu.addSeparator()
         self.action_load_files_in_cache = self._cache_progress_menu.addAction('Load files in cache')
+        self.action_cancel_files_loading = self._cache_progress_menu.addAction('Cancel loading files')
+        self.action_cancel_files_loading.setEnabled(False)
+        self.action_cancel_files_loading.triggered.connect(self.cancel_files_loading)
         self._cache_progress_menu.addSeparator()
         # self._cache_progress_menu.addSection("Image Cache")
         if total_memory<16000:
@@ -205,16 +266,61 @@ class ImCompWindow(QtWidgets.QMainWindow):
                                         self.update_image_max_cache_size)
         self.action_load_files_in_cache.triggered.connect(self.load_files_in_cache)
 
+        # Adaptive cache budgets: the selected sizes are upper bounds, the budgets follow the available memory,
+        # set with AdaptiveBudgets, MemoryReserve and MinCachePercent (in %) in the [CACHE] section of ~/.imcomp.cfg
+        self.cache_budgets = CacheBudgetController(
+            reserve_ratio=userconf.getint('CACHE', 'MemoryReserve', fallback=10)/100,
+            min_ratio=userconf.getint('CACHE', 'MinCachePercent', fallback=25)/100)
+        self.cache_budgets.enabled = userconf.getboolean('CACHE', 'AdaptiveBudgets', fallback=True)
+        # the image cache is reduced last
+        self._image_cache_budget = self.cache_budgets.add_cache('Image cache', self.image_cache,
+                                                                self._image_cache_selection.get_selection_value())
+        self._file_cache_budget = self.cache_budgets.add_cache('File cache', self.file_cache,
+                                                               self._file_cache_selection.get_selection_value())
+        self._cache_progress_menu.addSeparator()
+        self.action_adaptive_budgets = QtGui.QAction("Adaptive cache budgets", self._cache_progress_menu,
+                                                     checkable=True)
+        self.action_adaptive_budgets.setChecked(self.cache_budgets.enabled)
+        self.action_adaptive_budgets.toggled.connect(self.toggle_adaptive_budgets)
+        self._cache_progress_menu.addAction(self.action_adaptive_budgets)
+        self._cache_budget_timer = QtCore.QTimer(self)
+        self._cache_budget_timer.setInterval(2000)
+        self._cache_budget_timer.timeout.connect(self.update_cache_budgets)
+        self._cache_budget_timer.timeout.connect(self.update_cache_stats)
+        self.action_cache_stats = self._cache_progress_menu.addAction('Cache statistics')
+        self.action_cache_stats.triggered.connect(self.show_cache_stats)
+
+        # Decoded images shared with the other imcomp processes, enabled with SharedCache and budget in Mb set
+        # with SharedCacheSize in the [CACHE] section of ~/.imcomp.cfg
+        self.shared_store : Optional[SharedImageStore] = None
+        self.action_shared_cache = QtGui.QAction("Shared image cache", self._cache_progress_menu, checkable=True)
+        self.action_shared_cache.toggled.connect(self.toggle_shared_cache)
+        self._cache_progress_menu.addAction(self.action_shared_cache)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.detach_shared_cache)
+        self.action_shared_cache.setChecked(userconf.getboolean('CACHE', 'SharedCache', fallback=False))
+
         # Enable or Disable file cache
         self.toggle_file_cache()
+        self.update_cache_budgets()
+        self._cache_budget_timer.start()
 
         self.params : Optional[Dict[str, Any]] = None
+        self.config : Optional[Dict[str, Any]] = None
         self.viewer_mode = viewer_mode
-        self.table_widget : Optional[ImCompTable] = None
+        self.table_widget : Optional[ImCompTable | ImCompTableView] = None
+        # Watch mode: new or modified images in the image sets are added to the table
+        self.set_watcher : Optional[SetWatcher] = None
+        # row_id -> list of filenames (None if not found yet) for the rows not present in all the sets
+        self._incomplete_rows : Dict[str, list] = {}
+        # Report parsing thread
+        self._report_pool = ThreadPool()
+        self._report_data = None
         self.clip = QtWidgets.QApplication.clipboard()
 
         self.image1 = dict()
         self.image2 = dict()
+        # image names added to image_list for the difference heatmaps
+        self.heatmap_names = set()
         self.verbosity = 0
         self.verbosity_LIGHT = 1
         self.verbosity_TIMING = 1 << 2
@@ -263,6 +369,11 @@ class ImCompWindow(QtWidgets.QMainWindow):
             'Bayer2': ImageFormat.CH_RGGB,
             'Bayer3': ImageFormat.CH_GRBG
             }
+        self.option_colormap = self.option_menu.addMenu(self.tr('Colormap'))
+        self.colormap_selection = MenuSelection("Colormap", self.option_colormap,
+                                                { name:name for name in colormap_names() },
+                                                _default='jet', _callback=self.set_colormap)
+
         self.default_raw_bayer = 'Read'
         self.option_raw_bayer = self.option_menu.addMenu('RAW Bayer')
         for l in self.raw_bayer.keys():
@@ -284,28 +395,89 @@ class ImCompWindow(QtWidgets.QMainWindow):
         if is_enabled:
             gb_image_reader.set_file_cache(self.file_cache)
         else:
+            self.cancel_files_loading()
             gb_image_reader.set_file_cache(None)
             self.file_cache.reset()
             self.file_cache.check_size_limit()
+        self.prefetcher.file_cache = self.file_cache if is_enabled else None
+        self._file_cache_budget.enabled = is_enabled
+        self.update_cache_tooltips()
+
+    def toggle_thumbnail_preview(self, checked):
+        if self.thumbnail_preview is not None:
+            self.thumbnail_preview.enabled = checked
+
+    def toggle_prefetch_rows(self, checked):
+        self.prefetcher.enabled = checked
+        if not checked:
+            self.prefetcher.cancel()
 
 
     def update_file_max_cache_size(self):
         try:
             new_cache_size = self._file_cache_selection.get_selection_value()
-            if gb_image_reader.file_cache is not None:
-                gb_image_reader.file_cache.set_max_cache_size(new_cache_size)
-            self.file_cache_progress.setToolTip(f"{new_cache_size} Mb")
+            self.cache_budgets.set_bounds(self._file_cache_budget, new_cache_size)
+            self.update_cache_budgets()
         except Exception as e:
             print(f"Failed to set file cache size with exception {e}")
 
     def update_image_max_cache_size(self):
         try:
             new_cache_size = self._image_cache_selection.get_selection_value()
-            self.multiview.cache.set_max_cache_size(new_cache_size)
-            self.image_cache_progress.setToolTip(f"{new_cache_size} Mb")
+            self.cache_budgets.set_bounds(self._image_cache_budget, new_cache_size)
+            self.update_cache_budgets()
         except Exception as e:
             print(f"Failed to set image cache size with exception {e}")
 
+    def toggle_adaptive_budgets(self, checked):
+        self.cache_budgets.set_enabled(checked)
+        self.update_cache_budgets()
+
+    def update_cache_budgets(self):
+        """ Adapt the cache budgets to the available memory, the images displayed are evicted last """
+        multiview = getattr(self, 'multiview', None)
+        displayed = multiview.image_dict.values() if multiview is not None else []
+        self.cache_budgets.update(displayed)
+        self.update_cache_tooltips()
+
+    def update_cache_stats(self):
+        self.cache_stats_label.setText(self.cache_stats.status())
+        if self._cache_stats_dialog is not None and self._cache_stats_dialog.isVisible():
+            self._cache_stats_dialog.refresh()
+
+    def show_cache_stats(self):
+        """ Show the cache statistics of the session, refreshed with the cache budgets """
+        if self._cache_stats_dialog is None:
+            self._cache_stats_dialog = CacheStatsDialog(self.cache_stats, self)
+        self._cache_stats_dialog.refresh()
+        self._cache_stats_dialog.show()
+        self._cache_stats_dialog.raise_()
+
+    def toggle_shared_cache(self, checked):
+        if checked and self.shared_store is None:
+            try:
+                self.shared_store = SharedImageStore(os.path.join(ImCompConfig.cache_dir('shared_cache'), 'lock'),
+                                                     budget=userconf.getint('CACHE', 'SharedCacheSize',
+                                                                            fallback=2048)*1024*1024)
+                print(f"Attached to the shared image cache {self.shared_store.name}: {len(self.shared_store)} images")
+            except Exception as e:
+                print(f"Failed to attach to the shared image cache: {e}")
+                self.action_shared_cache.setChecked(False)
+        elif not checked:
+            self.detach_shared_cache()
+        self.image_cache.shared = self.shared_store
+
+    def detach_shared_cache(self):
+        """ Detach from the shared image cache, the last imcomp process removes it """
+        self.image_cache.shared = None
+        if self.shared_store is not None:
+            self.shared_store.close()
+            self.shared_store = None
+
+    def update_cache_tooltips(self):
+        self.image_cache_progress.setToolTip(self.cache_budgets.tooltip(self._image_cache_budget))
+        self.file_cache_progress.setToolTip(self.cache_budgets.tooltip(self._file_cache_budget))
+
     def set_image_list(self, imlist):
         self.image_list = imlist
 
@@ -339,6 +511,11 @@ class ImCompWindow(QtWidgets.QMainWindow):
     def set_readsize(self):
         self.multiview.set_read_size(self.read_size_selection.get_selection())
 
+    def set_colormap(self):
+        if self.table_widget:
+            self.table_widget.colormap = self.colormap_selection.get_selection_value()
+            self.update_colors()
+
     def update_raw_bayer_callback(self):
         # change bayer phase of current displayed image?
         menu = self.option_raw_bayer
@@ -351,12 +528,23 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.multiview.update_image()
 
     def create_table_widget(self, _rows=0, _columns=0):
-        self.table_widget = ImCompTable(self, _rows=_rows, _columns=_columns)
+        if self.params is not None and self.params.get('table', 'widget') == 'model':
+            # virtualized table for large image sets
+            self.table_widget = ImCompTableView(self, _rows=_rows, _columns=_columns)
+        else:
+            self.table_widget = ImCompTable(self, _rows=_rows, _columns=_columns)
         self.table_widget.create()
+        # prefetch once the current row is displayed, the selection is updated after the current row
+        if isinstance(self.table_widget, ImCompTableView):
+            self.table_widget.selectionModel().currentChanged.connect(self.schedule_prefetch)
+        else:
+            self.table_widget.currentCellChanged.connect(self.schedule_prefetch)
 
     def set_table_info(self):
         if self.table_widget:
             self.table_widget.set_info(self.image_list, self.useful_data, self.multiview)
+            self.table_widget.thumbnail_preview = self.thumbnail_preview
+            self.table_widget.stats = self.cache_stats
 
     def set_params(self, params : Dict[str, Any]) -> None:
         self.params = params
@@ -365,13 +553,82 @@ class ImCompWindow(QtWidgets.QMainWindow):
         return self.params
 
     def fill_data(self, config):
+        self.config = config
         if self.params:
             jpeg_only = self.params['config'] == 'default'
-            list_jpegs = fill_table_data.parse_images(self.params['image_sets'], self.params['filters'],
-                                                        self.params['ext'], self.params['recursive'])
-            fill_table_data.CreateTableFromImages(self, list_jpegs, config)
+            if self.params.get('watch', False):
+                # start watching before the scan to avoid missing files written during the scan
+                self.start_watch()
+            scanner = ImageScanner(self.params['image_sets'], self.params['filters'], self.params['ext'],
+                                   self.params['recursive'], use_index=True,
+                                   rescan=self.params.get('rescan', False))
+            # rows are added to the table while the image sets are scanned
+            fill_table_data.CreateTableFromScanner(self, scanner, config)
+            self._incomplete_rows = scanner.incomplete_rows
+            if self.set_watcher is not None:
+                self.set_watcher.start_notifications()
             if self.params['report'] and self.table_widget:
-                self.table_widget.read_report(self.params['report'], self.statusBar(), self.setProgress)
+                self.read_report(self.params['report'])
+            self.build_thumbnails()
+
+    def build_thumbnails(self):
+        """ Add the missing thumbnails of the table images in the background, in the table priority order """
+        if self.thumbnail_builder is None or self.table_widget is None:
+            return
+        filenames = []
+        for row in prioritized_row_ids(self.table_widget):
+            row_data = self.useful_data.get(row, dict())
+            filenames.extend(row_data[im] for im in self.image_list if im != 'none' and row_data.get(im))
+        self.thumbnail_builder.start(filenames)
+
+    def close_thumbnails(self):
+        self.thumbnail_builder.cancel()
+        self.thumbnail_store.close()
+
+    def start_watch(self):
+        """ Watch the image set directories for new or modified images """
+        self.stop_watch()
+        self.set_watcher = SetWatcher(self.params['image_sets'], self.params['filters'], self.params['ext'],
+                                      self.params['recursive'], parent=self)
+        self.set_watcher.filesChanged.connect(self.on_watched_files_changed)
+        self.set_watcher.start()
+
+    def stop_watch(self):
+        if self.set_watcher is not None:
+            self.set_watcher.stop()
+            self.set_watcher = None
+
+    def on_watched_files_changed(self, changes):
+        """
+        Add the new complete rows and refresh the rows whose images changed
+        :param changes: list of (set_index, row_id, filename)
+        """
+        nb_sets = len(self.params['image_sets'])
+        new_rows = []
+        updated_rows = set()
+        for set_index, _row_id, filename in changes:
+            if _row_id in self.useful_data:
+                self.useful_data[_row_id][self.image_list[set_index+1]] = filename
+                updated_rows.add(_row_id)
+            else:
+                files = self._incomplete_rows.setdefault(_row_id, [None]*nb_sets)
+                files[set_index] = filename
+                if all(f is not None for f in files):
+                    new_rows.append((_row_id, self._incomplete_rows.pop(_row_id)))
+        if new_rows:
+            fill_table_data.AddTableRows(self, new_rows, self.config, self.useful_data)
+        if updated_rows:
+            for _row_id in updated_rows:
+                for im in self.image_list:
+                    filename = self.useful_data[_row_id].get(im, '')
+                    if im != 'none' and filename:
+                        filename = os.path.abspath(filename)
+                        self.file_cache.remove(filename)
+                        self.image_cache.remove(filename)
+            self.table_widget.invalidate_row_metrics(updated_rows)
+            if getattr(self.table_widget, '_row_id', None) in updated_rows and self.multiview is not None:
+                self.multiview.update_image(reload=True)
+        self.statusBar().showMessage(f" Watch: {len(new_rows)} new rows, {len(updated_rows)} updated rows")
 
     def set_default_report_file(self, filename):
         print(" set_default_report_file {0}".format(filename))
@@ -379,17 +636,32 @@ class ImCompWindow(QtWidgets.QMainWindow):
 
     def read_file(self):
         fname = QtWidgets.QFileDialog.getOpenFileName(None, 'Read contents from file',
-                                                  self.default_report_file, 'Json (*.json)')
-        self.read_report(fname[0])
+                                                  self.table_widget.default_report_file, 'Json (*.json *.json.gz)')
+        if fname[0]:
+            self.read_report(fname[0])
 
     def reload(self):
-        self.fill_data()
+        self.fill_data(self.config)
 
     def read_report(self, filename):
-        import os
+        """ Parse the report on a worker thread, the table is filled when parsing is done """
         self.statusBar().showMessage(" Reading report {0}".format(os.path.basename(filename)))
-        data = fill_table_data.readJson(filename)
-        self.table_widget.read_report(data, self.statusBar(), self.setProgress)
+        self._report_data = None
+        self._report_pool.set_worker(parse_report, filename, list(self.table_widget.column_list))
+        self._report_pool.set_worker_callbacks(progress_cb=self.setProgress, finished_cb=self.report_parsed,
+                                               result_cb=self.set_report_data)
+        self._report_pool.start_worker()
+
+    def set_report_data(self, report_data):
+        # called from the worker thread
+        self._report_data = report_data
+
+    def report_parsed(self):
+        if self._report_data is None:
+            self.statusBar().showMessage(" Failed to read report")
+            return
+        self.table_widget.apply_report(self._report_data, self.statusBar(), self.setProgress)
+        self._report_data = None
 
     def write_file(self, selected_rows=None, save_folder=None):
         self.table_widget.write_file(self.params, selected_rows, save_folder)
@@ -406,14 +678,39 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.useful_data = useful_data
 
     def load_files_in_cache(self):
-        # start reading in the cache file ?
+        """ Read the image files into the file cache: selected rows first, then visible rows, then the table order """
         filename_list = []
-        for row in self.useful_data:
+        for row in prioritized_row_ids(self.table_widget):
+            row_data = self.useful_data.get(row, dict())
             for im in self.image_list:
-                if im != 'none':
-                    filename_list.append(self.useful_data[row][im])
+                if im != 'none' and row_data.get(im):
+                    filename_list.append(row_data[im])
         print(f"ImCompWindow.load_files_in_cache() {len(filename_list)} files")
-        self.file_cache.add_files(filename_list)
+        # the loader starts from the current cache size
+        self.file_cache.check_size_limit()
+        self.cache_loader.start(filename_list)
+        self.action_load_files_in_cache.setEnabled(False)
+        self.action_cancel_files_loading.setEnabled(True)
+        self._cache_loader_timer.start()
+
+    def cancel_files_loading(self):
+        if self.cache_loader.running():
+            self.cache_loader.cancel()
+            self.update_cache_loading()
+
+    def update_cache_loading(self):
+        """ Show the progress of the files loading, in the cache menu and the status bar """
+        loader = self.cache_loader
+        if loader.running():
+            self.action_load_files_in_cache.setText(f'Loading files in cache {loader.progress()}%')
+            self.statusBar().showMessage(f" Loading files in cache: {loader.summary()}")
+            return
+        self._cache_loader_timer.stop()
+        self.action_load_files_in_cache.setText('Load files in cache')
+        self.action_load_files_in_cache.setEnabled(self.action_file_cache_enabled.isChecked())
+        self.action_cancel_files_loading.setEnabled(False)
+        self.file_cache.check_size_limit(update_progress=True)
+        self.statusBar().showMessage(f" Files in cache: {loader.summary()}")
 
     def setAllData(self, all_data):
         self.all_data = all_data
@@ -459,6 +756,22 @@ class ImCompWindow(QtWidgets.QMainWindow):
         widget = QtWidgets.QApplication.instance().widgetAt(QtGui.QCursor.pos())
         if widget: widget.setFocus()
 
+    def schedule_prefetch(self, *args):
+        QtCore.QTimer.singleShot(0, self.prefetch_rows)
+
+    def row_filenames(self, row):
+        """ Image filenames of a row in the table order """
+        item = self.table_widget.item(row, 0)
+        row_data = self.useful_data.get(item.text(), dict()) if item is not None else dict()
+        return [row_data[im] for im in self.image_list if im != 'none' and row_data.get(im)]
+
+    def prefetch_rows(self):
+        """ Read the rows next to the current row into the caches """
+        if self.table_widget is None or self.multiview is None:
+            return
+        self.prefetcher.update(self.table_widget.previous_row, self.table_widget.rowCount(), self.row_filenames,
+                               self.multiview.read_size, use_RGB=not self.multiview.use_opengl)
+
     def set_previous_row(self):
         self.table_widget.selectRow(max(0,self.table_widget.previous_row-1))
         # Set focus to widget under cursor
@@ -824,7 +1137,48 @@ class ImCompWindow(QtWidgets.QMainWindow):
         self.progressBar.setValue(progress)
 
     def compute_image_differences(self):
-        self.table_widget.compute_image_differences_thread(self.setProgress, self.statusBar())
+        options = (self.config.get('diff_options') if self.config else None) or dict()
+        # image sets of image_list, without the input image, the registered differences and the heatmaps
+        image_names = [im for im in self.image_list[1:] if im not in self.image1 and im not in self.heatmap_names]
+        config_pairs = [(diff_name, self.image1[diff_name], self.image2[diff_name]) for diff_name in self.image1]
+        pairs = difference_pairs(image_names, config_pairs, options.get('mode', 'config'), options.get('reference'))
+        if options.get('heatmaps', False):
+            # the heatmap of each pair is shown as an image named as the pair
+            for diff_name, _, _ in pairs:
+                if diff_name not in self.image_list:
+                    self.image_list.append(diff_name)
+                    self.heatmap_names.add(diff_name)
+        self.table_widget.compute_image_differences_thread(self.setProgress, self.statusBar(), pairs, options)
+
+    def running_differences(self):
+        """ Difference thread of the table if it is running, else None """
+        worker = self.table_widget.differences_worker if self.table_widget else None
+        if worker is None or not worker.isRunning():
+            self.statusBar().showMessage(" No image differences running")
+            return None
+        return worker
+
+    def pause_image_differences(self):
+        worker = self.running_differences()
+        if worker:
+            worker.pause()
+
+    def resume_image_differences(self):
+        """
+        Resume a paused run, or restart a cancelled one: the rows already computed are read from the metric cache
+        """
+        worker = self.table_widget.differences_worker if self.table_widget else None
+        if worker is not None and worker.isRunning():
+            worker.resume()
+        elif worker is not None and worker.cancelled:
+            self.compute_image_differences()
+        else:
+            self.statusBar().showMessage(" No image differences to resume")
+
+    def cancel_image_differences(self):
+        worker = self.running_differences()
+        if worker:
+            worker.cancel()
 
     def update_colors(self):
         """
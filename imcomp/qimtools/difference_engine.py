@@ -0,0 +1,447 @@
+"""
+Image difference engine running on a process pool
+
+Rows are split in chunks of chunk_size rows, each chunk is decoded, resized and compared by a worker
+process with OpenCV and the metric kernel, and the results of a chunk are returned together. When a
+MetricCache is given, only the rows with values missing from the cache are sent to the workers; since
+the cache is written after each chunk, it is also the checkpoint from which a cancelled or interrupted
+run resumes.
+
+The engine can also write a small color heatmap of the per pixel difference of each pair, as a PNG file
+named from the identity of the two images, so that an existing heatmap is never computed again.
+
+This module does not depend on Qt, ProcessImageDifferences runs it from a QThread and forwards the
+results to the table.
+"""
+
+import os
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .metrics import METRICS, get_kernel, peak_value
+from .metric_cache import MetricCache, file_identity
+
+
+# OpenCV flags of the reduced JPEG decoding, color and grayscale, by scale factor
+_REDUCED_FLAGS = {
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+def jpeg_header(filename: str) -> Optional[Tuple[int, int, int]]:
+    '''
+    Read the frame header of a JPEG file without decoding it
+    :return: (width, height, number of components), None if the file is not a JPEG image
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            # padding bytes
+            while marker[1] == 0xFF:
+                marker = marker[1:] + f.read(1)
+            code = marker[1]
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            size = int.from_bytes(length, 'big')
+            # start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                header = f.read(6)
+                if len(header) < 6:
+                    return None
+                height = int.from_bytes(header[1:3], 'big')
+                width = int.from_bytes(header[3:5], 'big')
+                return width, height, header[5]
+            f.seek(size-2, 1)
+
+
+def reduced_scale(image_width: int, width: int) -> int:
+    ''' Largest JPEG decoding scale (1, 2, 4 or 8) that keeps at least width pixels '''
+    for scale in (8, 4, 2):
+        if image_width//scale >= width:
+            return scale
+    return 1
+
+
+def read_resized(filename: str, width: int, reduced: bool = True) -> np.ndarray:
+    '''
+    Read an image with OpenCV and resize it to the given width, keeping the aspect ratio
+    :param filename: image file
+    :param width: output width in pixels
+    :param reduced: decode JPEG images at the smallest DCT scale that is still at least width pixels wide
+    '''
+    image = None
+    # (height, width) of the full image
+    size = None
+    if reduced:
+        header = jpeg_header(filename)
+        if header is not None:
+            size = header[1], header[0]
+            scale = reduced_scale(header[0], width)
+            if scale > 1:
+                # as with IMREAD_UNCHANGED, the EXIF orientation is not applied
+                image = cv2.imread(filename, _REDUCED_FLAGS[scale][1 if header[2] == 1 else 0] |
+                                   cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"Failed to read image {filename}")
+    # the height is computed from the full image: the reduced decoding rounds the size up,
+    # and the image would not have the height of the same image in another format
+    if size is None:
+        size = image.shape[:2]
+    height = max(1, int(width * size[0] / size[1]))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def difference_pairs(image_names: List[str], config_pairs: List[Tuple[str, str, str]], mode: str = 'config',
+                     reference: Optional[str] = None) -> List[Tuple[str, str, str]]:
+    '''
+    Image pairs to compare
+    :param image_names: names of the image sets
+    :param config_pairs: list of (diff_name, image1, image2) registered from config['diff']
+    :param mode: 'config' for the configured pairs, 'reference' to compare a reference set with all the others,
+        the reference mode is also used when no pair is configured
+    :param reference: name of the reference set, the first set by default
+    :return: list of (diff_name, image1, image2)
+    '''
+    if mode == 'config' and config_pairs:
+        return list(config_pairs)
+    if not image_names:
+        return []
+    if reference not in image_names:
+        reference = image_names[0]
+    return [(f'{reference}-{name}', reference, name) for name in image_names if name != reference]
+
+
+def difference_tasks(row_ids, useful_data, images):
+    '''
+    Input of the difference engine, built by the table or by imcomp-batch
+    :param row_ids: unique names of the rows to compute
+    :param useful_data: dictionary row_id -> {image name: filename}
+    :param images: names of the images used by the pairs
+    :return: list of (unique_name, {image name: filename})
+    '''
+    tasks = []
+    for row_id in row_ids:
+        row_data = useful_data.get(row_id, dict())
+        tasks.append((row_id, {name: row_data.get(name, '') for name in images}))
+    return tasks
+
+
+def write_heatmap(im1: np.ndarray, im2: np.ndarray, filename: str, width: int, gain: float) -> None:
+    '''
+    Write the per pixel absolute difference (maximum over the channels) as a jet colored PNG image
+    :param im1: first image
+    :param im2: second image, same shape as im1
+    :param filename: PNG file to write
+    :param width: heatmap width, at most the image width
+    :param gain: the difference is multiplied by gain, relative to the 8 bit range, before the color mapping
+    '''
+    diff = cv2.absdiff(im1, im2)
+    if diff.ndim == 3:
+        diff = diff.max(axis=2)
+    diff = np.clip(diff.astype(np.float32)*(gain*255/peak_value(im1)), 0, 255).astype(np.uint8)
+    width = min(width, diff.shape[1])
+    height = max(1, int(width * diff.shape[0] / diff.shape[1]))
+    heatmap = cv2.applyColorMap(cv2.resize(diff, (width, height), interpolation=cv2.INTER_AREA), cv2.COLORMAP_JET)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # write then rename, the same heatmap can be requested by two runs
+    tmp_filename = f'{filename}.{os.getpid()}.png'
+    cv2.imwrite(tmp_filename, heatmap)
+    os.replace(tmp_filename, filename)
+
+
+# set when the run is cancelled, the worker processes get it from _init_worker()
+_worker_cancel = None
+
+
+def _init_worker(cancel_event) -> None:
+    global _worker_cancel
+    _worker_cancel = cancel_event
+
+
+def compute_chunk(tasks: List[Tuple[str, Dict[str, str]]], pairs: List[Tuple[str, str, str]],
+                  width: int, metrics: List[str], threshold: float, reduced: bool = True,
+                  heatmaps: Optional[Dict[str, List[Optional[str]]]] = None,
+                  heatmap_params: Tuple[int, float] = (256, 4)) -> List[Tuple[str, List[float]]]:
+    '''
+    Worker function: compute the differences of a chunk of rows
+    Each image of a row is decoded and resized once, and shared by all the pairs that use it.
+    When the run is cancelled, the chunk stops after the current row.
+    :param tasks: list of (unique_name, {image name: filename})
+    :param pairs: list of (diff_name, image1, image2)
+    :param metrics: metric ids computed for each pair
+    :param threshold: threshold of the 'above' metric
+    :param reduced: use the reduced JPEG decoding, see read_resized()
+    :param heatmaps: optional {unique_name: heatmap filename of each pair}, existing heatmaps are not written again
+    :param heatmap_params: heatmap width and gain, see write_heatmap()
+    :return: list of (unique_name, values), values are ordered by pair then by metric,
+        NaN when the images cannot be compared
+    '''
+    kernel = get_kernel(metrics, threshold)
+    results = []
+    for unique_name, filenames in tasks:
+        if _worker_cancel is not None and _worker_cancel.is_set():
+            break
+        images = dict()
+        differences = []
+        row_heatmaps = heatmaps.get(unique_name) if heatmaps else None
+        for pair_index, (diff_name, image1, image2) in enumerate(pairs):
+            try:
+                for name in (image1, image2):
+                    if name not in images:
+                        # a failed decode is not retried for the next pairs
+                        images[name] = None
+                        images[name] = read_resized(filenames[name], width, reduced)
+                if images[image1] is None or images[image2] is None:
+                    raise IOError("missing image")
+                differences.extend(kernel.compute(images[image1], images[image2]))
+                if row_heatmaps and row_heatmaps[pair_index] and not os.path.isfile(row_heatmaps[pair_index]):
+                    write_heatmap(images[image1], images[image2], row_heatmaps[pair_index], *heatmap_params)
+            except Exception as e:
+                print(f"Failed to compute difference {diff_name} of {unique_name}: {e}")
+                differences.extend([float('nan')]*len(metrics))
+        results.append((unique_name, differences))
+    return results
+
+
+class DifferenceEngine:
+    """
+        Compute image differences on a pool of worker processes
+    """
+    def __init__(self, pairs: List[Tuple[str, str, str]], metrics: Optional[List[str]] = None, threshold: float = 10,
+                 max_workers: Optional[int] = None, chunk_size: int = 8, width: int = 1000,
+                 start_method: str = 'spawn', cache: Optional[MetricCache] = None, reduced_decode: bool = True,
+                 heatmap_folder: Optional[str] = None, heatmap_width: int = 256, heatmap_gain: float = 4):
+        '''
+        :param pairs: list of (diff_name, image1, image2) compared for each row
+        :param metrics: metric ids computed for each pair, see metrics.METRICS, ['mae'] by default
+        :param threshold: absolute error threshold of the 'above' metric
+        :param max_workers: number of worker processes, the number of cores if None or 0
+        :param chunk_size: number of rows processed by a worker task
+        :param width: width of the resized images that are compared
+        :param start_method: multiprocessing start method, spawn avoids forking the threads of the GUI
+        :param cache: optional cache of the metric values
+        :param reduced_decode: decode JPEG images at a reduced scale when it is still larger than width
+        :param heatmap_folder: folder of the difference heatmaps, no heatmap is computed if None
+        :param heatmap_width: width of the heatmaps
+        :param heatmap_gain: gain applied to the differences in the heatmaps
+        '''
+        self.pairs = pairs
+        metrics = metrics or ['mae']
+        unknown = [m for m in metrics if m not in METRICS]
+        if unknown:
+            print(f"Unknown metrics {unknown} are ignored, available metrics are {list(METRICS)}")
+        self.metrics = [m for m in metrics if m in METRICS] or ['mae']
+        self.threshold = threshold
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self.width = width
+        self.start_method = start_method
+        self.cache = cache
+        self.reduced_decode = reduced_decode
+        self.heatmap_folder = heatmap_folder
+        self.heatmap_width = heatmap_width
+        self.heatmap_gain = heatmap_gain
+        # unique_name -> heatmap filename of each pair, for the rows of the current run
+        self.heatmaps: Dict[str, List[Optional[str]]] = dict()
+        # run control, set from another thread
+        self._resume = threading.Event()
+        self._resume.set()
+        self._cancel = threading.Event()
+
+    @classmethod
+    def from_options(cls, pairs: List[Tuple[str, str, str]], options: Optional[Dict[str, Any]],
+                     default_name: Optional[str] = None) -> 'DifferenceEngine':
+        '''
+        Engine from the diff_options entry of the configuration file
+        :param default_name: prefix of the cache database (<name>_metrics.sqlite) and of the heatmap folder
+            (<name>_heatmaps) when the options do not set 'cache_file' and 'heatmap_folder'
+        '''
+        options = options or dict()
+        cache = None
+        if options.get('cache', True):
+            cache_file = options.get('cache_file') or (default_name and default_name+'_metrics.sqlite')
+            if cache_file:
+                cache = MetricCache(cache_file)
+        heatmap_folder = None
+        if options.get('heatmaps', False):
+            heatmap_folder = options.get('heatmap_folder') or (default_name and default_name+'_heatmaps')
+        return cls(pairs, metrics=options.get('metrics'), threshold=options.get('threshold', 10),
+                   max_workers=options.get('max_workers'), chunk_size=options.get('chunk_size', 8),
+                   width=options.get('width', 1000), cache=cache,
+                   reduced_decode=options.get('reduced_decode', True), heatmap_folder=heatmap_folder,
+                   heatmap_width=options.get('heatmap_width', 256), heatmap_gain=options.get('heatmap_gain', 4))
+
+    def pause(self) -> None:
+        ''' Stop submitting chunks, the chunks already submitted are still returned '''
+        self._resume.clear()
+
+    def resume(self) -> None:
+        self._resume.set()
+
+    def cancel(self) -> None:
+        ''' Stop the run, the pending chunks are dropped '''
+        self._cancel.set()
+        self._resume.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def column_names(self) -> List[str]:
+        ''' Result column of each value, ordered by pair then by metric '''
+        return [f'{diff_name}:{metric}' for diff_name, _, _ in self.pairs for metric in self.metrics]
+
+    def images(self) -> List[str]:
+        ''' Names of the images used by the pairs '''
+        return list(dict.fromkeys(name for _, image1, image2 in self.pairs for name in (image1, image2)))
+
+    def metric_params(self, metric: str) -> str:
+        ''' Parameters that change the value of a metric, part of the cache keys '''
+        params = f'width={self.width}'
+        if self.reduced_decode:
+            params += ',reduced'
+        if metric == 'above':
+            params += f',threshold={self.threshold}'
+        return params
+
+    def identities(self, filenames: Dict[str, str]) -> Dict[str, Optional[str]]:
+        ''' File identity of each image of a row, None for missing images '''
+        return {name: file_identity(filenames.get(name, '')) for name in self.images()}
+
+    def heatmap_paths(self, identities: Dict[str, Optional[str]]) -> List[Optional[str]]:
+        ''' Heatmap filename of each pair of a row, None when an image is missing '''
+        paths = []
+        for _, image1, image2 in self.pairs:
+            if identities[image1] is None or identities[image2] is None:
+                paths.append(None)
+                continue
+            key = f'{identities[image1]}#{identities[image2]}#{self.metric_params("")}' \
+                  f'#{self.heatmap_width},{self.heatmap_gain}'
+            paths.append(os.path.join(self.heatmap_folder, hashlib.sha1(key.encode()).hexdigest()+'.png'))
+        return paths
+
+    def cache_keys(self, identities: Dict[str, Optional[str]]) -> List[Optional[str]]:
+        ''' Cache key of each value of a row, None when an image is missing '''
+        keys = []
+        for _, image1, image2 in self.pairs:
+            for metric in self.metrics:
+                if identities[image1] is None or identities[image2] is None:
+                    keys.append(None)
+                else:
+                    keys.append(MetricCache.key(identities[image1], identities[image2], metric,
+                                                self.metric_params(metric)))
+        return keys
+
+    def read_cache(self, tasks: List[Tuple[str, Dict[str, str]]], identities: Dict[str, Dict[str, Optional[str]]]):
+        '''
+        Split the tasks between the rows found in the cache and the rows to compute
+        The values of a pair with a missing image have no key: they are NaN without any lookup, so that
+        these rows are neither computed again nor counted as misses.
+        :param identities: {unique_name: file identities of the row}
+        :return: (results of the cached rows, tasks to compute, {unique_name: cache keys} of the tasks to compute)
+        '''
+        row_keys = {unique_name: self.cache_keys(identities[unique_name]) for unique_name, _ in tasks}
+        found = self.cache.lookup([key for keys in row_keys.values() for key in keys if key is not None])
+        found[None] = float('nan')
+        cached = []
+        remaining = []
+        for task in tasks:
+            keys = row_keys[task[0]]
+            heatmaps = self.heatmaps.get(task[0], [])
+            if all(key in found for key in keys) and all(path is None or os.path.isfile(path) for path in heatmaps):
+                cached.append((task[0], [found[key] for key in keys]))
+                del row_keys[task[0]]
+            else:
+                remaining.append(task)
+        return cached, remaining, row_keys
+
+    def write_cache(self, results: List[Tuple[str, List[float]]], row_keys: Dict[str, List[Optional[str]]]) -> None:
+        ''' Store the computed values, the failures (NaN) are not stored '''
+        values = dict()
+        for unique_name, row_values in results:
+            for key, value in zip(row_keys[unique_name], row_values):
+                if key is not None and not np.isnan(value):
+                    values[key] = value
+        self.cache.store(values)
+
+    def run(self, tasks: List[Tuple[str, Dict[str, str]]]):
+        '''
+        Generator over the results, in completion order
+        At most two chunks per worker are submitted at a time. The cached rows are returned first, in one list.
+        :param tasks: list of (unique_name, {image name: filename})
+        :return: yields lists of (unique_name, values in the order of column_names()), one list per chunk
+        '''
+        if self.cache is None and self.heatmap_folder is None:
+            yield from self._compute(tasks)
+            return
+        identities = {unique_name: self.identities(filenames) for unique_name, filenames in tasks}
+        if self.heatmap_folder is not None:
+            self.heatmaps = {unique_name: self.heatmap_paths(identities[unique_name]) for unique_name, _ in tasks}
+        if self.cache is None:
+            yield from self._compute(tasks)
+            return
+        try:
+            cached, tasks, row_keys = self.read_cache(tasks, identities)
+            if cached:
+                yield cached
+            for results in self._compute(tasks):
+                self.write_cache(results, row_keys)
+                yield results
+        finally:
+            self.cache.close()
+        print(self.cache.summary())
+
+    def _compute(self, tasks: List[Tuple[str, Dict[str, str]]]):
+        chunks = [tasks[pos:pos+self.chunk_size] for pos in range(0, len(tasks), self.chunk_size)]
+        if not chunks:
+            return
+        context = multiprocessing.get_context(self.start_method)
+        worker_cancel = context.Event()
+        executor = ProcessPoolExecutor(max_workers=min(self.max_workers, len(chunks)), mp_context=context,
+                                       initializer=_init_worker, initargs=(worker_cancel,))
+        try:
+            next_chunk = 0
+            pending = set()
+            while next_chunk < len(chunks) or pending:
+                if self.cancelled:
+                    # the running chunks stop after their current row
+                    worker_cancel.set()
+                    break
+                while not self.paused and next_chunk < len(chunks) and len(pending) < 2*self.max_workers:
+                    chunk = chunks[next_chunk]
+                    heatmaps = {unique_name: self.heatmaps[unique_name] for unique_name, _ in chunk
+                                if unique_name in self.heatmaps}
+                    pending.add(executor.submit(compute_chunk, chunk, self.pairs, self.width, self.metrics,
+                                                self.threshold, self.reduced_decode, heatmaps,
+                                                (self.heatmap_width, self.heatmap_gain)))
+                    next_chunk += 1
+                if not pending:
+                    # paused
+                    self._resume.wait(0.1)
+                    continue
+                # the timeout lets a cancel stop the run without waiting for the pending chunks
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # after a cancel, the pending chunks are dropped and the running chunks are not waited for
+            executor.shutdown(wait=not self.cancelled, cancel_futures=True)
@@ -0,0 +1,76 @@
+"""
+On-disk cache of the image comparison metrics
+
+Values are stored in a SQLite table, keyed by the identity of both images (path, size, modification time),
+the metric id and the parameters that change its value (resize width, threshold, ...). A modified image
+gets a new key, so that its pairs are computed again while the other rows are read from the cache.
+"""
+
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+
+def file_identity(filename: str) -> Optional[str]:
+    ''' path|size|mtime of a file, None if the file does not exist '''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return f'{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+class MetricCache:
+    """
+        Metric values of image pairs stored in a SQLite database
+        The connection is opened on first use, by the thread that uses the cache.
+    """
+    # number of keys per SELECT
+    _batch_size = 500
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._connection: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(identity1: str, identity2: str, metric: str, params: str) -> str:
+        return f'{identity1}#{identity2}#{metric}#{params}'
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS metrics (key TEXT PRIMARY KEY, value REAL) '
+                                     'WITHOUT ROWID')
+        return self._connection
+
+    def lookup(self, keys: List[str]) -> Dict[str, float]:
+        '''
+        Read the cached values, updates the hit and miss counts
+        :return: dictionary key -> value for the keys found in the cache
+        '''
+        connection = self._connect()
+        found = dict()
+        for pos in range(0, len(keys), self._batch_size):
+            batch = keys[pos:pos+self._batch_size]
+            query = 'SELECT key, value FROM metrics WHERE key IN ({})'.format(','.join('?'*len(batch)))
+            found.update(connection.execute(query, batch).fetchall())
+        self.hits += len(found)
+        self.misses += len(keys)-len(found)
+        return found
+
+    def store(self, values: Dict[str, float]) -> None:
+        ''' Write the values of a dictionary key -> value '''
+        if values:
+            connection = self._connect()
+            connection.executemany('INSERT OR REPLACE INTO metrics (key, value) VALUES (?, ?)', values.items())
+            connection.commit()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def summary(self) -> str:
+        return f'metric cache: {self.hits} hits, {self.misses} misses'
@@ -0,0 +1,158 @@
+"""
+Image comparison metrics
+
+MetricKernel computes the requested metrics of a pair of images of the same size. The absolute
+difference is computed once and shared by MAE, RMSE, PSNR, max abs and percent above threshold, and
+the float32 buffers are kept from one pair to the next as long as the image shape does not change,
+so that a worker comparing many rows does not reallocate them.
+"""
+
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+
+# metric id -> description, used for the column tooltips and the configuration
+METRICS = {
+    'mae':     'mean absolute error',
+    'rmse':    'root mean square error',
+    'psnr':    'peak signal to noise ratio in dB, capped at 100 dB for identical images',
+    'ssim':    'structural similarity, gaussian window of size 11 and sigma 1.5',
+    'max_abs': 'maximal absolute error',
+    'above':   'percent of pixel values whose absolute error is above the threshold',
+    'hist':    'Bhattacharyya distance of the per channel histograms, averaged over the channels',
+}
+
+PSNR_MAX = 100.0
+
+
+def peak_value(image: np.ndarray) -> float:
+    ''' Maximal value of the image type, used by PSNR and SSIM '''
+    if np.issubdtype(image.dtype, np.integer):
+        return float(np.iinfo(image.dtype).max)
+    return 1.0
+
+
+class MetricKernel:
+    """
+        Compute several metrics of image pairs, reusing its buffers across calls
+    """
+    def __init__(self, metrics: List[str], threshold: float = 10):
+        '''
+        :param metrics: metric ids, see METRICS
+        :param threshold: absolute error threshold of the 'above' metric
+        '''
+        for metric in metrics:
+            if metric not in METRICS:
+                raise ValueError(f"Unknown metric {metric}, available metrics are {list(METRICS)}")
+        self.metrics = list(metrics)
+        self.threshold = threshold
+        self._shape = None
+        self._buffers: Dict[str, np.ndarray] = dict()
+
+    def _buffer(self, name: str, shape, dtype=np.float32) -> np.ndarray:
+        if self._shape != shape:
+            self._shape = shape
+            self._buffers = dict()
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def compute(self, im1: np.ndarray, im2: np.ndarray) -> List[float]:
+        '''
+        :param im1: first image
+        :param im2: second image, same shape and type as im1
+        :return: values in the order of self.metrics
+        '''
+        if im1.shape != im2.shape:
+            raise ValueError(f"Image shapes differ {im1.shape} {im2.shape}")
+        shape = im1.shape
+        peak = peak_value(im1)
+        a = self._buffer('a', shape)
+        b = self._buffer('b', shape)
+        np.copyto(a, im1, casting='unsafe')
+        np.copyto(b, im2, casting='unsafe')
+        res = dict()
+        if {'mae', 'rmse', 'psnr', 'max_abs', 'above'} & set(self.metrics):
+            diff = self._buffer('diff', shape)
+            np.subtract(a, b, out=diff)
+            np.abs(diff, out=diff)
+            res['mae'] = float(diff.mean())
+            res['max_abs'] = float(diff.max())
+            if 'above' in self.metrics:
+                above = self._buffer('above', shape, np.bool_)
+                np.greater(diff, self.threshold, out=above)
+                res['above'] = float(np.count_nonzero(above)*100/above.size)
+            if 'rmse' in self.metrics or 'psnr' in self.metrics:
+                np.multiply(diff, diff, out=diff)
+                mse = float(diff.mean())
+                res['rmse'] = float(np.sqrt(mse))
+                res['psnr'] = PSNR_MAX if mse == 0 else min(PSNR_MAX, float(10*np.log10(peak*peak/mse)))
+        if 'ssim' in self.metrics:
+            res['ssim'] = self._ssim(a, b, peak)
+        if 'hist' in self.metrics:
+            res['hist'] = self._histogram_distance(im1, im2, peak)
+        return [res[m] for m in self.metrics]
+
+    def _ssim(self, a: np.ndarray, b: np.ndarray, peak: float) -> float:
+        ''' Mean SSIM over the pixels and the channels '''
+        shape = a.shape
+        c1 = (0.01*peak)**2
+        c2 = (0.03*peak)**2
+        mu1 = self._buffer('mu1', shape)
+        mu2 = self._buffer('mu2', shape)
+        tmp = self._buffer('tmp', shape)
+        s = self._buffer('s', shape)
+        cv2.GaussianBlur(a, (11, 11), 1.5, dst=mu1)
+        cv2.GaussianBlur(b, (11, 11), 1.5, dst=mu2)
+        # numerator: (2 mu1 mu2 + c1) (2 sigma12 + c2)
+        np.multiply(a, b, out=tmp)
+        cv2.GaussianBlur(tmp, (11, 11), 1.5, dst=s)
+        np.multiply(mu1, mu2, out=tmp)
+        np.subtract(s, tmp, out=s)
+        np.multiply(s, 2, out=s)
+        np.add(s, c2, out=s)
+        np.multiply(tmp, 2, out=tmp)
+        np.add(tmp, c1, out=tmp)
+        num = self._buffer('num', shape)
+        np.multiply(tmp, s, out=num)
+        # denominator: (mu1^2 + mu2^2 + c1) (sigma1^2 + sigma2^2 + c2)
+        np.multiply(a, a, out=tmp)
+        cv2.GaussianBlur(tmp, (11, 11), 1.5, dst=s)
+        np.multiply(b, b, out=tmp)
+        np.add(s, cv2.GaussianBlur(tmp, (11, 11), 1.5, dst=tmp), out=s)
+        np.multiply(mu1, mu1, out=mu1)
+        np.multiply(mu2, mu2, out=mu2)
+        np.add(mu1, mu2, out=mu1)
+        np.subtract(s, mu1, out=s)
+        np.add(s, c2, out=s)
+        np.add(mu1, c1, out=mu1)
+        np.multiply(mu1, s, out=s)
+        np.divide(num, s, out=num)
+        return float(num.mean())
+
+    @staticmethod
+    def _histogram_distance(im1: np.ndarray, im2: np.ndarray, peak: float) -> float:
+        nb_channels = 1 if im1.ndim == 2 else im1.shape[2]
+        distances = []
+        for channel in range(nb_channels):
+            hists = []
+            for image in (im1, im2):
+                if image.dtype not in (np.uint8, np.uint16, np.float32):
+                    image = image.astype(np.float32)
+                hists.append(cv2.calcHist([image], [channel], None, [256], [0, peak+1e-6]))
+            distances.append(cv2.compareHist(hists[0], hists[1], cv2.HISTCMP_BHATTACHARYYA))
+        return float(np.mean(distances))
+
+
+_kernel: Optional[MetricKernel] = None
+
+
+def get_kernel(metrics: List[str], threshold: float) -> MetricKernel:
+    ''' Kernel of the current process, kept between calls to reuse its buffers '''
+    global _kernel
+    if _kernel is None or _kernel.metrics != metrics or _kernel.threshold != threshold:
+        _kernel = MetricKernel(metrics, threshold)
+    return _kernel
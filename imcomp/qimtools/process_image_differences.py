@@ -1,92 +1,85 @@
-from qimview.utils.qt_imports import QtWidgets, QtCore, QtGui
-from qimview.utils.utils import get_time
-
-from qimview.image_readers import gb_image_reader
+import os
 
-import cv2
-import numpy as np
+from qimview.utils.qt_imports import QtCore
+from qimview.utils.utils import get_time
 
 
-# Numeric item to allow better sorting of cells
-class NumericItem(QtWidgets.QTableWidgetItem):
-    def __lt__(self, other):
-        return self.data(QtCore.Qt.UserRole) < other.data(QtCore.Qt.UserRole)
+def register_heatmaps(useful_data, engine, results):
+    '''
+    Add the heatmaps written for a batch of results to useful_data, named as their pair, so that the viewers
+    display them with the images of the row
+    '''
+    for unique_name, _ in results:
+        heatmaps = engine.heatmaps.get(unique_name)
+        if heatmaps and unique_name in useful_data:
+            for (diff_name, _, _), heatmap in zip(engine.pairs, heatmaps):
+                if heatmap and os.path.isfile(heatmap):
+                    useful_data[unique_name][diff_name] = heatmap
 
 
 class ProcessImageDifferences(QtCore.QThread):
+    """
+        Run the difference engine, the thread only computes: the results are sent to the table in batches
+        through the resultsReady signal, keyed by unique name so that the table can be sorted during the run
+    """
     # This is the signal that will be emitted during the processing.
     # By including int as an argument, it lets the signal know to expect
     # an integer argument when emitting.
     updateProgress = QtCore.Signal(int)
+    # status bar message with the throughput
+    updateStatus = QtCore.Signal(str)
+    # list of (unique_name, values in the order of engine.column_names())
+    resultsReady = QtCore.Signal(object)
+    # minimal delay between two batches of results, in seconds
+    batch_delay = 0.05
 
-    def __init__(self, tw, statusBar, setProgress):
+    def __init__(self, engine, tasks):
+        '''
+        :param engine: DifferenceEngine with the pairs and metrics to compute
+        :param tasks: list of (unique_name, {image name: filename}), see difference_tasks()
+        '''
         QtCore.QThread.__init__(self)
-        self.column = -1
         self.time_start = get_time()
-        # Table Window to update
-        self.tw = tw
-        self.statusBar = statusBar
-        self.setProgress = setProgress
+        self.engine = engine
+        self.tasks = tasks
+        self.nb_done = 0
 
     def __del__(self):
         self.wait()
 
-    def run(self):
-        print("ProcessDifferences run")
-        # Is the display on the statusBar crashing sometimes ?
-        # self.tw.statusBar().showMessage(" Processing image differences")
-        # Compute image differences: more heavy processing
-        self.time_start = get_time()
-        inputs = dict()
-        col = -1
-        horizontal_header = self.tw.horizontalHeader()
-        column_count = horizontal_header.count()
-        for c in range(column_count):
-            column_name = self.tw.horizontalHeaderItem(c).text()
-            if column_name == 'diff':
-                col = c
-                break
-        if col == -1:
-            col = 1
-            print("diff column not found, using column 1")
-        # First get list of row ids before the user gets time to reorder the table
-        self.tw.hideColumn(col)
-        row_ids = []
-        num_rows = self.tw.rowCount()
-        # we could also use len(self.tw.all_data) but it works only for json files, not jpg
-        for row in range(num_rows):
-            # This is simply to show the bar
-            row_item = NumericItem('')
-            self.tw.setItem(row, col, row_item)
-            row_id = self.tw.item(row, 0).text()
-            row_ids.append([row, row_id, row_item])
-        print("row_ids = {0}", row_ids)
+    def pause(self):
+        self.engine.pause()
+        self.updateStatus.emit(" Image differences paused")
+
+    def resume(self):
+        self.engine.resume()
 
-        for row_info in row_ids:
-            row = row_info[0]
-            row_id = row_info[1]
-            row_item = row_info[2]
-            # This is simply to show the bar
-            self.updateProgress.emit(row * 100 / num_rows)
-            print(f"self.tw image1 {self.tw.image1} image2 {self.tw.image2}")
-            print(f"{row_id} {self.tw.useful_data[row_id].keys()}")
-            for im_type in ['out_set0','out_set1']:
-                cv2_im = gb_image_reader.read(self.tw.useful_data[row_id][im_type])
-                width = cv2_im.data.shape[1]
-                height = cv2_im.data.shape[0]
-                new_width = int(1000)
-                new_height = int(new_width * height / width)
-                to_np_resized = cv2.resize(cv2_im.data, (new_width, new_height), interpolation=cv2.INTER_AREA)
-                inputs[im_type] = to_np_resized
+    def cancel(self):
+        self.engine.cancel()
+        self.updateStatus.emit(" Cancelling image differences")
 
-            im1 = inputs['out_set0']
-            im2 = inputs['out_set1']
-            diff = cv2.mean(cv2.absdiff(im1, im2))
-            # print "diff = ", diff, " ", type(diff)
-            diff = np.mean(np.array(diff))
-            # print "diff = ", diff, " ", type(diff)
-            # if cells are reordered, the cell position is not valid anymore
-            self.tw.write_number_item(row_item, col, diff)
-        self.tw.showColumn(col)
+    @property
+    def cancelled(self):
+        return self.engine.cancelled
 
-        self.column = col
+    def run(self):
+        print("ProcessDifferences run")
+        self.time_start = get_time()
+        num_rows = len(self.tasks)
+        print(f"ProcessDifferences {num_rows} rows, {len(self.engine.pairs)} pairs, {self.engine.metrics} on "
+              f"{self.engine.max_workers} processes, chunks of {self.engine.chunk_size} rows")
+        self.nb_done = 0
+        batch = []
+        last_batch = get_time()
+        for results in self.engine.run(self.tasks):
+            batch.extend(results)
+            self.nb_done += len(results)
+            if get_time()-last_batch >= self.batch_delay or self.nb_done == num_rows:
+                self.resultsReady.emit(batch)
+                batch = []
+                last_batch = get_time()
+                self.updateProgress.emit(int(self.nb_done * 100 / num_rows))
+                rate = self.nb_done / max(last_batch-self.time_start, 1e-6)
+                self.updateStatus.emit(f" Image differences: {self.nb_done}/{num_rows} rows, {rate:.1f} rows/s")
+        if batch:
+            self.resultsReady.emit(batch)
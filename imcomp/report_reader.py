@@ -0,0 +1,102 @@
+"""
+Report parsing into typed columns
+
+Reading a report is split in two steps: parse_report() reads the json file (gzip included) and converts
+each column to a NumPy array, it does not depend on Qt and is run on a worker thread by the main window.
+The tables then apply the ReportData to their rows in one pass, see apply_report().
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from .fill_table_data import readJson
+from .qimtools.metrics import METRICS
+
+
+class ReportColumn:
+    """
+        Values of one column for the rows of the report that define it
+    """
+    def __init__(self, name: str, rows: np.ndarray, kind: str, values):
+        '''
+        :param name: column name
+        :param rows: int64 positions in ReportData.row_ids
+        :param kind: 'int', 'float' or 'text'
+        :param values: int64 or float64 array for numbers, list of strings for text
+        '''
+        self.name = name
+        self.rows = rows
+        self.kind = kind
+        self.values = values
+
+
+class ReportData:
+    """
+        Parsed report: parameters, row ids and typed columns
+    """
+    def __init__(self, params: Optional[Dict[str, Any]], row_ids: List[str], columns: Dict[str, ReportColumn]):
+        self.params = params
+        self.row_ids = row_ids
+        self.columns = columns
+
+
+def is_metric_column(column_name: str) -> bool:
+    ''' Columns named <diff_name>:<metric> are written by the image differences, in the table or by imcomp-batch '''
+    return ':' in column_name and column_name.rpartition(':')[2] in METRICS
+
+
+def convert_values(texts: List[str]):
+    '''
+    Convert the report strings of a column, as is_int_number()/is_float_number() but for the whole column
+    :return: pair (kind, values) with kind in 'int', 'float', 'text'
+    '''
+    try:
+        return 'int', np.array(texts, dtype=np.int64)
+    except (ValueError, OverflowError):
+        pass
+    try:
+        return 'float', np.array(texts, dtype=np.float64)
+    except ValueError:
+        return 'text', texts
+
+
+def parse_report(filename: str, column_names: Optional[List[str]] = None,
+                 progress_callback: Optional[Callable] = None) -> ReportData:
+    '''
+    Read a report and convert its contents by column
+    :param filename: json report, compressed if it ends with .json.gz
+    :param column_names: columns to read, all the columns found in the report if None. The metric columns
+        are always read, see is_metric_column()
+    :param progress_callback: optional object with an emit(int) method, receives the progress in percent
+    :return: ReportData
+    '''
+    data = readJson(filename)
+    params = data.pop('params', None)
+    row_ids = []
+    # column name -> (list of row positions, list of strings)
+    cells: Dict[str, tuple] = dict()
+    for _row_id, data_row in data.items():
+        if not isinstance(data_row, dict):
+            continue
+        row = len(row_ids)
+        row_ids.append(_row_id)
+        for column_name, value in data_row.items():
+            if column_names is not None and column_name not in column_names and not is_metric_column(column_name):
+                continue
+            if value == '':
+                continue
+            column_cells = cells.get(column_name)
+            if column_cells is None:
+                column_cells = cells[column_name] = ([], [])
+            column_cells[0].append(row)
+            column_cells[1].append(value if isinstance(value, str) else str(value))
+    columns = dict()
+    for pos, (column_name, (rows, texts)) in enumerate(cells.items()):
+        if progress_callback is not None:
+            progress_callback.emit(int(pos*100/len(cells)))
+        kind, values = convert_values(texts)
+        columns[column_name] = ReportColumn(column_name, np.array(rows, dtype=np.int64), kind, values)
+    if progress_callback is not None:
+        progress_callback.emit(0)
+    return ReportData(params, row_ids, columns)
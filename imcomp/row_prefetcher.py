@@ -0,0 +1,186 @@
+"""
+Prefetch of the rows next to the current row
+
+When moving through the table row by row, the images of a row are read and decoded only once it is
+selected. The RowPrefetcher reads the following rows, in the current table order, into the ImageCache
+(and through the image reader into the FileCache) on a small thread pool while the current row is
+reviewed. The number of rows read ahead follows the navigation speed and is bounded by the cache budgets,
+moving to a distant row drops the pending work.
+"""
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Set
+
+
+class RowPrefetcher:
+    """
+        Read the rows around the current row into the image cache
+    """
+    # weight of the last row in the moving averages of the read time and size of an image
+    _smoothing = 0.3
+
+    def __init__(self, image_cache, file_cache=None, min_rows: int = 1, max_rows: int = 16,
+                 max_workers: int = 2, budget_ratio: float = 0.5, stats=None):
+        '''
+        :param image_cache: ImageCache shared by the viewers
+        :param file_cache: FileCache of the image reader, None if disabled, only used for its budget
+        :param min_rows: number of rows read ahead after a jump
+        :param max_rows: maximal number of rows read ahead
+        :param max_workers: number of reading threads
+        :param budget_ratio: part of each cache budget that the prefetched rows can use
+        :param stats: optional SessionStats, where the reads are counted apart from the navigation
+        '''
+        self.image_cache = image_cache
+        self.file_cache = file_cache
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_workers = max_workers
+        self.budget_ratio = budget_ratio
+        self.enabled = True
+        self.stats = stats
+        # number of rows read ahead
+        self.depth = min_rows
+        self.rows_loaded = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures = []
+        # incremented to drop the work of the previous requests
+        self._generation = 0
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._last_row: Optional[int] = None
+        self._last_time = 0.
+        self._direction = 1
+        self._files_per_row = 1
+        self._checked_rows = 0
+        # moving averages per image: read time in seconds, decoded size and file size in bytes
+        self._image_time = 0.
+        self._image_bytes = 0.
+        self._file_bytes = 0.
+
+    def update(self, row: int, nb_rows: int, row_files: Callable[[int], List[str]], read_size='full',
+               use_RGB: bool = True) -> List[int]:
+        '''
+        Called when the current row changes, from the GUI thread
+        :param row: current row in the table order
+        :param nb_rows: number of rows of the table
+        :param row_files: function that returns the image filenames of a row
+        :param read_size: read size of the viewers, as given to ImageCache.get_image()
+        :param use_RGB: as given to ImageCache.get_image()
+        :return: rows submitted for reading
+        '''
+        self.check_size_limits()
+        if not self.enabled or nb_rows == 0:
+            return []
+        now = time.perf_counter()
+        step = None if self._last_row is None else row-self._last_row
+        interval = now-self._last_time
+        self._last_row, self._last_time = row, now
+        if step == 0:
+            return []
+        direction = 1 if step is None or step > 0 else -1
+        if step is None or abs(step) > self.depth or direction != self._direction:
+            # jump or change of direction: the pending rows are not needed anymore
+            self.cancel()
+            self.depth = self.min_rows
+        else:
+            self.depth = self.adapted_depth(interval/abs(step))
+        self._direction = direction
+        self._files_per_row = max(1, len(row_files(row)))
+        return self._submit(self.rows_around(row, nb_rows), row_files, read_size, use_RGB)
+
+    def adapted_depth(self, interval: float) -> int:
+        '''
+        Number of rows to read ahead so that reading stays in front of a user moving one row every interval
+        seconds, bounded by max_rows and the cache budgets
+        '''
+        with self._lock:
+            row_time = self._image_time*self._files_per_row
+        needed = 1 + math.ceil(row_time/(self.max_workers*max(interval, 1e-3)))
+        return min(max(self.min_rows, min(self.max_rows, needed)), self.budget_rows())
+
+    def budget_rows(self) -> int:
+        ''' Number of rows that fit in budget_ratio of the image cache and of the file cache '''
+        limit = self.max_rows
+        with self._lock:
+            sizes = ((self.image_cache, self._image_bytes), (self.file_cache, self._file_bytes))
+        for cache, image_bytes in sizes:
+            if cache is not None and image_bytes > 0:
+                budget = self.budget_ratio*cache.max_cache_size*cache.cache_unit
+                limit = min(limit, int(budget/(image_bytes*self._files_per_row)))
+        return limit
+
+    def rows_around(self, row: int, nb_rows: int) -> List[int]:
+        ''' Rows to read, in priority order: depth rows in the direction of the navigation, then one row behind '''
+        rows = [row+self._direction*d for d in range(1, self.depth+1)]
+        rows.append(row-self._direction)
+        return [r for r in rows if 0 <= r < nb_rows]
+
+    def _submit(self, rows, row_files, read_size, use_RGB) -> List[int]:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='prefetch')
+        self._futures = [f for f in self._futures if not f.done()]
+        submitted = []
+        for r in rows:
+            with self._lock:
+                filenames = [f for f in row_files(r) if f not in self._pending and not self.image_cache.has_image(f)]
+                self._pending.update(filenames)
+            if filenames:
+                self._futures.append(self._executor.submit(self._read_row, self._generation, filenames,
+                                                           read_size, use_RGB))
+                submitted.append(r)
+        return submitted
+
+    def _read_row(self, generation: int, filenames: List[str], read_size, use_RGB: bool) -> None:
+        if self.stats is not None:
+            # the threads of the pool only read for the prefetcher
+            self.stats.set_prefetching(True)
+        for filename in filenames:
+            if generation != self._generation:
+                return
+            start = time.perf_counter()
+            try:
+                # the size limits are checked from the GUI thread, see check_size_limits()
+                image, from_cache = self.image_cache.get_image(filename, read_size, use_RGB=use_RGB,
+                                                               check_size=False)
+                data = getattr(image, 'data', None)
+                if data is not None and not from_cache:
+                    with self._lock:
+                        a = self._smoothing if self._image_time > 0 else 1.
+                        self._image_time += a*(time.perf_counter()-start-self._image_time)
+                        self._image_bytes += a*(data.nbytes-self._image_bytes)
+                        self._file_bytes += a*(os.path.getsize(filename)-self._file_bytes)
+            except Exception as e:
+                print(f"RowPrefetcher failed to read {filename}: {e}")
+            finally:
+                with self._lock:
+                    if generation == self._generation:
+                        self._pending.discard(filename)
+        with self._lock:
+            self.rows_loaded += 1
+
+    def check_size_limits(self) -> None:
+        ''' Apply the cache budgets to the rows read since the last call, from the GUI thread '''
+        if self.rows_loaded != self._checked_rows:
+            self._checked_rows = self.rows_loaded
+            self.image_cache.check_size_limit(update_progress=True)
+            if self.file_cache is not None:
+                self.file_cache.check_size_limit(update_progress=True)
+
+    def cancel(self) -> None:
+        ''' Drop the rows not read yet, the images being read are finished '''
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+
+    def shutdown(self) -> None:
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
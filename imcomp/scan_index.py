@@ -0,0 +1,105 @@
+"""
+Persistent scan index of an image set directory
+
+For each directory of the set, the index stores its modification time, its subdirectories and the
+unique_name -> filename mapping found by each ImageNameMatcher. On the next scan, directories whose
+modification time did not change are not listed again: only a stat() is needed per directory.
+Note that a directory mtime only changes when entries are added, removed or renamed in it, which is
+all that matters for the unique_name -> filename mapping.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .imcomp_config import ImCompConfig
+
+SCAN_INDEX_VERSION = 1
+
+# Directories modified less than this number of nanoseconds before the scan are not trusted:
+# on file systems with a coarse mtime resolution, they could still change without a new mtime
+RACY_MTIME_NS = 2_000_000_000
+
+
+class ScanIndex:
+    """
+        Scan index of one set directory, stored as a compressed json file in the imcomp cache folder
+    """
+    def __init__(self, directory: str, index_dir: Optional[str] = None):
+        self.directory = os.path.abspath(directory)
+        if index_dir is None:
+            index_dir = ImCompConfig.cache_dir('scan_index')
+        key = hashlib.sha1(self.directory.encode('utf-8')).hexdigest()
+        self.filename = os.path.join(index_dir, key + '.json.gz')
+        # entries from the previous scan and from the current one:
+        #   { rel_dir: [mtime_ns, subdirs, { matcher_key: { unique_name: basename } }] }
+        self._entries: Dict[str, list] = dict()
+        self._updated: Dict[str, list] = dict()
+        self._lock = threading.Lock()
+        self._scan_start = time.time_ns()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        self._scan_start = time.time_ns()
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with gzip.GzipFile(self.filename, 'r') as fileHandler:
+                data = json.loads(fileHandler.read().decode('utf-8'))
+            if data.get('version') == SCAN_INDEX_VERSION and data.get('directory') == self.directory:
+                self._entries = data['entries']
+        except Exception as e:
+            print(f"Failed to read scan index {self.filename}: {e}")
+            self._entries = dict()
+
+    def lookup(self, rel_dir: str, mtime_ns: int, matcher_keys: List[str]) \
+            -> Optional[Tuple[List[str], List[Dict[str, str]]]]:
+        """
+        :param rel_dir: directory relative to the set directory
+        :param mtime_ns: current modification time of the directory
+        :param matcher_keys: keys of the matchers applied to the directory
+        :return: pair (subdirs, [ {unique_name: basename} per matcher ]) if the index entry is valid, else None
+        """
+        entry = self._entries.get(rel_dir)
+        if entry is None or entry[0] != mtime_ns or not all(k in entry[2] for k in matcher_keys):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._updated[rel_dir] = entry
+        return entry[1], [entry[2][k] for k in matcher_keys]
+
+    def update(self, rel_dir: str, mtime_ns: int, subdirs: List[str], files: Dict[str, Dict[str, str]]) -> None:
+        """
+        :param rel_dir: directory relative to the set directory
+        :param mtime_ns: modification time of the directory before it was listed
+        :param subdirs: list of subdirectory names
+        :param files: { matcher_key: {unique_name: basename} }
+        """
+        if mtime_ns > self._scan_start - RACY_MTIME_NS:
+            # recently modified: force a new listing next time
+            mtime_ns = -1
+        with self._lock:
+            self._updated[rel_dir] = [mtime_ns, subdirs, files]
+
+    def save(self, keep_previous: bool = False) -> None:
+        """
+        Write the index, only directories visited by the current scan are kept unless keep_previous is True
+        """
+        entries = dict(self._entries) if keep_previous else dict()
+        entries.update(self._updated)
+        data = {'version': SCAN_INDEX_VERSION, 'directory': self.directory, 'entries': entries}
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+            with gzip.GzipFile(tmp_filename, 'w', 6) as fileHandler:
+                fileHandler.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+            os.replace(tmp_filename, self.filename)
+        except Exception as e:
+            print(f"Failed to write scan index {self.filename}: {e}")
@@ -0,0 +1,325 @@
+"""
+Watch the image set directories for new or modified images
+
+On Linux, inotify is used through ctypes (no additional dependency), with a polling fallback on other
+platforms or when inotify watches cannot be added (e.g. fs.inotify.max_user_watches reached).
+The polling backend detects new and renamed files from the directory modification times, files
+overwritten in place are only detected by inotify.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+from qimview.utils.qt_imports import QtCore
+
+from .image_scanner import ImageNameMatcher, directory_prefix
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = getattr(os, 'O_CLOEXEC', 0)
+_EVENT_HEADER  = struct.Struct('iIII')
+
+
+def _list_subdirs(path: str) -> List[str]:
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir() and not entry.is_symlink():
+                        subdirs.append(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return subdirs
+
+
+class PollingBackend:
+    """
+        Detect new files by checking the directory modification times every interval seconds
+    """
+    name = 'polling'
+
+    def __init__(self, roots: List[str], recursive: bool, accept: Callable[[str], bool],
+                 report: Callable[[List[str]], None], interval: float = 2.0):
+        self.roots = roots
+        self.recursive = recursive
+        self.accept = accept
+        self.report = report
+        self.interval = interval
+        # directory -> (mtime_ns, { filename: (size, mtime_ns) })
+        self._snapshot: Dict[str, tuple] = dict()
+        self._stop = threading.Event()
+
+    def _list(self, path: str):
+        files = dict()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file() and self.accept(entry.path):
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return files
+
+    def _directories(self):
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            yield path
+            if self.recursive:
+                stack.extend(_list_subdirs(path))
+
+    def _poll(self, initial: bool) -> None:
+        changed = []
+        new_snapshot = dict()
+        for path in self._directories():
+            if self._stop.is_set():
+                return
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            previous = self._snapshot.get(path)
+            if previous is not None and previous[0] == mtime_ns:
+                new_snapshot[path] = previous
+                continue
+            files = self._list(path)
+            new_snapshot[path] = (mtime_ns, files)
+            if not initial:
+                previous_files = previous[1] if previous is not None else dict()
+                for name, stat in files.items():
+                    if previous_files.get(name) != stat:
+                        changed.append(os.path.join(path, name))
+        self._snapshot = new_snapshot
+        if changed:
+            self.report(changed)
+
+    def run(self) -> None:
+        self._poll(initial=True)
+        while not self._stop.wait(self.interval):
+            self._poll(initial=False)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class InotifyBackend:
+    """
+        Linux inotify watches on every directory of the image sets, through ctypes
+    """
+    name = 'inotify'
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+    def __init__(self, roots: List[str], recursive: bool, accept: Callable[[str], bool],
+                 report: Callable[[List[str]], None]):
+        self.roots = roots
+        self.recursive = recursive
+        self.accept = accept
+        self.report = report
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: Dict[int, str] = dict()
+        self._stop = threading.Event()
+
+    def _add_watch(self, path: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch({path}) failed: {os.strerror(errno)}")
+        self._watches[wd] = path
+
+    def add_tree(self, path: str, report_existing: bool = False) -> None:
+        """ Watch path and its subdirectories, optionally reporting the files they already contain """
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            self._add_watch(current)
+            if report_existing:
+                try:
+                    with os.scandir(current) as it:
+                        existing = [e.path for e in it if e.is_file() and self.accept(e.path)]
+                except OSError:
+                    existing = []
+                if existing:
+                    self.report(existing)
+            if self.recursive:
+                stack.extend(_list_subdirs(current))
+
+    def setup(self) -> None:
+        """ Add all the watches, raises OSError if the watch limit is reached """
+        for root in self.roots:
+            if self.recursive:
+                self.add_tree(root)
+            else:
+                self._add_watch(root)
+
+    def _read_events(self) -> None:
+        try:
+            buffer = os.read(self._fd, 64*1024)
+        except BlockingIOError:
+            return
+        changed = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, pos)
+            pos += _EVENT_HEADER.size
+            name = buffer[pos:pos+name_length].rstrip(b'\0')
+            pos += name_length
+            if mask & IN_Q_OVERFLOW:
+                print("SetWatcher: inotify event queue overflow, some changes may be missed")
+                continue
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        # files may have been written before the watch was added
+                        self.add_tree(path, report_existing=True)
+                    except OSError as e:
+                        print(f"SetWatcher: {e}")
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self.accept(path):
+                changed.append(path)
+        if changed:
+            self.report(changed)
+
+    def run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([self._fd], [], [], 0.5)
+                if ready:
+                    self._read_events()
+        finally:
+            os.close(self._fd)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class SetWatcher(QtCore.QObject):
+    """
+        Watch the image set directories and emit filesChanged with the list of
+        (set_index, unique_name, filename) for new or modified images matching the set rules.
+        Changes are accumulated by the backend thread and emitted from the GUI thread at most
+        every notify_interval ms once start_notifications() has been called.
+    """
+    filesChanged = QtCore.Signal(list)
+
+    def __init__(self, image_sets: List[Dict[str, str]], name_filters: str, extensions: List[str],
+                 recursive: bool = True, poll_interval: float = 2.0, use_inotify: bool = True, parent=None):
+        super().__init__(parent)
+        self.image_sets = image_sets
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and sys.platform.startswith('linux')
+        # directory -> [ (set_index, matcher) ]
+        self._roots: Dict[str, list] = dict()
+        for set_index, image_set in enumerate(image_sets):
+            matcher = ImageNameMatcher(name_filters, image_set['suffix'], extensions)
+            self._roots.setdefault(os.path.normpath(image_set['directory']), []).append((set_index, matcher))
+        self._changed: Set[str] = set()
+        self._lock = threading.Lock()
+        self._backend = None
+        self._stop_requested = False
+        self._thread: Optional[threading.Thread] = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._notify)
+
+    def match(self, filename: str) -> list:
+        """ List of (set_index, unique_name) of the image sets that contain filename """
+        res = []
+        directory, basename = os.path.split(filename)
+        for root, set_matchers in self._roots.items():
+            rel_dir = os.path.relpath(directory, root)
+            if rel_dir == os.pardir or rel_dir.startswith(os.pardir + os.sep):
+                continue
+            if rel_dir != '.' and not self.recursive:
+                continue
+            prefix = directory_prefix(rel_dir)
+            for set_index, matcher in set_matchers:
+                unique_name = matcher.unique_name(prefix, basename)
+                if unique_name is not None:
+                    res.append((set_index, unique_name))
+        return res
+
+    def _accept(self, filename: str) -> bool:
+        return len(self.match(filename)) > 0
+
+    def _report(self, filenames: List[str]) -> None:
+        with self._lock:
+            self._changed.update(filenames)
+
+    def _run(self) -> None:
+        roots = [root for root in self._roots if os.path.isdir(root)]
+        backend = None
+        if self.use_inotify:
+            try:
+                backend = InotifyBackend(roots, self.recursive, self._accept, self._report)
+                backend.setup()
+            except (OSError, AttributeError) as e:
+                print(f"SetWatcher: inotify not available ({e}), using polling")
+                if backend is not None:
+                    backend.close()
+                backend = None
+        if backend is None:
+            backend = PollingBackend(roots, self.recursive, self._accept, self._report, self.poll_interval)
+        self._backend = backend
+        if self._stop_requested:
+            backend.stop()
+        print(f"SetWatcher: watching {len(roots)} directories with {backend.name}")
+        backend.run()
+
+    def start(self) -> None:
+        """ Start watching in a background thread, changes are kept until start_notifications() """
+        self._thread = threading.Thread(target=self._run, name='SetWatcher', daemon=True)
+        self._thread.start()
+
+    def start_notifications(self, notify_interval: int = 500) -> None:
+        self._timer.start(notify_interval)
+
+    def stop(self) -> None:
+        self._timer.stop()
+        self._stop_requested = True
+        if self._backend is not None:
+            self._backend.stop()
+
+    def _notify(self) -> None:
+        with self._lock:
+            filenames, self._changed = self._changed, set()
+        if not filenames:
+            return
+        changes = []
+        for filename in sorted(filenames):
+            for set_index, unique_name in self.match(filename):
+                changes.append((set_index, unique_name, filename))
+        if changes:
+            self.filesChanged.emit(changes)
@@ -0,0 +1,287 @@
+"""
+Decoded images shared between the imcomp processes of a machine
+
+Each image is stored in its own multiprocessing.shared_memory segment. A small index segment, with a
+fixed number of entries, maps a key of the image (file identity, read size and channel order) to its
+segment, shape and format, and keeps the last use of each entry for the LRU eviction within the budget.
+The index is protected by a file lock, and records the processes attached to it: the last process to
+detach removes the segments.
+
+A window that misses an image in its ImageCache copies it from the shared segment instead of decoding it,
+so each image is decoded once per machine.
+"""
+
+import hashlib
+import inspect
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .qimtools.metric_cache import file_identity
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+    from multiprocessing import resource_tracker
+
+_VERSION = 1
+_MAX_PROCESSES = 32
+_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('capacity', '<u4'), ('budget', '<u8'),
+                    ('used', '<u8'), ('next_segment', '<u8'), ('pids', '<i8', (_MAX_PROCESSES,))])
+_ENTRY = np.dtype([('key', '<u8'), ('segment', '<u8'), ('nbytes', '<u8'), ('last_used', '<f8'),
+                   ('shape', '<u4', (3,)), ('dtype', 'S4'), ('ndim', 'u1'), ('precision', 'u1'),
+                   ('downscale', 'u1'), ('channels', 'u1')])
+
+
+# Python >= 3.13 can open segments that are not tracked
+_TRACK = 'track' in inspect.signature(shared_memory.SharedMemory).parameters
+
+
+def open_segment(name: str, create: bool = False, size: int = 0) -> shared_memory.SharedMemory:
+    '''
+    Open a shared memory segment that is not removed when the process exits:
+    the segments are removed by the SharedImageStore
+    '''
+    if _TRACK:
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    if os.name != 'nt':
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def unlink_segment(segment: shared_memory.SharedMemory) -> None:
+    if not _TRACK and os.name != 'nt':
+        # unlink() unregisters the segment from the resource tracker
+        resource_tracker.register(segment._name, 'shared_memory')
+    segment.unlink()
+
+
+def process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # pids are not checked on Windows, where the segments are removed with their last handle
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FileLock:
+    """
+        Lock shared by the processes and by the threads of a process
+    """
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        if os.name == 'nt':
+            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if os.name == 'nt':
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class SharedImageStore:
+    """
+        Pixel arrays in shared memory segments, indexed and evicted in LRU order
+        The first process creates the index with its budget and capacity, the others attach to it.
+    """
+    def __init__(self, lock_filename: str, name: Optional[str] = None, budget: int = 2048*1024*1024,
+                 capacity: int = 4096):
+        '''
+        :param lock_filename: file locked while the index is used
+        :param name: name of the index segment, the segment names of the images start with it
+        :param budget: total size in bytes of the image segments
+        :param capacity: number of index entries
+        '''
+        self.name = name or f'imcomp_{os.getuid() if hasattr(os, "getuid") else os.getlogin()}'
+        self._lock = FileLock(lock_filename)
+        # segments created by this process, kept open on Windows where a segment is removed with its last handle
+        self._owned = dict()
+        with self._lock:
+            try:
+                self._index = open_segment(self.name)
+                created = False
+            except FileNotFoundError:
+                self._index = open_segment(self.name, create=True,
+                                           size=_HEADER.itemsize+capacity*_ENTRY.itemsize)
+                created = True
+            self._header = np.ndarray((), dtype=_HEADER, buffer=self._index.buf)
+            if created:
+                self._header['magic'] = b'IMCS'
+                self._header['version'] = _VERSION
+                self._header['capacity'] = capacity
+                self._header['budget'] = budget
+                self._header['used'] = 0
+                self._header['next_segment'] = 0
+                self._header['pids'] = 0
+            elif self._header['magic'] != b'IMCS' or self._header['version'] != _VERSION:
+                self._release_index()
+                raise RuntimeError(f"Shared memory segment {self.name} is not an imcomp index")
+            self._entries = np.ndarray((int(self._header['capacity']),), dtype=_ENTRY, buffer=self._index.buf,
+                                       offset=_HEADER.itemsize)
+            self._register(os.getpid())
+
+    @property
+    def budget(self) -> int:
+        return int(self._header['budget'])
+
+    @property
+    def used(self) -> int:
+        return int(self._header['used'])
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._entries['nbytes']))
+
+    @staticmethod
+    def key(filename: str, variant: str = '') -> Optional[int]:
+        ''' 64 bits key of an image file and of the way it is decoded, None if the file does not exist '''
+        identity = file_identity(filename)
+        if identity is None:
+            return None
+        return int.from_bytes(hashlib.blake2b(f'{identity}|{variant}'.encode(), digest_size=8).digest(), 'little')
+
+    def _register(self, pid: int) -> None:
+        pids = self._header['pids']
+        alive = [p for p in pids if p and p != pid and process_alive(int(p))][:_MAX_PROCESSES-1]
+        pids[:] = 0
+        pids[:len(alive)+1] = alive+[pid]
+
+    def _segment_name(self, segment: int) -> str:
+        return f'{self.name}_{segment}'
+
+    def _find(self, key: int) -> Optional[int]:
+        found = np.flatnonzero((self._entries['key'] == key) & (self._entries['nbytes'] > 0))
+        return int(found[0]) if len(found) else None
+
+    def _remove(self, index: int) -> None:
+        entry = self._entries[index]
+        name = self._segment_name(int(entry['segment']))
+        segment = self._owned.pop(name, None)
+        try:
+            if segment is None:
+                segment = open_segment(name)
+            segment.close()
+            unlink_segment(segment)
+        except FileNotFoundError:
+            pass
+        self._header['used'] -= entry['nbytes']
+        entry['nbytes'] = 0
+        entry['key'] = 0
+
+    def get(self, key: int) -> Optional[Tuple[np.ndarray, dict]]:
+        '''
+        :return: pair (copy of the array, format given to put()), None if the key is not in the store
+        '''
+        with self._lock:
+            index = self._find(key) if self._entries is not None else None
+            if index is None:
+                return None
+            entry = self._entries[index]
+            try:
+                segment = open_segment(self._segment_name(int(entry['segment'])))
+            except FileNotFoundError:
+                # removed with the process that created it, on Windows
+                self._remove(index)
+                return None
+            try:
+                shape = tuple(int(n) for n in entry['shape'][:entry['ndim']])
+                array = np.ndarray(shape, dtype=np.dtype(entry['dtype'].decode()), buffer=segment.buf).copy()
+            finally:
+                segment.close()
+            entry['last_used'] = time.time()
+            image_format = {'precision': int(entry['precision']), 'downscale': int(entry['downscale']),
+                            'channels': int(entry['channels'])}
+        return array, image_format
+
+    def put(self, key: int, array: np.ndarray, precision: int = 8, downscale: int = 1, channels: int = 0) -> bool:
+        '''
+        Add an array, the least recently used arrays are removed to stay within the budget
+        :return: False if the array is larger than a quarter of the budget
+        '''
+        nbytes = array.nbytes
+        if nbytes == 0 or nbytes > self.budget//4 or array.ndim > 3:
+            return False
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            if self._entries is None:
+                # detached
+                return False
+            if self._find(key) is not None:
+                return True
+            entries = self._entries
+            while True:
+                valid = np.flatnonzero(entries['nbytes'] > 0)
+                if self.used+nbytes <= self.budget and len(valid) < len(entries):
+                    break
+                self._remove(int(valid[np.argmin(entries['last_used'][valid])]))
+            segment_id = int(self._header['next_segment'])
+            self._header['next_segment'] += 1
+            segment = open_segment(self._segment_name(segment_id), create=True, size=nbytes)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            if os.name == 'nt':
+                self._owned[segment.name] = segment
+            else:
+                segment.close()
+            entry = entries[int(np.flatnonzero(entries['nbytes'] == 0)[0])]
+            entry['key'] = key
+            entry['segment'] = segment_id
+            entry['nbytes'] = nbytes
+            entry['last_used'] = time.time()
+            entry['shape'] = array.shape+(0,)*(3-array.ndim)
+            entry['ndim'] = array.ndim
+            entry['dtype'] = array.dtype.str.encode()
+            entry['precision'] = precision
+            entry['downscale'] = downscale
+            entry['channels'] = channels
+            self._header['used'] += nbytes
+        return True
+
+    def _release_index(self) -> None:
+        # the views must be released before the segment is closed
+        self._header = None
+        self._entries = None
+        self._index.close()
+
+    def close(self) -> None:
+        ''' Detach from the store, the last process removes the segments '''
+        with self._lock:
+            pid = os.getpid()
+            pids = self._header['pids']
+            alive = [int(p) for p in pids if p and p != pid and process_alive(int(p))]
+            pids[:] = 0
+            pids[:len(alive)] = alive
+            last = not alive
+            if last:
+                for index in np.flatnonzero(self._entries['nbytes'] > 0):
+                    self._remove(int(index))
+            for segment in self._owned.values():
+                segment.close()
+            self._owned = dict()
+            self._release_index()
+            if last:
+                unlink_segment(self._index)
+        self._lock.close()
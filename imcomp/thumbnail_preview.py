@@ -0,0 +1,85 @@
+"""
+Thumbnail preview of the rows whose images are not in the image cache
+
+The viewers show the thumbnails of the ThumbnailStore at once, the images are decoded into the ImageCache
+on a worker thread and the row is displayed as usual when they are ready.
+"""
+
+import cv2
+
+from qimview.utils.thread_pool import ThreadPool
+from qimview.utils.viewer_image import ViewerImage, ImageFormat
+
+
+class ThumbnailPreview:
+    """
+        Show the thumbnails of a new selection while its images are decoded
+    """
+    def __init__(self, store, image_cache):
+        '''
+        :param store: ThumbnailStore
+        :param image_cache: ImageCache shared by the viewers
+        '''
+        self.store = store
+        self.image_cache = image_cache
+        self.enabled = True
+        self._pool = ThreadPool()
+        self._pool.setMaxThreadCount(1)
+        # incremented for each selection, only the last one is displayed
+        self._generation = 0
+
+    def viewer_image(self, filename, use_RGB=True):
+        ''' ViewerImage of the thumbnail of an image, None if it has no thumbnail '''
+        res = self.store.get(filename)
+        if res is None:
+            return None
+        thumbnail, image_width = res
+        if thumbnail.ndim == 2:
+            return ViewerImage(thumbnail, precision=8, downscale=max(1, image_width//thumbnail.shape[1]),
+                               channels=ImageFormat.CH_Y)
+        if use_RGB:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)
+        return ViewerImage(thumbnail, precision=8, downscale=max(1, image_width//thumbnail.shape[1]),
+                           channels=ImageFormat.CH_RGB if use_RGB else ImageFormat.CH_BGR)
+
+    def show(self, multiview, image_dict, display) -> bool:
+        '''
+        Show the thumbnails in the viewers and decode the images in the background
+        :param multiview: MultiView, its viewers keep the image names of the previous selection
+        :param image_dict: image name -> filename of the new selection
+        :param display: function that displays the new selection, called once the images are in the cache
+        :return: False if there is nothing to preview, the caller then displays the selection itself
+        '''
+        self._generation += 1
+        if not self.enabled:
+            return False
+        missing = [f for f in dict.fromkeys(image_dict.values()) if f and not self.image_cache.has_image(f)]
+        if not missing:
+            return False
+        use_RGB = not multiview.use_opengl
+        viewers = [v for v in multiview.image_viewers[:multiview.nb_viewers_used] if v.image_name in image_dict]
+        images = {v.image_name: self.viewer_image(image_dict[v.image_name], use_RGB) for v in viewers}
+        if not viewers or any(image is None for image in images.values()):
+            return False
+        reference = images.get(multiview.output_label_reference_image)
+        for viewer in viewers:
+            viewer.set_image(images[viewer.image_name])
+            viewer.set_image_ref(reference)
+            viewer.widget.repaint()
+        generation = self._generation
+        self._pool.set_worker(self.read_images, generation, missing, multiview.read_size, use_RGB)
+        self._pool.set_worker_callbacks(finished_cb=lambda: self.images_read(generation, display))
+        self._pool.start_worker()
+        return True
+
+    def read_images(self, generation, filenames, read_size, use_RGB, progress_callback=None):
+        for filename in filenames:
+            if generation != self._generation:
+                # the selection has changed
+                return
+            self.image_cache.get_image(filename, read_size, use_RGB=use_RGB, check_size=False)
+
+    def images_read(self, generation, display):
+        self.image_cache.check_size_limit(update_progress=True)
+        if generation == self._generation:
+            display()
@@ -0,0 +1,294 @@
+"""
+Persistent store of image thumbnails
+
+The thumbnails are uint8 pixel arrays appended to a pack file that is read through mmap, so that showing
+a thumbnail is only a copy. A SQLite index maps the identity of the image file (path, size, modification
+time) to the position of its thumbnail in the pack, a modified image gets a new thumbnail. When the pack
+exceeds the disk budget, the least recently used thumbnails are dropped and the pack is rewritten.
+
+Several imcomp processes can use the same folder: the pack and the index are changed under a file lock,
+new thumbnails are appended at the end of the pack file, and the generation of the pack, stored in the index,
+tells the other processes that the pack was rewritten.
+"""
+
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .qimtools.difference_engine import jpeg_header, read_resized
+from .qimtools.metric_cache import file_identity
+from .shared_cache import FileLock
+
+
+def make_thumbnail(filename: str, width: int) -> Tuple[np.ndarray, int]:
+    '''
+    Read an image at thumbnail size, JPEG images are decoded at a reduced scale
+    :return: pair (uint8 thumbnail in BGR order, width of the image)
+    '''
+    header = jpeg_header(filename)
+    if header is not None:
+        image_width = header[0]
+        image = read_resized(filename, min(width, image_width))
+    else:
+        image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise IOError(f"Failed to read image {filename}")
+        image_width = image.shape[1]
+        if image_width > width:
+            image = cv2.resize(image, (width, max(1, int(width*image.shape[0]/image_width))),
+                               interpolation=cv2.INTER_AREA)
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    elif image.dtype != np.uint8:
+        image = np.clip(image*255, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(image), image_width
+
+
+class ThumbnailStore:
+    """
+        Thumbnails in a pack file indexed by file identity, with LRU eviction
+        The store can be used from several threads, and by the imcomp processes that share its folder.
+    """
+    # after an eviction, the pack is reduced to this part of the budget
+    _compact_ratio = 0.75
+
+    def __init__(self, folder: str, max_size: int = 1024*1024*1024, width: int = 256):
+        '''
+        :param folder: folder of the pack and index files
+        :param max_size: disk budget of the pack in bytes
+        :param width: thumbnail width
+        '''
+        os.makedirs(folder, exist_ok=True)
+        self.max_size = max_size
+        self.width = width
+        self.pack_filename = os.path.join(folder, 'thumbnails.pack')
+        # lock of the pack and of the index, shared by the threads and by the processes
+        self._lock = FileLock(os.path.join(folder, 'thumbnails.lock'))
+        self._mmap: Optional[mmap.mmap] = None
+        # last use of the thumbnails read since the last flush
+        self._used: Dict[str, float] = dict()
+        with self._lock:
+            self._connection = sqlite3.connect(os.path.join(folder, 'thumbnails.sqlite'), check_same_thread=False,
+                                               timeout=30)
+            # each thumbnail is committed, so that the other processes find it
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS thumbnails (key TEXT PRIMARY KEY, offset INTEGER, '
+                                     'height INTEGER, width INTEGER, channels INTEGER, image_width INTEGER, '
+                                     'last_used REAL) WITHOUT ROWID')
+            # incremented each time the pack is rewritten
+            self._connection.execute('CREATE TABLE IF NOT EXISTS pack (generation INTEGER)')
+            if self._connection.execute('SELECT generation FROM pack').fetchone() is None:
+                self._connection.execute('INSERT INTO pack VALUES (0)')
+            self._connection.commit()
+            self._open_pack()
+
+    def _open_pack(self) -> None:
+        ''' Open the current pack, with the lock held '''
+        self._generation = self._connection.execute('SELECT generation FROM pack').fetchone()[0]
+        # unbuffered: the size of the file is the offset of the next thumbnail
+        self._pack = open(self.pack_filename, 'ab', buffering=0)
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _check_generation(self) -> None:
+        ''' Open the pack again if another process has rewritten it, with the lock held '''
+        if self._connection.execute('SELECT generation FROM pack').fetchone()[0] != self._generation:
+            self._pack.close()
+            self._open_pack()
+
+    def _read(self, offset: int, size: int) -> bytes:
+        ''' Bytes of the pack, the pack is mapped again when it has grown '''
+        if self._mmap is None or offset+size > len(self._mmap):
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.pack_filename, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:offset+size]
+
+    def _key(self, filename: str) -> Optional[str]:
+        ''' File identity and thumbnail width '''
+        identity = file_identity(filename)
+        return None if identity is None else f'{identity}#{self.width}'
+
+    def has(self, filename: str) -> bool:
+        identity = self._key(filename)
+        if identity is None:
+            return False
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM thumbnails WHERE key=?', (identity,)).fetchone() is not None
+
+    def get(self, filename: str) -> Optional[Tuple[np.ndarray, int]]:
+        '''
+        :return: pair (uint8 thumbnail in BGR order, width of the image), None if the image has no thumbnail
+        '''
+        identity = self._key(filename)
+        if identity is None:
+            return None
+        with self._lock:
+            self._check_generation()
+            row = self._connection.execute('SELECT offset, height, width, channels, image_width FROM thumbnails '
+                                           'WHERE key=?', (identity,)).fetchone()
+            if row is None:
+                return None
+            offset, height, width, channels, image_width = row
+            shape = (height, width) if channels == 1 else (height, width, channels)
+            thumbnail = np.frombuffer(self._read(offset, height*width*channels), dtype=np.uint8).reshape(shape)
+            self._used[identity] = time.time()
+        return thumbnail, image_width
+
+    def put(self, filename: str, thumbnail: np.ndarray, image_width: int) -> None:
+        ''' Add the uint8 thumbnail of an image, see make_thumbnail() '''
+        identity = self._key(filename)
+        if identity is None:
+            return
+        channels = 1 if thumbnail.ndim == 2 else thumbnail.shape[2]
+        data = thumbnail.tobytes()
+        with self._lock:
+            self._check_generation()
+            # the end of the pack, which the other processes also append to
+            offset = os.fstat(self._pack.fileno()).st_size
+            self._pack.write(data)
+            self._connection.execute('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (identity, offset, thumbnail.shape[0], thumbnail.shape[1], channels,
+                                      image_width, time.time()))
+            self._connection.commit()
+            if offset+len(data) > self.max_size:
+                self._evict()
+
+    def flush(self) -> None:
+        ''' Write the last use of the thumbnails read to the index '''
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._used:
+            self._connection.executemany('UPDATE thumbnails SET last_used=? WHERE key=?',
+                                         [(t, key) for key, t in self._used.items()])
+            self._used = dict()
+        self._connection.commit()
+
+    def _evict(self) -> None:
+        '''
+        Keep the most recently used thumbnails within _compact_ratio of the budget, and rewrite the pack,
+        with the lock held
+        '''
+        self._flush()
+        rows = self._connection.execute('SELECT key, offset, height*width*channels FROM thumbnails '
+                                        'ORDER BY last_used DESC').fetchall()
+        kept = []
+        total = 0
+        for key, offset, size in rows:
+            if total+size > self.max_size*self._compact_ratio:
+                break
+            kept.append((key, offset, size))
+            total += size
+        tmp_filename = self.pack_filename+'.tmp'
+        offsets = []
+        with open(tmp_filename, 'wb') as pack:
+            for key, offset, size in kept:
+                offsets.append((pack.tell(), key))
+                pack.write(self._read(offset, size))
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._pack.close()
+        try:
+            os.replace(tmp_filename, self.pack_filename)
+        except OSError as e:
+            # on Windows, the pack cannot be replaced while another process maps it
+            print(f"ThumbnailStore: failed to rewrite the pack: {e}")
+            os.remove(tmp_filename)
+            self._open_pack()
+            return
+        self._connection.executemany('DELETE FROM thumbnails WHERE key=?', [(key,) for key, _, _ in rows[len(kept):]])
+        self._connection.executemany('UPDATE thumbnails SET offset=? WHERE key=?', offsets)
+        self._connection.execute('UPDATE pack SET generation=generation+1')
+        self._connection.commit()
+        self._open_pack()
+        print(f"ThumbnailStore: {len(rows)-len(kept)} thumbnails evicted, {total/(1024*1024):.0f} Mb kept")
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._pack.close()
+            self._connection.close()
+        self._lock.close()
+
+
+class ThumbnailBuilder:
+    """
+        Add the missing thumbnails of a list of images to a store, in the background
+    """
+    def __init__(self, store: ThumbnailStore, max_workers: int = 2):
+        self.store = store
+        self.max_workers = max_workers
+        self._thread: Optional[threading.Thread] = None
+        self._cancel = threading.Event()
+        self.files_total = 0
+        self.files_done = 0
+
+    def start(self, filenames: List[str]) -> None:
+        '''
+        Start building the thumbnails, a previous run is cancelled
+        :param filenames: images in priority order, empty names and duplicates are ignored
+        '''
+        self.cancel()
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=([f for f in dict.fromkeys(filenames) if f],),
+                                        daemon=True)
+        self._thread.start()
+
+    def cancel(self) -> None:
+        if self._thread is not None:
+            self._cancel.set()
+            self._thread.join()
+            self._thread = None
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, filenames: List[str]) -> None:
+        filenames = [f for f in filenames if not self.store.has(f)]
+        self.files_total = len(filenames)
+        self.files_done = 0
+        next_file = 0
+        pending = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='thumbnails') as executor:
+            while next_file < len(filenames) or pending:
+                while not self._cancel.is_set() and next_file < len(filenames) and len(pending) < 2*self.max_workers:
+                    filename = filenames[next_file]
+                    try:
+                        pending[executor.submit(make_thumbnail, filename, self.store.width)] = filename
+                    except RuntimeError:
+                        # the interpreter is shutting down
+                        self._cancel.set()
+                        break
+                    next_file += 1
+                if self._cancel.is_set():
+                    for future in pending:
+                        future.cancel()
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = pending.pop(future)
+                    try:
+                        self.store.put(filename, *future.result())
+                    except Exception as e:
+                        print(f"ThumbnailBuilder failed for {filename}: {e}")
+                    self.files_done += 1
+        self.store.flush()
+        print(f"ThumbnailBuilder: {self.files_done}/{self.files_total} thumbnails added")
@@ -0,0 +1,66 @@
+import os
+
+from imcomp import basename_index
+from imcomp.basename_index import BasenameIndex
+from imcomp.fill_table_data import adapt_path, find_file
+
+
+def make_tree(root, nb_dirs=5, nb_files=4):
+    for d in range(nb_dirs):
+        for f in range(nb_files):
+            path = os.path.join(root, f'moved{d % 2}', f'dir{d}', f'image_{d}_{f}.png')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fh:
+                fh.write(path)
+
+
+def count_listings(monkeypatch):
+    listed = []
+    list_dir = BasenameIndex._list_dir
+
+    def counting_list_dir(path):
+        listed.append(path)
+        return list_dir(path)
+    monkeypatch.setattr(BasenameIndex, '_list_dir', staticmethod(counting_list_dir))
+    return listed
+
+
+def test_find_file_lists_each_directory_once(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_tree(root)
+    listed = count_listings(monkeypatch)
+    # the report paths no longer exist, each file is found by its basename
+    for d in range(5):
+        for f in range(4):
+            filename = os.path.join('old', f'image_{d}_{f}.png')
+            expected = os.path.join(root, f'moved{d % 2}', f'dir{d}', f'image_{d}_{f}.png')
+            assert find_file(root, filename) == expected
+    # the root, moved0, moved1 and the 5 dirs
+    assert len(listed) == len(set(listed)) == 8
+
+
+def test_refresh_lists_modified_directories(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_tree(root)
+    index = BasenameIndex(root)
+    assert index.find_file('new.png') is None
+    listed = count_listings(monkeypatch)
+    new_file = os.path.join(root, 'moved1', 'dir3', 'new.png')
+    with open(new_file, 'w') as fh:
+        fh.write('new')
+    # a name not found refreshes the index, at most once per min_refresh_interval
+    index._refresh_time -= index.min_refresh_interval
+    assert index.find_file('new.png') == new_file
+    assert listed == [os.path.join(root, 'moved1', 'dir3')]
+    assert index.find_file('other.png') is None
+    assert len(listed) == 1
+
+
+def test_adapt_path_matches_path_end(tmp_path, monkeypatch):
+    monkeypatch.setattr(basename_index, '_indexes', dict())
+    root = str(tmp_path)
+    for folder in ('results/output', 'other/output', 'output2'):
+        os.makedirs(os.path.join(root, folder))
+    assert adapt_path('/old/project/results/output', root_dir=root) == os.path.join(root, 'results', 'output')
+    # the folder has the same name but not the same parent folder
+    assert adapt_path('/old/project/logs/output', root_dir=root) == '/old/project/logs/output'
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+
+from imcomp.qimtools.difference_engine import DifferenceEngine, compute_chunk, read_resized
+from imcomp.qimtools.metric_cache import MetricCache
+
+
+def write_image(filename, seed=0, shape=(120, 160, 3)):
+    image = np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+    cv2.imwrite(filename, image)
+    return filename
+
+
+def test_read_cache_missing_image(tmp_path):
+    a = write_image(str(tmp_path / 'a.png'), 0)
+    b = write_image(str(tmp_path / 'b.png'), 1)
+    engine = DifferenceEngine([('A-B', 'A', 'B')], metrics=['mae'], width=80,
+                              cache=MetricCache(str(tmp_path / 'metrics.sqlite')))
+    tasks = [('complete', {'A': a, 'B': b}), ('missing', {'A': a, 'B': str(tmp_path / 'none.png')})]
+    identities = {unique_name: engine.identities(filenames) for unique_name, filenames in tasks}
+
+    cached, remaining, row_keys = engine.read_cache(tasks, identities)
+    # the row with a missing image is resolved without a lookup, only the complete row is a miss
+    assert [unique_name for unique_name, _ in cached] == ['missing']
+    assert np.isnan(cached[0][1][0])
+    assert [unique_name for unique_name, _ in remaining] == ['complete']
+    assert (engine.cache.hits, engine.cache.misses) == (0, 1)
+
+    engine.write_cache([('complete', [1.5])], row_keys)
+    cached, remaining, _ = engine.read_cache(tasks, identities)
+    assert dict(cached)['complete'] == [1.5] and not remaining
+    assert (engine.cache.hits, engine.cache.misses) == (1, 1)
+    engine.cache.close()
+
+
+def test_read_resized_jpeg_and_png(tmp_path):
+    # the reduced JPEG decoding gives 300x201 pixels, the height must still be the one of the full image
+    image = np.random.default_rng(0).integers(0, 256, (401, 600, 3), dtype=np.uint8)
+    jpeg = str(tmp_path / 'image.jpg')
+    png = str(tmp_path / 'image.png')
+    cv2.imwrite(jpeg, image)
+    cv2.imwrite(png, image)
+    assert read_resized(jpeg, 200).shape == read_resized(png, 200).shape == (133, 200, 3)
+    results = compute_chunk([('row', {'A': jpeg, 'B': png})], [('A-B', 'A', 'B')], 200, ['mae'], 10)
+    assert not np.isnan(results[0][1][0])
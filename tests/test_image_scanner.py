@@ -0,0 +1,32 @@
+import os
+
+from imcomp.image_scanner import ImageScanner, merge_image_lists
+
+
+def make_tree(root):
+    # 'img.jpg' and 'img.png' have the same unique name, as 'a_b/x' and 'a/b/x'
+    files = ['img.jpg', 'img.png', 'other.jpg', 'a_b/x.jpg', 'a/b/x.jpg', 'a/b/y.png', 'a/c/z.jpg']
+    for name in files:
+        for image_set in ('A', 'B'):
+            path = os.path.join(root, image_set, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+
+
+def streamed_rows(image_sets, max_workers):
+    scanner = ImageScanner(image_sets, '', ['.jpg', '.png'], max_workers=max_workers)
+    rows = dict()
+    for batch in scanner.iter_rows(batch_size=1, interval=0):
+        rows.update(batch)
+    rows.update(scanner.updated_rows)
+    return [(unique_name, rows[unique_name]) for unique_name in scanner.row_order]
+
+
+def test_iter_rows_matches_scan(tmp_path):
+    make_tree(str(tmp_path))
+    image_sets = [{'directory': os.path.join(str(tmp_path), s), 'suffix': ''} for s in ('A', 'B')]
+    expected = list(merge_image_lists(ImageScanner(image_sets, '', ['.jpg', '.png']).scan()).items())
+    assert len(expected) == 5
+    for max_workers in (1, 2, 8, 8, 8):
+        assert streamed_rows(image_sets, max_workers) == expected
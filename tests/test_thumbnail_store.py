@@ -0,0 +1,46 @@
+import multiprocessing
+
+import numpy as np
+
+from imcomp.thumbnail_store import ThumbnailStore
+
+
+def thumbnail(index):
+    return np.full((16, 32, 3), index % 251, dtype=np.uint8)
+
+
+def fill_store(folder, filenames, first):
+    # the budget holds about 20 thumbnails, so that both processes evict while the other one appends
+    store = ThumbnailStore(folder, max_size=20*16*32*3, width=32)
+    for index, filename in enumerate(filenames):
+        store.put(filename, thumbnail(first+index), 320)
+        res = store.get(filename)
+        assert res is not None and np.array_equal(res[0], thumbnail(first+index))
+    store.close()
+
+
+def test_processes_share_the_store(tmp_path):
+    folder = str(tmp_path / 'thumbnails')
+    filenames = []
+    for index in range(120):
+        filename = tmp_path / f'image{index}.png'
+        filename.write_bytes(b'image')
+        filenames.append(str(filename))
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=fill_store, args=(folder, filenames[first:first+60], first))
+                 for first in (0, 60)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0]
+
+    store = ThumbnailStore(folder, max_size=20*16*32*3, width=32)
+    found = 0
+    for index, filename in enumerate(filenames):
+        res = store.get(filename)
+        if res is not None:
+            assert np.array_equal(res[0], thumbnail(index)) and res[1] == 320
+            found += 1
+    store.close()
+    assert found > 0